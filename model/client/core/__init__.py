@@ -1,2 +1,2 @@
-from .config import API_KEY, model_client, MODEL_NAME, pool, SERVER_URL, get_client_id, set_client_id
+from .config import API_KEY, model_client, MODEL_NAME, EMBEDDING_DTYPE, pool, SERVER_URL, CLIENT_CAPACITY, get_client_id, set_client_id
 from .security import verify_api_key
\ No newline at end of file
@@ -10,6 +10,8 @@ load_dotenv()
 # CLIENTS SETTINGS #
 API_KEY = os.getenv("API_KEY")
 SERVER_URL = os.getenv("SERVER_URL")
+# validation tasks this client runs at once (e.g. several LM instances)
+CLIENT_CAPACITY = int(os.getenv("CLIENT_CAPACITY", "1"))
 
 # MODEL SETTINGS #
 transport = httpx.HTTPTransport(retries=0)
@@ -17,6 +19,8 @@ model_client = OpenAI(base_url=os.getenv("MODEL_URL"), api_key=os.getenv("MODEL_
                       http_client=httpx.Client(transport=transport, trust_env=False))
 
 MODEL_NAME = "maziyarpanahi/mistral-7b-instruct-v0.3"
+# storage of the book embedding matrix: float32 | float16 | int8 (per-row scale)
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
 
 # DATABASE SETTINGS #
 DB_CONFIG = {
@@ -4,17 +4,35 @@ import pickle
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from client.core import EMBEDDING_DTYPE
 from client.database import get_cursor
 
 
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8)
+
+
 class EmbeddingManager:
+    # строк матрицы за одно умножение: ограничивает временную float32-копию блока
+    block_rows = 32768
+
     def __init__(self, cache_file="embeddings/embeddings.pkl"):
         self.model = SentenceTransformer('all-MiniLM-L6-v2')
         self.cache_file = cache_file
+        # нормированные float32-векторы лежат рядом с pickle и отображаются в память,
+        # а не хранятся словарём по книгам
+        self.matrix_file = os.path.splitext(cache_file)[0] + ".npy"
 
-        self.book_vectors = {}
         self.book_meta = {}
 
+        self.dtype = EMBEDDING_DTYPE
+        self._ids = []
+        self._vectors = None
+        # матрица поиска в EMBEDDING_DTYPE; для float32 — сами отображённые векторы
+        self._matrix = None
+        self._scale = None
+
     async def async_encode(self, text, **kwargs):
         loop = asyncio.get_running_loop()
         return await loop.run_in_executor(None, lambda: self.model.encode(text, convert_to_numpy=True, **kwargs)) # type: ignore
@@ -26,7 +44,12 @@ class EmbeddingManager:
             return
 
         print("Loading embeddings from cache...")
-        self._load_cache()
+        try:
+            self._load_cache()
+        except FileNotFoundError:
+            print("Embedding matrix not found — generating fresh embeddings...")
+            await self._build_initial_cache()
+            return
 
         print("Checking for new books in DB...")
         await self._update_cache_fast()
@@ -52,26 +75,44 @@ class EmbeddingManager:
         print(f"Encoding {len(texts)} books…")
         vectors = self.model.encode(texts, batch_size=256, convert_to_numpy=True)
 
-        for (bid, title, author), vec in zip(rows, vectors):
-            genres = book_genres_map[bid]
-            self.book_vectors[bid] = vec
-            self.book_meta[bid] = (title, author, genres)
+        self.book_meta = {}
+        for (bid, title, author) in rows:
+            self.book_meta[bid] = (title, author, book_genres_map[bid])
 
-        self._save_cache()
+        self._write_vectors(ids, _normalize(vectors) if ids else None)
         print("Initial cache built.")
 
     def _save_cache(self):
         with open(self.cache_file, "wb") as f:
             pickle.dump({
-                "book_vectors": self.book_vectors,
+                "ids": self._ids,
                 "book_meta": self.book_meta
             }, f) # type: ignore
 
     def _load_cache(self):
         with open(self.cache_file, "rb") as f:
             data = pickle.load(f)
-            self.book_vectors = data["book_vectors"]
-            self.book_meta = data["book_meta"]
+        self.book_meta = data["book_meta"]
+
+        if "book_vectors" in data:
+            # старый формат: векторы внутри pickle — переносим их в .npy
+            vectors = data["book_vectors"]
+            ids = list(vectors)
+            self._write_vectors(ids, _normalize(np.stack([vectors[bid] for bid in ids])) if ids else None)
+            return
+
+        self._ids = data["ids"]
+        self._load_matrix()
+
+    def _write_vectors(self, ids, vectors):
+        """Пишет нормированные векторы в .npy (через rename), сохраняет pickle и отображает матрицу заново."""
+        if vectors is not None and len(ids):
+            tmp = self.matrix_file + ".tmp.npy"
+            np.save(tmp, np.asarray(vectors, dtype=np.float32))
+            os.replace(tmp, self.matrix_file)
+        self._ids = list(ids)
+        self._save_cache()
+        self._load_matrix()
 
     async def _update_cache_fast(self):
         """Обновление кэша: сравнивает только ID."""
@@ -81,7 +122,7 @@ class EmbeddingManager:
             cursor.execute("SELECT id FROM books")
             db_ids = {row[0] for row in cursor.fetchall()}
 
-        cache_ids = set(self.book_vectors.keys())
+        cache_ids = set(self._ids)
 
         # 2. Ищем новые книги
         new_ids = db_ids - cache_ids
@@ -117,18 +158,20 @@ class EmbeddingManager:
 
         vectors = self.model.encode(texts, batch_size=256, convert_to_numpy=True)
 
-        for (bid, title, author, genres), vec in zip(updated_rows, vectors):
-            self.book_vectors[bid] = vec
+        for (bid, title, author, genres) in updated_rows:
             self.book_meta[bid] = (title, author, genres)
 
-        self._save_cache()
+        vectors = _normalize(vectors)
+        if self._vectors is not None:
+            vectors = np.vstack([self._vectors, vectors])
+        self._write_vectors(self._ids + [row[0] for row in updated_rows], vectors)
         print("Cache updated with new books.")
 
     def top_similar(self, read_list, n=30):
         if not read_list:
             return []
 
-        if not self.book_vectors:
+        if self._matrix is None:
             return []
 
         read_texts = [f"{b.title} {b.author} {" ".join(b.genre) if b.genre else ""}" for b in read_list]
@@ -136,12 +179,24 @@ class EmbeddingManager:
 
         avg_vec = np.mean(read_vectors, axis=0)
 
-        ids = list(self.book_vectors.keys())
-        mats = np.stack([self.book_vectors[id] for id in ids])
-
-        sims = mats @ avg_vec / (
-            np.linalg.norm(mats, axis=1) * np.linalg.norm(avg_vec) + 1e-8
-        )
+        ids = self._ids
+        avg_vec = (avg_vec / (np.linalg.norm(avg_vec) + 1e-8)).astype(np.float32)
+        # по блокам: для float32 блок — срез отображённой матрицы без копии,
+        # для float16/int8 во float32 расширяется только блок
+        sims = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), self.block_rows):
+            block = np.asarray(self._matrix[start:start + self.block_rows], dtype=np.float32)
+            sims[start:start + block.shape[0]] = block @ avg_vec
+        if self._scale is not None:
+            sims *= self._scale
+
+        if self.dtype != "float32":
+            # quantized scores pick the candidates, float32 vectors rank them;
+            # читаются только их строки отображённой матрицы
+            cand = np.sort(np.argpartition(-sims, min(4 * n, len(ids)) - 1)[:4 * n])
+            rescored = np.full_like(sims, -np.inf)
+            rescored[cand] = np.asarray(self._vectors[cand], dtype=np.float32) @ avg_vec
+            sims = rescored
 
         top_idx = sims.argsort()[-n:][::-1]
 
@@ -150,5 +205,32 @@ class EmbeddingManager:
             for i in top_idx
         ]
 
+    def _load_matrix(self):
+        self._scale = None
+        if not self._ids:
+            self._vectors, self._matrix = None, None
+            return
+
+        self._vectors = np.load(self.matrix_file, mmap_mode="r")
+        if self.dtype not in ("float16", "int8"):
+            self._matrix = self._vectors
+            return
+
+        # квантуем по блокам, чтобы не держать в памяти float32-копию всей матрицы
+        n = self._vectors.shape[0]
+        self._matrix = np.empty(self._vectors.shape, dtype=np.int8 if self.dtype == "int8" else np.float16)
+        if self.dtype == "int8":
+            self._scale = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.block_rows):
+            block = np.asarray(self._vectors[start:start + self.block_rows], dtype=np.float32)
+            end = start + block.shape[0]
+            if self.dtype == "int8":
+                scale = np.abs(block).max(axis=1) / 127
+                scale[scale == 0] = 1
+                self._matrix[start:end] = np.rint(block / scale[:, None])
+                self._scale[start:end] = scale
+            else:
+                self._matrix[start:end] = block
+
 
 embedding_manager = EmbeddingManager()
@@ -2,13 +2,13 @@ import asyncio
 
 import httpx
 
-from client.core import API_KEY, SERVER_URL
+from client.core import API_KEY, SERVER_URL, CLIENT_CAPACITY
 from client.server.services import measure_ping, get_client_ip
 
 
 async def register():
     async with httpx.AsyncClient() as client:
-        response = await client.post(f"{SERVER_URL}clients/register", json={"address": get_client_ip(), "model_name": "maziyarpanahi/mistral-7b-instruct-v0.3"}, headers={"x-api-key": API_KEY})
+        response = await client.post(f"{SERVER_URL}clients/register", json={"address": get_client_ip(), "model_name": "maziyarpanahi/mistral-7b-instruct-v0.3", "capacity": CLIENT_CAPACITY}, headers={"x-api-key": API_KEY})
         data = response.json()
         return data["client_id"]
 
@@ -1,14 +1,20 @@
 import asyncio
 import os
 import sys
+import time
+import logging
 import aiohttp
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from routes import client_router, generate_router, health_router
+from model.server.core import embedding_service, CATALOG_REFRESH_INTERVAL, scoring_pool, http_pool, \
+    callback_queue, REQUEST_SECONDS
+
+log = logging.getLogger(__name__)
 
 app = FastAPI(title="Bookpoisk", version="1.0")
 
@@ -17,6 +23,21 @@ app.include_router(generate_router)
 app.include_router(health_router)
 
 
+@app.middleware("http")
+async def request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # route template, not the raw path, so ids do not blow up the label set
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe((request.method, getattr(route, "path", "unmatched"), str(status)),
+                                time.perf_counter() - start)
+
+
 async def health_endpoint():
     while True:
         try:
@@ -28,9 +49,30 @@ async def health_endpoint():
         await asyncio.sleep(300)
 
 
+async def catalog_refresh():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, embedding_service.refresh_catalog)
+        except Exception:
+            log.exception("Catalog refresh failed")
+
+
 @app.on_event("startup")
 async def startup():
+    await http_pool.start()
+    await callback_queue.start()
     asyncio.create_task(health_endpoint())
+    if CATALOG_REFRESH_INTERVAL > 0:
+        asyncio.create_task(catalog_refresh())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    scoring_pool.shutdown()
+    await callback_queue.stop()
+    await http_pool.close()
 
 
 if __name__ == "__main__":
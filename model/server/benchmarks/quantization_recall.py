@@ -0,0 +1,93 @@
+"""
+Recall of quantized catalog search against the exact float32 path.
+
+    python -m model.server.benchmarks.quantization_recall --rows 200000 --dim 384
+
+For every dtype the exact retriever is run with and without the float32 rescoring pass.
+The catalog is memory-mapped from a .npy file, as the embedding store serves it (--heap keeps
+it in memory instead, where quantization falls back to float32). The benchmark reports
+recall@k of the top-k rows, the heap footprint of the retriever (the quantized copy plus the
+float32 matrix when it is not mapped) and the scan time per batch of users.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from model.server.services.retrieval import ExactRetriever
+
+
+def synthetic_embeddings(rows: int, dim: int, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """Normalized vectors around random centroids, closer to sentence embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centroids[rng.integers(0, clusters, rows)] + 0.6 * rng.standard_normal((rows, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def user_queries(embeddings: np.ndarray, users: int, books: int, seed: int = 1):
+    """Each user's read books are noisy copies of catalog rows; returns (queries, offsets)."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, embeddings.shape[0], users * books)
+    q = embeddings[rows] + 0.3 * rng.standard_normal((len(rows), embeddings.shape[1])).astype(np.float32)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    return q, np.arange(0, users * books, books)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def recall(expected: np.ndarray, got: np.ndarray) -> float:
+    hits = sum(len(np.intersect1d(e, g)) for e, g in zip(expected, got))
+    return hits / expected.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--books", type=int, default=5, help="read books per user")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore", type=int, default=200)
+    parser.add_argument("--heap", action="store_true", help="keep the float32 matrix in memory")
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.rows, args.dim)
+    queries, offsets = user_queries(embeddings, args.users, args.books)
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.heap:
+            path = os.path.join(tmp, "matrix.npy")
+            np.save(path, embeddings)
+            embeddings = np.load(path, mmap_mode="r")
+        run(args, embeddings, queries, offsets)
+        # the mapping has to be closed before the directory goes
+        del embeddings
+
+
+def run(args, embeddings: np.ndarray, queries: np.ndarray, offsets: np.ndarray):
+
+    exact = ExactRetriever(embeddings)
+    start = time.perf_counter()
+    truth = top_k(exact.scores_batch(queries, offsets), args.k)
+    base_time = time.perf_counter() - start
+
+    print(f"{args.rows} rows x {args.dim}, {args.users} users x {args.books} books, recall@{args.k}")
+    print(f"{'dtype':<10}{'rescore':>8}{'recall':>9}{'heap MB':>11}{'scan ms':>9}")
+    print(f"{'float32':<10}{'-':>8}{1.0:>9.4f}{exact.resident_bytes / 1e6:>11.1f}{base_time * 1e3:>9.1f}")
+
+    for dtype in ("float16", "int8"):
+        for rescore in (0, args.rescore):
+            retriever = ExactRetriever(embeddings, dtype, rescore)
+            start = time.perf_counter()
+            got = top_k(retriever.scores_batch(queries, offsets), args.k)
+            elapsed = time.perf_counter() - start
+            print(f"{retriever.dtype:<10}{rescore:>8}{recall(truth, got):>9.4f}"
+                  f"{retriever.resident_bytes / 1e6:>11.1f}{elapsed * 1e3:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""
+Offline benchmark of EmbeddingService recommendations.
+
+    python -m model.server.benchmarks.recommendation --rows 100000 --concurrency 1,8,32
+    python -m model.server.benchmarks.recommendation --catalog books.jsonl --reads model/server/req.json
+
+The catalog is synthetic (deterministic for a given --seed) or read from a JSON lines file of
+books, and is served by an in-memory BookRepository. Read lists are sampled from the catalog
+with a share of books it does not contain, or replayed from /generate/ request bodies such as
+req.json. Books are encoded with the hashing fallback encoder: nothing is downloaded, so the
+benchmark runs offline, in CI as well as on a dev machine.
+
+Reported: catalog load time and size (columns, key/id indexes), latency of every recommendation
+stage (encode, score, select, genre_lookup, taken from recommendation_stage_seconds), request
+latency and throughput through the scoring pool and the batcher at each concurrency level, peak
+RSS, and recall@k of the approximate retrieval paths (hnsw, ivfpq, float16, int8) against exact
+float32 search.
+The recall pass memory-maps the catalog matrix from a temporary .npy file, as the embedding
+store serves it: float16 / int8 quantize only a mapped matrix. "used" is the path that actually
+ran (exact search when FAISS is missing or the catalog is too small for IVF-PQ).
+
+The hashing encoder puts every book in a narrow cone (scores of a user against the whole
+catalog fall within a few hundredths), so int8 recall here, and float16 recall on large
+catalogs, is far below what sentence embeddings get; raise --rescore to see how many
+candidates they need, and see quantization_recall.py for recall on embeddings shaped like
+the transformer's.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import resource
+    _HAS_RESOURCE = True
+except Exception:
+    _HAS_RESOURCE = False
+
+from model.server.benchmarks.quantization_recall import recall, top_k
+from model.server.models import Book
+from model.server.services.batcher import RecommendationBatcher
+from model.server.services.book_repository import BookRepository, book_key
+from model.server.services.catalog import BOOK_FIELDS
+from model.server.services.embedding_service import EmbeddingService, STAGE_SECONDS
+from model.server.services.retrieval import ExactRetriever, RetrievalConfig, build_retriever
+from model.server.services.scoring_pool import PoolSaturated, ScoringPool
+
+GENRES = (
+    "fantasy", "science fiction", "detective", "thriller", "romance", "classics", "poetry", "drama",
+    "history", "biography", "horror", "adventure", "humor", "philosophy", "psychology", "business",
+    "children", "young adult", "dystopia", "mystery", "war", "travel", "science", "religion",
+)
+# two-syllable pseudo-words: a vocabulary large enough for distinct texts without a corpus
+_SYLLABLES = ("ka", "lo", "mi", "ra", "te", "vu", "an", "sel", "dor", "ni", "pe", "os", "tar", "ul", "be", "gri")
+WORDS = tuple(a + b for a in _SYLLABLES for b in _SYLLABLES)
+
+STAGES = ("encode", "score", "select", "genre_lookup")
+APPROXIMATE = ("hnsw", "ivfpq", "float16", "int8")
+
+
+class SyntheticBookRepository(BookRepository):
+    """
+    Deterministic catalog generated in blocks of BLOCK rows, so even a million books are never
+    held as dicts. A block depends only on (seed, block number). The id is also the last word
+    of the title, so a genre lookup regenerates the one row instead of indexing the catalog.
+    """
+
+    BLOCK = 1000
+
+    def __init__(self, rows: int, seed: int = 0, authors: int = 0):
+        self.rows = rows
+        self.seed = seed
+        # about 20 books per author, as in a real catalog a few authors have many books
+        self.authors = authors or max(1, rows // 20)
+        # genre popularity falls off as 1 / rank
+        weights = 1 / np.arange(1, len(GENRES) + 1)
+        self._genre_p = weights / weights.sum()
+        self._block = lru_cache(maxsize=64)(self._make_block)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _make_block(self, block: int) -> List[Tuple[Any, ...]]:
+        start = block * self.BLOCK
+        n = min(self.BLOCK, self.rows - start)
+        rng = np.random.default_rng((self.seed, block))
+        title_words = rng.integers(0, len(WORDS), (n, 3))
+        desc_len = rng.integers(15, 40, n)
+        desc_words = rng.integers(0, len(WORDS), (n, 40))
+        authors = rng.integers(0, self.authors, n)
+        years = rng.integers(1850, 2025, n)
+        pages = rng.integers(80, 900, n)
+        genre_count = rng.integers(1, 4, n)
+        genres = rng.choice(len(GENRES), (n, 3), p=self._genre_p)
+
+        rows = []
+        for j in range(n):
+            i = start + j
+            rows.append((
+                str(i),
+                " ".join(WORDS[w] for w in title_words[j]) + f" {i}",
+                f"Author {authors[j]}",
+                int(years[j]),
+                " ".join(WORDS[w] for w in desc_words[j, :desc_len[j]]),
+                None,
+                int(pages[j]),
+                [GENRES[g] for g in dict.fromkeys(genres[j, :genre_count[j]].tolist())],
+            ))
+        return rows
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return dict(zip(BOOK_FIELDS, self._block(i // self.BLOCK)[i % self.BLOCK]))
+
+    def iter_book_rows(self, batch_size: int = 2000) -> Iterator[List[Tuple[Any, ...]]]:
+        batch: List[Tuple[Any, ...]] = []
+        for block in range(-(-self.rows // self.BLOCK)):
+            # straight from the generator, the load must not warm up the lookup cache
+            batch.extend(self._make_block(block))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_all_books(self) -> List[Dict[str, Any]]:
+        return [dict(zip(BOOK_FIELDS, r)) for batch in self.iter_book_rows() for r in batch]
+
+    def get_book_ids(self) -> List[Any]:
+        return [str(i) for i in range(self.rows)]
+
+    def _index(self, value: Any) -> Optional[int]:
+        value = str(value or "").rsplit(" ", 1)[-1]
+        return int(value) if value.isdigit() and int(value) < self.rows else None
+
+    def get_books_by_ids(self, ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        rows = (self._index(i) for i in ids)
+        return [self.row(i) for i in rows if i is not None]
+
+    def get_genres_for_titles(self, titles_and_authors: Iterable[Dict[str, str]]) -> Dict[str, List[str]]:
+        res = {}
+        for t in titles_and_authors:
+            i = self._index(t.get("title"))
+            if i is None:
+                continue
+            book = self.row(i)
+            key = book_key(t.get("title"), t.get("author"))
+            if book_key(book["title"], book["author"]) == key:
+                res[key] = list(book["genres"])
+        return res
+
+
+class MemoryBookRepository(BookRepository):
+    """Books given as dicts (e.g. a dump of the books table), with the genre lookup of the database."""
+
+    def __init__(self, books: Iterable[Dict[str, Any]]):
+        self.books = []
+        self._genres: Dict[str, List[str]] = {}
+        for i, b in enumerate(books):
+            book = {f: b.get(f) for f in BOOK_FIELDS}
+            book["id"] = str(book["id"] if book["id"] is not None else i)
+            book["genres"] = list(dict.fromkeys(book["genres"] or []))
+            self.books.append(book)
+            # all editions of a title and author share one genre list, like the GROUP BY in SQL
+            self._genres.setdefault(book_key(book["title"], book["author"]), []).extend(book["genres"])
+        self._by_id = {b["id"]: b for b in self.books}
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> "MemoryBookRepository":
+        with open(path, encoding="utf-8") as fh:
+            return cls(json.loads(line) for line in fh if line.strip())
+
+    def __len__(self) -> int:
+        return len(self.books)
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return self.books[i]
+
+    def get_all_books(self) -> List[Dict[str, Any]]:
+        return [dict(b) for b in self.books]
+
+    def get_book_ids(self) -> List[Any]:
+        return list(self._by_id)
+
+    def get_books_by_ids(self, ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        return [dict(self._by_id[str(i)]) for i in ids if str(i) in self._by_id]
+
+    def get_genres_for_titles(self, titles_and_authors: Iterable[Dict[str, str]]) -> Dict[str, List[str]]:
+        res = {}
+        for t in titles_and_authors:
+            key = book_key(t.get("title"), t.get("author"))
+            if key in self._genres:
+                res[key] = list(dict.fromkeys(self._genres[key]))
+        return res
+
+
+def _book(data: Dict[str, Any]) -> Book:
+    data = {k: v for k, v in data.items() if k in Book.model_fields}
+    if data.get("id") is None:
+        # /generate/ bodies carry no ids; a stable one keeps the query cache meaningful
+        data["id"] = uuid.uuid5(uuid.NAMESPACE_URL, book_key(data.get("title"), data.get("author")))
+    return Book(**data)
+
+
+def load_read_lists(paths: List[str]) -> List[List[Book]]:
+    """Read lists from /generate/ request bodies: one per .json file, a JSON list of them, or one per line."""
+    bodies = []
+    for path in paths:
+        with open(path, encoding="utf-8") as fh:
+            if path.endswith(".jsonl"):
+                bodies.extend(json.loads(line) for line in fh if line.strip())
+            else:
+                data = json.load(fh)
+                bodies.extend(data if isinstance(data, list) else [data])
+    return [[_book(b) for b in (body.get("books") if isinstance(body, dict) else body)] for body in bodies]
+
+
+def synthetic_read_lists(repo, users: int, books: int, unknown: float, seed: int) -> List[List[Book]]:
+    """Each user reads `books` catalog books, a share `unknown` of them replaced by books the catalog lacks."""
+    rng = np.random.default_rng(seed)
+    outside = SyntheticBookRepository(users * books, seed=seed + 1)
+    lists = []
+    for u in range(users):
+        read = []
+        for j in range(books):
+            if rng.random() < unknown:
+                book = dict(outside.row(u * books + j), id=None)
+                book["title"] = book["title"].rsplit(" ", 1)[0]
+            else:
+                book = repo.row(int(rng.integers(0, len(repo))))
+            read.append(_book(book))
+        lists.append(read)
+    return lists
+
+
+def peak_rss_mb() -> Optional[float]:
+    if not _HAS_RESOURCE:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _latency(seconds: List[float], elapsed: float) -> Dict[str, float]:
+    ms = np.asarray(seconds) * 1e3
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if len(ms) else (float("nan"),) * 3
+    return {"requests": len(ms), "rps": len(ms) / elapsed if elapsed else 0.0,
+            "mean_ms": float(ms.mean()) if len(ms) else float("nan"),
+            "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def stage_latency(before: Dict[str, dict], after: Dict[str, dict]) -> Dict[str, Dict[str, float]]:
+    """Per-stage count and mean from two snapshots of recommendation_stage_seconds."""
+    res = {}
+    for stage in STAGES:
+        a, b = after.get(stage), before.get(stage, {"count": 0, "sum": 0.0})
+        count = (a["count"] - b["count"]) if a else 0
+        total = (a["sum"] - b["sum"]) if a else 0.0
+        res[stage] = {"count": count, "mean_ms": total / count * 1e3 if count else 0.0, "total_s": total}
+    return res
+
+
+def run_sequential(service: EmbeddingService, read_lists: List[List[Book]], params: Dict[str, Any],
+                   requests: int) -> Tuple[Dict[str, float], Dict[str, Dict[str, float]]]:
+    before = STAGE_SECONDS.snapshot()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        t = time.perf_counter()
+        service.get_recommendations(read_lists[i % len(read_lists)], **params)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return _latency(latencies, elapsed), stage_latency(before, STAGE_SECONDS.snapshot())
+
+
+async def run_concurrent(service: EmbeddingService, read_lists: List[List[Book]], params: Dict[str, Any],
+                         requests: int, concurrency: int, workers: int, max_batch: int,
+                         max_wait_ms: float) -> Dict[str, float]:
+    """`concurrency` callers issue requests back to back through the scoring pool and the batcher, as the routes do."""
+    pool = ScoringPool(workers, queue_size=concurrency)
+    batcher = RecommendationBatcher(service, pool, max_wait_ms, max_batch)
+    counter = itertools.count()
+    latencies: List[float] = []
+    rejected = 0
+
+    async def caller():
+        nonlocal rejected
+        while (i := next(counter)) < requests:
+            t = time.perf_counter()
+            try:
+                await batcher.recommend(read_lists[i % len(read_lists)], **params)
+            except PoolSaturated:
+                rejected += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(caller() for _ in range(concurrency)))
+    finally:
+        pool.shutdown()
+    res = _latency(latencies, time.perf_counter() - start)
+    res.update(concurrency=concurrency, rejected=rejected)
+    return res
+
+
+def _approximate_config(name: str, base: RetrievalConfig) -> RetrievalConfig:
+    if name in ("float16", "int8"):
+        return base.model_copy(update={"backend": "exact", "dtype": name})
+    return base.model_copy(update={"backend": name, "dtype": "float32"})
+
+
+def measure_recall(service: EmbeddingService, read_lists: List[List[Book]], names: List[str], k: int,
+                   base: RetrievalConfig) -> List[Dict[str, Any]]:
+    """
+    recall@k of each approximate path against exact float32 scores, for the same read lists.
+    The catalog matrix is memory-mapped from a .npy file, as the embedding store serves it:
+    float16 / int8 only quantize a mapped matrix.
+    """
+    snap = service._load_catalog()
+    books = [b for read in read_lists for b in read]
+    queries = service._encode_books(books, snap)
+    offsets = np.cumsum([0] + [len(read) for read in read_lists[:-1]])
+    k = min(k, len(snap) - 1)
+
+    truth = top_k(ExactRetriever(snap.embeddings).scores_batch(queries, offsets), k)
+    res = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "matrix.npy")
+        np.save(path, np.asarray(snap.embeddings, dtype=np.float32))
+        embeddings = np.load(path, mmap_mode="r")
+        for name in names:
+            config = _approximate_config(name, base)
+            start = time.perf_counter()
+            retriever = build_retriever(embeddings, config)
+            build = time.perf_counter() - start
+            # what actually ran: build_retriever falls back to exact search without FAISS,
+            # ExactRetriever to float32 for a matrix that is not mapped
+            used = retriever.backend
+            if isinstance(retriever, ExactRetriever) and retriever.dtype != "float32":
+                used = retriever.dtype
+            start = time.perf_counter()
+            got = top_k(retriever.scores_batch(queries, offsets), k)
+            res.append({"path": name, "used": used, "recall": recall(truth, got), "build_s": build,
+                        "score_ms": (time.perf_counter() - start) * 1e3})
+            del retriever
+        # the mapping has to be closed before the directory goes
+        del embeddings
+    return res
+
+
+def _print_latency(title: str, rows: List[Dict[str, float]]):
+    print(f"\n{title}")
+    print(f"{'concurrency':>11}{'requests':>10}{'rps':>9}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rejected':>10}")
+    for r in rows:
+        print(f"{r.get('concurrency', 1):>11}{r['requests']:>10}{r['rps']:>9.1f}{r['mean_ms']:>9.2f}"
+              f"{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{r.get('rejected', 0):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="synthetic catalog size")
+    parser.add_argument("--catalog", help="JSON lines file of books instead of a synthetic catalog")
+    parser.add_argument("--reads", nargs="*", default=[], help="/generate/ request bodies (.json / .jsonl) to replay")
+    parser.add_argument("--users", type=int, default=200, help="synthetic read lists")
+    parser.add_argument("--books", type=int, default=5, help="read books per synthetic user")
+    parser.add_argument("--unknown", type=float, default=0.2, help="share of read books missing from the catalog")
+    parser.add_argument("--requests", type=int, default=500, help="requests per run")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--workers", type=int, default=2, help="scoring pool workers")
+    parser.add_argument("--batch", type=int, default=16, help="batcher max batch size (1 disables batching)")
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0)
+    parser.add_argument("--top", type=int, default=10, help="similar / novel / genre_similar per request")
+    parser.add_argument("--backend", default="exact", help="retrieval backend of the service: exact | hnsw | ivfpq")
+    parser.add_argument("--candidates", type=int, default=200, help="approximate index rows per read book")
+    parser.add_argument("--band-candidates", type=int, default=0,
+                        help="approximate index search depth for the novel band (0 = --candidates)")
+    parser.add_argument("--dtype", default="float32", help="exact search matrix dtype: float32 | float16 | int8")
+    parser.add_argument("--rescore", type=int, default=200, help="float32 rescoring candidates of float16 / int8")
+    parser.add_argument("--approximate", default=",".join(APPROXIMATE), help="paths compared with exact search")
+    parser.add_argument("--k", type=int, default=50, help="recall@k")
+    parser.add_argument("--query-cache", type=int, default=10000, help="read-book vector cache size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    repo = (MemoryBookRepository.from_jsonl(args.catalog) if args.catalog
+            else SyntheticBookRepository(args.rows, args.seed))
+    read_lists = (load_read_lists(args.reads) if args.reads
+                  else synthetic_read_lists(repo, args.users, args.books, args.unknown, args.seed))
+    read_lists = [r for r in read_lists if r]
+    if not read_lists:
+        parser.error("no read lists to replay")
+
+    retrieval = RetrievalConfig(backend=args.backend, candidates=args.candidates, band_candidates=args.band_candidates,
+                                dtype=args.dtype, rescore=args.rescore)
+    service = EmbeddingService(repo, retrieval=retrieval, query_cache_size=args.query_cache, encoder="hash")
+    params = {"similar_top": args.top, "novel_top": args.top, "genre_top": args.top}
+
+    start = time.perf_counter()
+    snap = service._load_catalog()
+    load = {"rows": len(snap), "seconds": time.perf_counter() - start, "books_mb": snap.books.nbytes / 1e6,
+            "index_mb": snap.index_nbytes / 1e6, "embeddings_mb": snap.embeddings.nbytes / 1e6,
+            "peak_rss_mb": peak_rss_mb()}
+    print(f"catalog: {load['rows']} rows loaded in {load['seconds']:.2f}s, columns {load['books_mb']:.1f} MB, "
+          f"key/id indexes {load['index_mb']:.1f} MB, "
+          f"embeddings {load['embeddings_mb']:.1f} MB, {len(read_lists)} read lists, "
+          f"retrieval {args.backend}/{args.dtype}")
+
+    # warm-up: the first requests fill the query cache and touch the pages of the matrix
+    service.get_recommendations(read_lists[0], **params)
+
+    sequential, stages = run_sequential(service, read_lists, params, args.requests)
+    print(f"\n{'stage':<14}{'count':>8}{'mean ms':>10}{'total s':>10}")
+    for stage, s in stages.items():
+        print(f"{stage:<14}{s['count']:>8}{s['mean_ms']:>10.3f}{s['total_s']:>10.3f}")
+    _print_latency("sequential get_recommendations", [sequential])
+
+    concurrent = [
+        asyncio.run(run_concurrent(service, read_lists, params, args.requests, c, args.workers, args.batch,
+                                   args.batch_wait_ms))
+        for c in (int(c) for c in args.concurrency.split(",") if c)
+    ]
+    _print_latency(f"scoring pool ({args.workers} workers), batcher (max {args.batch})", concurrent)
+
+    # before the recall pass, which holds several (users, rows) score matrices at once
+    serving_rss = peak_rss_mb()
+
+    names = [n for n in args.approximate.split(",") if n]
+    recalls = measure_recall(service, read_lists, names, args.k, retrieval) if names else []
+    if recalls:
+        print(f"\n{'path':<10}{'used':<10}{f'recall@{args.k}':>11}{'build s':>9}{'score ms':>10}")
+        for r in recalls:
+            print(f"{r['path']:<10}{r['used']:<10}{r['recall']:>11.4f}{r['build_s']:>9.2f}{r['score_ms']:>10.1f}")
+
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"\npeak RSS: {serving_rss:.1f} MB serving, {rss:.1f} MB with the recall pass")
+    else:
+        print("\npeak RSS: unavailable on this platform")
+    print(f"query cache: {service.query_cache_stats()}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"args": vars(args), "catalog": load, "stages": stages, "sequential": sequential,
+                       "concurrent": concurrent, "recall": recalls,
+                       "peak_rss_mb": {"serving": serving_rss, "total": rss},
+                       "query_cache": service.query_cache_stats()}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,4 @@
-from .config import client_manager, task_manager, BACKEND_URL, embedding_service
+from .config import client_manager, task_manager, BACKEND_URL, embedding_service, CATALOG_REFRESH_INTERVAL
+from .config import scoring_pool, recommendation_batcher, http_pool, callback_queue, CLIENT_WAIT_TIMEOUT
+from .metrics import REQUEST_SECONDS, VALIDATION_RTT_SECONDS
 from .security import verify_api_key
\ No newline at end of file
@@ -3,18 +3,111 @@ import sys
 
 from dotenv import load_dotenv
 
-from model.server.services import ClientManager, TaskManager, MemoryClientStore
+from model.server.services import ClientManager, RedisClientManager, TaskManager, MemoryClientStore, \
+    RedisClientStore, MemoryTaskStore, RedisTaskStore
 from model.server.services.book_repository import DBBookRepository
 from model.server.services.embedding_service import EmbeddingService
+from model.server.services.retrieval import RetrievalConfig
+from model.server.services.scoring_pool import ScoringPool
+from model.server.services.batcher import RecommendationBatcher
+from model.server.services.http_client import HttpClientPool
+from model.server.services.callback_queue import CallbackQueue
 
 load_dotenv()
 
 sys.stdout.reconfigure(line_buffering=True)
 
 BACKEND_URL = os.getenv("BACKEND_URL")
+EMBEDDINGS_CACHE_DIR = os.getenv("EMBEDDINGS_CACHE_DIR", "embeddings")
+# seconds between incremental catalog refreshes, 0 disables them
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "600"))
+# read-book vectors kept in the LRU query cache
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+# threads running recommendation scoring and jobs allowed to wait for one,
+# /generate/ answers 503 once both are exhausted
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", "2"))
+SCORING_QUEUE_SIZE = int(os.getenv("SCORING_QUEUE_SIZE", "16"))
+# concurrent /generate/ requests are coalesced for up to BATCH_MAX_WAIT_MS into batches
+# of at most BATCH_MAX_SIZE, a size of 1 turns batching off
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+# outgoing HTTP (validation dispatch, backend callbacks): total connections,
+# idle keep-alive connections and concurrent requests per destination host
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", "20"))
+# backend callback delivery: background workers, attempts before a callback is dropped,
+# optional JSONL journal for undelivered callbacks (every worker process writes its own
+# CALLBACK_JOURNAL, CALLBACK_JOURNAL.1, ...) and optional batch endpoint of the backend
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", "4"))
+CALLBACK_MAX_ATTEMPTS = int(os.getenv("CALLBACK_MAX_ATTEMPTS", "8"))
+CALLBACK_JOURNAL = os.getenv("CALLBACK_JOURNAL") or None
+CALLBACK_BATCH_URL = os.getenv("CALLBACK_BATCH_URL") or None
+CALLBACK_BATCH_SIZE = int(os.getenv("CALLBACK_BATCH_SIZE", "20"))
+# seconds shutdown waits for queued callbacks and their retries before giving up
+CALLBACK_DRAIN_TIMEOUT = float(os.getenv("CALLBACK_DRAIN_TIMEOUT", "10"))
+# the callback journal is rewritten with just the undelivered callbacks once it holds this many records
+CALLBACK_JOURNAL_COMPACT = int(os.getenv("CALLBACK_JOURNAL_COMPACT", "1000"))
+# finished tasks are kept as compact records for TASK_FINISHED_TTL seconds, at most
+# TASK_MAX_FINISHED of them; unanswered active tasks expire after TASK_ACTIVE_TTL
+TASK_FINISHED_TTL = float(os.getenv("TASK_FINISHED_TTL", "3600"))
+TASK_MAX_FINISHED = int(os.getenv("TASK_MAX_FINISHED", "10000"))
+TASK_ACTIVE_TTL = float(os.getenv("TASK_ACTIVE_TTL", "3600"))
+# a task waits in the background up to CLIENT_WAIT_TIMEOUT seconds for a free validation
+# slot before it completes without validation, 0 does not wait; the response never waits
+CLIENT_WAIT_TIMEOUT = float(os.getenv("CLIENT_WAIT_TIMEOUT", "5"))
+# a validation slot is leased per task: if the client never posts /generate/result,
+# the slot frees itself after CLIENT_LEASE_TTL seconds
+CLIENT_LEASE_TTL = float(os.getenv("CLIENT_LEASE_TTL", "300"))
+# memory | redis; with several workers or hosts tasks must live in redis,
+# /generate/result may arrive at a different process than the one that created the task
+TASK_STORE = os.getenv("TASK_STORE", "memory")
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD") or None
+# memory | redis, by default the same as TASK_STORE: with several workers the slots of
+# validation clients must be shared as well, otherwise every worker hands out the same slot
+CLIENT_STORE = os.getenv("CLIENT_STORE", TASK_STORE)
 
-store = MemoryClientStore()
-client_manager = ClientManager(store)
-task_manager = TaskManager()
+# catalog search: exact | hnsw | ivfpq, efSearch / nprobe trade recall for latency;
+# EMBEDDING_DTYPE float16 | int8 shrinks the exact search matrix, RESCORE_CANDIDATES rows
+# per user are then rescored in float32; RETRIEVAL_BAND_CANDIDATES searches an approximate
+# index deeper for the novel band, off by default since a deep search costs as much as exact
+RETRIEVAL = RetrievalConfig(
+    backend=os.getenv("RETRIEVAL_BACKEND", "exact"),
+    candidates=int(os.getenv("RETRIEVAL_CANDIDATES", "200")),
+    band_candidates=int(os.getenv("RETRIEVAL_BAND_CANDIDATES", "0")),
+    hnsw_m=int(os.getenv("FAISS_HNSW_M", "32")),
+    ef_construction=int(os.getenv("FAISS_EF_CONSTRUCTION", "200")),
+    ef_search=int(os.getenv("FAISS_EF_SEARCH", "64")),
+    nlist=int(os.getenv("FAISS_NLIST", "0")),
+    nprobe=int(os.getenv("FAISS_NPROBE", "16")),
+    pq_m=int(os.getenv("FAISS_PQ_M", "0")),
+    dtype=os.getenv("EMBEDDING_DTYPE", "float32"),
+    rescore=int(os.getenv("RESCORE_CANDIDATES", "200")),
+)
+
+http_pool = HttpClientPool(HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_PER_HOST)
+callback_queue = CallbackQueue(
+    http_pool, workers=CALLBACK_WORKERS, max_attempts=CALLBACK_MAX_ATTEMPTS,
+    journal_path=CALLBACK_JOURNAL, batch_url=CALLBACK_BATCH_URL, batch_size=CALLBACK_BATCH_SIZE,
+    drain_timeout=CALLBACK_DRAIN_TIMEOUT, journal_compact=CALLBACK_JOURNAL_COMPACT
+)
+if CLIENT_STORE == "redis":
+    store = RedisClientStore(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD)
+    client_manager = RedisClientManager(store, CLIENT_LEASE_TTL)
+else:
+    store = MemoryClientStore()
+    client_manager = ClientManager(store, CLIENT_LEASE_TTL)
+if TASK_STORE == "redis":
+    task_store = RedisTaskStore(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD,
+                                TASK_FINISHED_TTL, TASK_MAX_FINISHED, TASK_ACTIVE_TTL)
+else:
+    task_store = MemoryTaskStore(TASK_FINISHED_TTL, TASK_MAX_FINISHED, TASK_ACTIVE_TTL)
+task_manager = TaskManager(task_store)
+scoring_pool = ScoringPool(SCORING_WORKERS, SCORING_QUEUE_SIZE)
 book_repository = DBBookRepository()
-embedding_service = EmbeddingService(book_repository)
+embedding_service = EmbeddingService(
+    book_repository, cache_dir=EMBEDDINGS_CACHE_DIR, retrieval=RETRIEVAL, query_cache_size=QUERY_CACHE_SIZE
+)
+recommendation_batcher = RecommendationBatcher(embedding_service, scoring_pool, BATCH_MAX_WAIT_MS, BATCH_MAX_SIZE)
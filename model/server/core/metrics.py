@@ -0,0 +1,52 @@
+from model.server.utils.metrics import REGISTRY
+
+from .config import (client_manager, task_manager, embedding_service, scoring_pool, recommendation_batcher,
+                     callback_queue)
+
+# per-route latency of incoming requests, observed by the middleware in app.py
+REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "Latency of incoming requests", ("method", "route", "status")
+)
+# /generate/ dispatch to /generate/result, per validation client address (client ids change
+# on every registration, an address stays)
+VALIDATION_RTT_SECONDS = REGISTRY.histogram(
+    "validation_roundtrip_seconds", "Time from validation dispatch to the client's result", ("address",)
+)
+
+# everything below is read at scrape time, the hot path does not touch it
+REGISTRY.gauge("scoring_pool_pending", "Scoring jobs running or waiting for a worker",
+               lambda: scoring_pool.pending)
+REGISTRY.gauge("recommendation_batch_pending", "Requests waiting for the current batch",
+               lambda: recommendation_batcher.pending)
+REGISTRY.gauge("tasks", "Generation tasks by status", task_manager.counts, ("status",))
+
+REGISTRY.gauge("callback_queue_depth", "Callbacks waiting for delivery", lambda: callback_queue.depth)
+REGISTRY.counter("callbacks_delivered_total", "Callbacks delivered to the backend", lambda: callback_queue.delivered)
+REGISTRY.counter("callbacks_retried_total", "Callback delivery retries", lambda: callback_queue.retried)
+REGISTRY.counter("callbacks_failed_total", "Callbacks dropped after the last attempt", lambda: callback_queue.failed)
+
+
+def _clients():
+    clients = client_manager.get_all_clients()
+    return {
+        "registered": len(clients),
+        "busy": sum(1 for c in clients if c.busy),
+        "capacity": sum(c.capacity for c in clients),
+        "in_flight": sum(c.in_flight for c in clients),
+        "waiting": client_manager.waiting,
+    }
+
+
+REGISTRY.gauge("validation_clients", "Validation clients and their slots", _clients, ("kind",))
+
+
+def _catalog(key):
+    return lambda: embedding_service.catalog_stats()[key]
+
+
+REGISTRY.gauge("catalog_rows", "Books in the loaded catalog snapshot", _catalog("rows"))
+REGISTRY.gauge("catalog_refresh_age_seconds", "Seconds since the catalog was last loaded or refreshed",
+               _catalog("refresh_age"))
+REGISTRY.counter("query_cache_lookups_total", "Read-book vector lookups by outcome",
+                 lambda: {k: v for k, v in embedding_service.query_cache_stats().items()
+                          if k in ("hits", "catalog_hits", "misses")}, ("result",))
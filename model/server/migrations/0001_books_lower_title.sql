@@ -0,0 +1,9 @@
+-- Индексы под запросы модельного сервера (services/book_repository.py).
+-- CONCURRENTLY не блокирует запись в books; выполнять вне транзакции:
+--   psql "$DATABASE_URL" -f model/server/migrations/0001_books_lower_title.sql
+
+-- поиск книг пользователя по названию: JOIN books b ON lower(b.title) = lower(v.title)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS books_lower_title_idx ON books (lower(title));
+
+-- жанры книги: LEFT JOIN book_genres g ON g.book_id = b.id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS book_genres_book_id_idx ON book_genres (book_id);
@@ -1,4 +1,4 @@
 from .book import Book
 from .client import Client, ClientPingRequest, ClientRegisterRequest
 from .generate import GenerationRequest, GenerationTaskResponse, GenerationResultRequest, BackendGenerationRequest
-from .task import Task
+from .task import Task, TaskRecord
@@ -9,12 +9,16 @@ class Client(BaseModel):
     address: str
     model_name: Optional[str] = None
     ping: Optional[float] = None
+    # сколько задач валидации клиент берёт одновременно и сколько сейчас у него в работе
+    capacity: int = 1
+    in_flight: int = 0
     busy: bool = False
     last_update: str = Field(default_factory=datetime.utcnow)
 
 class ClientRegisterRequest(BaseModel):
     address: str
     model_name: Optional[str] = None
+    capacity: int = Field(1, ge=1)
 
 class ClientPingRequest(BaseModel):
     client_id: str
@@ -1,7 +1,7 @@
 from datetime import datetime, timezone
 from typing import Any, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from model.server.models import GenerationRequest
 
@@ -9,7 +9,7 @@ from model.server.models import GenerationRequest
 class Task(BaseModel):
     task_id: str
     status: str = "queued"
-    created_at: str = datetime.now(timezone.utc).isoformat()
+    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     completed_at: Optional[str] = None
     request: Optional[GenerationRequest] = None
     result: Optional[Any] = None
@@ -18,4 +18,37 @@ class Task(BaseModel):
     backend_callback: Optional[str] = None
     backend_request_id: Optional[str] = None
     backend_user_id: Optional[str] = None
+    # последняя отправка на валидацию: unix-время и адрес клиента (для validation_roundtrip_seconds,
+    # /generate/result может прийти в другой воркер)
+    dispatched_at: Optional[float] = None
+    dispatched_to: Optional[str] = None
 
+
+class TaskRecord(BaseModel):
+    """Компактная запись о задаче: без запроса, книг пользователя и результата."""
+    task_id: str
+    status: str
+    created_at: str
+    completed_at: Optional[str] = None
+    backend_request_id: Optional[str] = None
+    backend_user_id: Optional[str] = None
+    result_size: int = 0
+
+    @classmethod
+    def of(cls, task: Task) -> "TaskRecord":
+        return cls(
+            task_id=task.task_id,
+            status=task.status,
+            created_at=task.created_at,
+            completed_at=task.completed_at,
+            backend_request_id=task.backend_request_id,
+            backend_user_id=str(task.backend_user_id) if task.backend_user_id is not None else None,
+            result_size=cls.size_of(task.result),
+        )
+
+    @staticmethod
+    def size_of(result: Any) -> int:
+        # результат — список списков рекомендаций, считаем книги
+        if not isinstance(result, list):
+            return 0
+        return sum(len(r) if isinstance(r, list) else 1 for r in result)
@@ -15,7 +15,7 @@ async def clients() -> JSONResponse:
 
 @client_router.post('/register', status_code=201)
 async def clients_register(req: ClientRegisterRequest, api_key: str = Depends(verify_api_key)) -> JSONResponse:
-    client = client_manager.register(req.address, req.model_name)
+    client = client_manager.register(req.address, req.model_name, req.capacity)
     return JSONResponse(status_code=201, content=client.model_dump())
 
 
@@ -29,7 +29,7 @@ async def client_delete(client_id: str = Query(...)):
 
 @client_router.get('/best', status_code=200)
 async def clients_best() -> JSONResponse:
-    client = client_manager.best_client()
+    client = client_manager.get_best_client()
 
     if client is None:
         return JSONResponse(status_code=503, content={"detail": "No available clients"})
@@ -1,11 +1,15 @@
+import asyncio
 import os
-from typing import Optional, List
+import time
+from typing import Optional, List, Set
 
-import httpx
-from fastapi import APIRouter, Depends, Header
+from fastapi import APIRouter, Depends, Query
 from model.server.core import verify_api_key, task_manager, client_manager
 from model.server.models import BackendGenerationRequest, Book
-from model.server.core import embedding_service
+from model.server.core import recommendation_batcher, http_pool, callback_queue
+from model.server.core import CLIENT_WAIT_TIMEOUT, VALIDATION_RTT_SECONDS
+from model.server.services.book_repository import book_key
+from model.server.services.scoring_pool import PoolSaturated
 from pydantic import BaseModel
 from starlette.responses import JSONResponse
 import logging
@@ -17,7 +21,6 @@ generate_router = APIRouter(prefix="/generate", tags=["Generation"])
 
 log = logging.getLogger("generate")
 
-
 class ValidationResult(BaseModel):
     task_id: str
     ok: bool
@@ -25,41 +28,35 @@ class ValidationResult(BaseModel):
 
 
 async def _send_validation(client, task_id: str, candidates: List[Book]):
+    # время отправки хранится в задаче: ответ клиента может прийти в другой воркер;
+    # записывается до отправки, чтобы быстрый ответ его уже застал
+    task_manager.dispatched(task_id, client.address)
+
     payload = {
         "task_id": task_id,
         "candidates": [b.model_dump() for b in candidates]
     }
 
-    async with httpx.AsyncClient() as c:
-        await c.post(
-            f"{client.address.rstrip('/')}/validate/",
-            json=payload,
-            headers={"x-api-key": os.getenv("CLIENT_SECRET")},
-            timeout=20.0
-        )
+    await http_pool.post(
+        f"{client.address.rstrip('/')}/validate/",
+        json=payload,
+        headers={"x-api-key": os.getenv("CLIENT_SECRET")},
+        timeout=20.0
+    )
 
 
-async def _callback(callback_url: str, user_id: str, recommendations: List[List[dict]]):
+def _callback(callback_url: str, user_id: str, recommendations: List[List[dict]]):
+    # delivered in the background with retries, the handler does not wait on the backend
     payload = {
         "userId": user_id,
         "recommendations": recommendations
     }
 
-    async with httpx.AsyncClient() as c:
-        await c.post(callback_url, json=payload, timeout=15.0)
-
-
-@generate_router.post("/", status_code=202)
-async def generate(req: BackendGenerationRequest):
-    task = task_manager.create(req)
-    task.backend_callback = req.callbackUrl
-    task.backend_user_id = req.userId
-    task.backend_request_id = req.requestId
+    callback_queue.enqueue(callback_url, payload)
 
-    recs = embedding_service.get_recommendations(
-        req.books, similar_top=8, novel_top=8, genre_top=8
-    )
 
+def _combine(recs: dict) -> List[List[dict]]:
+    # три списка рекомендаций без повторов одной и той же книги
     combined = []
     seen = set()
 
@@ -67,7 +64,7 @@ async def generate(req: BackendGenerationRequest):
         ls = []
 
         for b in lst:
-            key = (b.get("title", "").lower(), b.get("author", "").lower())
+            key = book_key(b.get("title"), b.get("author"))
             if key not in seen:
                 seen.add(key)
                 ls.append(b)
@@ -77,18 +74,63 @@ async def generate(req: BackendGenerationRequest):
     add_list(recs.get("similar", []))
     add_list(recs.get("novel", []))
     add_list(recs.get("genre_similar", []))
+    return combined
+
+
+def _books(result: List[List[dict]]) -> List[Book]:
+    return [Book(**b) for lst in result for b in lst]
+
 
-    task.result = combined
+# фоновые ожидания слота; ссылки держим, чтобы задачи не собрал сборщик мусора
+_validations: Set[asyncio.Task] = set()
 
-    client = client_manager.get_best_client()
 
-    if not client:
-        try:
-            await _callback(req.callbackUrl, req.userId, combined)
-        except Exception as e:
-            print("Callback error:", e)
+def _in_background(coro):
+    task = asyncio.create_task(coro)
+    _validations.add(task)
+    task.add_done_callback(_validations.discard)
+
+
+async def _validate(task_id: str, candidates: List[Book], result: List[List[dict]], callback_url: str, user_id):
+    # слот клиента занимается под id задачи, двум задачам один слот не достанется; если все
+    # слоты заняты, ждём освобождения здесь, в фоне, а не в обработчике запроса
+    client = None
+    try:
+        client = await client_manager.acquire_wait(CLIENT_WAIT_TIMEOUT, lease_id=task_id)
+        if client is not None:
+            await _send_validation(client, task_id, candidates)
+            return
+    except Exception:
+        log.warning("Validation dispatch for task %s failed", task_id, exc_info=True)
+        if client is not None:
+            client_manager.release(task_id)
+
+    if task_manager.complete(task_id, result):
+        _callback(callback_url, user_id, result)
+
+
+def _overloaded() -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": "Recommendation queue is full"}, headers={"Retry-After": "1"})
+
+
+@generate_router.post("/", status_code=202)
+async def generate(req: BackendGenerationRequest):
+    # scoring blocks (model, numpy, db), so it runs in the bounded pool,
+    # batched together with concurrent requests
+    try:
+        recs = await recommendation_batcher.recommend(req.books, similar_top=8, novel_top=8, genre_top=8)
+    except PoolSaturated:
+        return _overloaded()
 
-        task_manager.complete(task.task_id, task.result)
+    combined = _combine(recs)
+
+    # задача сохраняется одной записью, уже с результатом
+    task = task_manager.create(req, result=combined)
+
+    # без живых клиентов валидировать некому
+    if not client_manager.has_live_clients():
+        if task_manager.complete(task.task_id, combined):
+            _callback(req.callbackUrl, req.userId, combined)
         return JSONResponse(
             status_code=200,
             content={
@@ -97,86 +139,74 @@ async def generate(req: BackendGenerationRequest):
             }
         )
 
-    client.busy = True
-    client_manager.store.register(client.client_id, client)
-
-    try:
-        books_for_validation = [Book(**b) for b in combined]
-        await _send_validation(client, task.task_id, books_for_validation)
-
-        task.status = "processing"
-        return {"status": "processing", "task": task.task_id}
-
-    except Exception:
-        client.busy = False
-        client_manager.store.register(client.client_id, client)
+    # ожидание слота и отправка клиенту идут в фоне, ответ сразу
+    _in_background(_validate(task.task_id, _books(combined), combined, req.callbackUrl, req.userId))
+    return {"status": "processing", "task": task.task_id}
 
-        try:
-            await _callback(req.callbackUrl, req.userId, combined)
-        except Exception as e:
-            print("Callback error:", e)
 
-        task_manager.complete(task.task_id, task.result)
-        return {"status": "done_without_validation", "task": task.task_id}
+@generate_router.get("/tasks", status_code=200)
+async def tasks(
+        status: Optional[str] = Query(None),
+        request_id: Optional[str] = Query(None),
+        api_key: str = Depends(verify_api_key)
+):
+    # компактные записи задач, без книг и результатов
+    if request_id:
+        record = task_manager.find_by_request(request_id)
+        if not record:
+            return JSONResponse(status_code=404, content={"error": "not found"})
+        return record.model_dump()
+    if status:
+        return [r.model_dump() for r in task_manager.by_status(status)]
+    return task_manager.all()
 
 
 @generate_router.post("/result", status_code=200)
 async def validation(
         req: ValidationResult,
-        api_key: str = Depends(verify_api_key),
-        client_id: Optional[str] = Header(None)
+        api_key: str = Depends(verify_api_key)
 ):
     task = task_manager.get(req.task_id)
     if not task:
         return {"error": "not found"}
 
-    if client_id:
-        client = client_manager.store.get(client_id)
-        if client:
-            client.busy = False
-            client_manager.store.register(client_id, client)
+    if task.dispatched_at is not None:
+        VALIDATION_RTT_SECONDS.observe(task.dispatched_to or "", time.time() - task.dispatched_at)
 
-    if req.ok:
-        try:
-            await _callback(task.backend_callback, task.backend_user_id, task.result)
-        except Exception as e:
-            print("Callback error:", e)
+    # слот занят под id задачи
+    client_manager.release(task.task_id)
 
-        task_manager.complete(task.task_id, task.result)
+    if req.ok:
+        # завершить задачу может только один запрос, callback уходит ровно один раз
+        if task_manager.complete(task.task_id, task.result):
+            _callback(task.backend_callback, task.backend_user_id, task.result)
         return {"status": "ok"}
 
     invalid_books = [Book(**b) if isinstance(b, dict) else b for b in (req.invalid or [])]
     original = task.request.books
 
-    new_candidates = embedding_service.get_similar(original, exclude=invalid_books, count=20)
-    task.result = [c.model_dump() for c in new_candidates]
-
-    next_client = client_manager.get_best_client()
-
-    if not next_client:
-        try:
-            await _callback(task.backend_callback, task.backend_user_id, task.result)
-        except Exception as e:
-            print("Callback error:", e)
-
-        task_manager.complete(task.task_id, task.result)
-        return {"status": "done_without_validation"}
-
-    next_client.busy = True
-    client_manager.store.register(next_client.client_id, next_client)
-
+    # те же рекомендации заново, без книг, которые клиент отклонил
     try:
-        await _send_validation(next_client, task.task_id, new_candidates)
-        return {"status": "retrying"}
-
-    except Exception:
-        next_client.busy = False
-        client_manager.store.register(next_client.client_id, next_client)
-
-        try:
-            await _callback(task.backend_callback, task.backend_user_id, task.result)
-        except Exception as e:
-            print("Callback error:", e)
-
-        task_manager.complete(task.task_id, task.result)
+        recs = await recommendation_batcher.recommend(
+            original, similar_top=8, novel_top=8, genre_top=8, exclude=invalid_books
+        )
+    except PoolSaturated:
+        # задача уже принята, слот отпущен: 503 клиент не повторит, и backend не дождётся
+        # ответа — отдаём прежний результат без валидации
+        log.warning("Scoring pool saturated, task %s completes without revalidation", task.task_id)
+        if task_manager.complete(task.task_id, task.result):
+            _callback(task.backend_callback, task.backend_user_id, task.result)
         return {"status": "done_without_validation"}
+    task.result = _combine(recs)
+    new_candidates = _books(task.result)
+    # задача могла прийти из redis — новый результат сохраняем обратно
+    if not task_manager.set_status(task.task_id, "processing", result=task.result):
+        return {"status": "already_done"}
+
+    if not client_manager.has_live_clients():
+        if task_manager.complete(task.task_id, task.result):
+            _callback(task.backend_callback, task.backend_user_id, task.result)
+        return {"status": "done_without_validation"}
+
+    _in_background(_validate(task.task_id, new_candidates, task.result, task.backend_callback, task.backend_user_id))
+    return {"status": "retrying"}
@@ -1,9 +1,10 @@
 from datetime import datetime
 
 from fastapi import APIRouter
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 
-from model.server.core import client_manager
+from model.server.core import client_manager, embedding_service, http_pool, callback_queue, task_manager
+from model.server.utils.metrics import REGISTRY
 
 health_router = APIRouter(prefix="/health", tags=["Server status"])
 start_time = datetime.now()
@@ -19,4 +20,18 @@ async def health() -> JSONResponse:
 async def metrics() -> JSONResponse:
     clients = client_manager.get_all_clients()
     avg_ping = sum(client.ping or 0 for client in clients) / max(len(clients), 1)
-    return JSONResponse(status_code=200, content={"active_clients": len(clients), "avg_ping": avg_ping, "busy_clients": len([c for c in clients if c.busy])})
+    return JSONResponse(status_code=200, content={"active_clients": len(clients), "avg_ping": avg_ping, "busy_clients": len([c for c in clients if c.busy]),
+                                                  "validation_slots": {"capacity": sum(c.capacity for c in clients),
+                                                                       "in_flight": sum(c.in_flight for c in clients),
+                                                                       "waiting": client_manager.waiting},
+                                                  "query_cache": embedding_service.query_cache_stats(),
+                                                  "http_latency": http_pool.latency.snapshot(),
+                                                  "callbacks": callback_queue.stats(),
+                                                  "catalog": embedding_service.catalog_stats(),
+                                                  "tasks": task_manager.counts()})
+
+
+@health_router.get("/prometheus")
+async def prometheus() -> PlainTextResponse:
+    # Prometheus text exposition format
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -1,6 +1,8 @@
-from .client_manager import ClientManager
+from .client_manager import ClientManager, RedisClientManager
 from .validator import validate_answer, validate_book
 from .client_store import MemoryClientStore, RedisClientStore, BaseClientStore
+from .task_store import MemoryTaskStore, RedisTaskStore, BaseTaskStore
 from .task_manager import TaskManager
 
-__all__ = ["ClientManager", "RedisClientStore", "BaseClientStore", "TaskManager", "MemoryClientStore"]
+__all__ = ["ClientManager", "RedisClientManager", "RedisClientStore", "BaseClientStore", "TaskManager", "MemoryClientStore",
+           "MemoryTaskStore", "RedisTaskStore", "BaseTaskStore"]
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from model.server.models import Book
+from .scoring_pool import ScoringPool
+
+
+class RecommendationBatcher:
+    """
+    Coalesces concurrent recommendation requests: read books arriving within max_wait_ms
+    (or until max_batch requests are collected) are encoded in one encoder pass and scored
+    in one matmul by EmbeddingService.get_recommendations_batch, running in the scoring pool.
+    The results are fanned back out to the waiting callers.
+    """
+
+    def __init__(self, embedding_service, pool: ScoringPool, max_wait_ms: float = 5.0, max_batch: int = 16):
+        self.embedding_service = embedding_service
+        self.pool = pool
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self._pending: List[Tuple[List[Book], Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # running batches; the loop keeps only weak references to tasks, a collected
+        # batch would leave its callers waiting forever
+        self._runs: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def recommend(self, user_books: List[Book], **params: Any) -> Dict[str, List[dict]]:
+        if self.max_batch <= 1:
+            return await self.pool.run(self.embedding_service.get_recommendations, user_books, **params)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_books, params, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._runs.add(task)
+            task.add_done_callback(self._runs.discard)
+
+    async def _run(self, batch: List[Tuple[List[Book], Dict[str, Any], asyncio.Future]]):
+        try:
+            results = await self.pool.run(
+                self.embedding_service.get_recommendations_batch, [(books, params) for books, params, _ in batch]
+            )
+        except Exception as e:
+            # PoolSaturated included: every caller of the batch sees the same error
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,18 +1,47 @@
 # services/book_repository.py
-from typing import List, Dict, Any, Iterable
+from contextlib import contextmanager
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
 import psycopg2
+import psycopg2.pool
 import os
 import logging
+import uuid
+import weakref
 
 from model.server.models import Book
+from model.server.services.catalog import BookColumns, BOOK_FIELDS
 
 log = logging.getLogger(__name__)
 
 
+def book_key(title: str | None, author: str | None) -> str:
+    """Нормализованный ключ книги: 'title|||author' в нижнем регистре."""
+    return (title or "").strip().lower() + "|||" + (author or "").strip().lower()
+
+
 class BookRepository:
     def get_all_books(self) -> List[Dict[str, Any]]:
         raise NotImplementedError
 
+    def iter_book_rows(self, batch_size: int = 2000) -> Iterator[List[Tuple[Any, ...]]]:
+        """Каталог пачками кортежей в порядке BOOK_FIELDS."""
+        books = self.get_all_books()
+        for start in range(0, len(books), batch_size):
+            yield [tuple(b.get(f) for f in BOOK_FIELDS) for b in books[start:start + batch_size]]
+
+    def load_catalog(self, batch_size: int = 2000) -> BookColumns:
+        """Весь каталог в колоночном виде, собранный из потока пачек."""
+        cols = BookColumns()
+        for batch in self.iter_book_rows(batch_size):
+            cols.append_rows(batch)
+        return cols
+
+    def get_book_ids(self) -> List[Any]:
+        raise NotImplementedError
+
+    def get_books_by_ids(self, ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
     def get_genres_for_titles(self, titles_and_authors: Iterable[Dict[str, str]]) -> Dict[str, List[str]]:
         raise NotImplementedError
 
@@ -23,55 +52,138 @@ class DBBookRepository(BookRepository):
     Ожидается, что в БД есть таблицы:
       - books(id, title, author, year, description)
       - book_genres(book_id, genre)   <-- имя таблицы должно быть book_genres
+    Соединения берутся из пула (запросы идут из потоков scoring pool и обновления каталога),
+    разорванное соединение выбрасывается из пула, и запрос повторяется на новом.
     """
 
-    def __init__(self):
+    def __init__(self, min_connections: int = None, max_connections: int = None):
+        min_connections = min_connections or int(os.getenv("DATABASE_POOL_MIN", "1"))
+        max_connections = max_connections or int(os.getenv("DATABASE_POOL_MAX", "8"))
         try:
-            self.conn = psycopg2.connect(
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                min_connections, max_connections,
                 host=os.getenv("DATABASE_HOST"),
                 port=os.getenv("DATABASE_PORT"),
                 user=os.getenv("DATABASE_USER"),
                 password=os.getenv("DATABASE_PASSWORD"),
                 database=os.getenv("DATABASE_NAME"),
             )
-            self.conn.autocommit = True
         except Exception as e:
             log.exception("DB connection failed: %s", e)
             raise
+        # соединения, на которых уже выполнен PREPARE
+        self._prepared = weakref.WeakSet()
 
-    def get_all_books(self) -> List[Dict[str, Any]]:
-        cur = self.conn.cursor()
+    @contextmanager
+    def _connection(self):
+        conn = self.pool.getconn()
+        broken = False
         try:
-            cur.execute("""
-                SELECT b.id, b.title, b.author, b.year, b.description, b.cover, b.pages,
-                       COALESCE(array_agg(g.genre) FILTER (WHERE g.genre IS NOT NULL), '{}') AS genres
-                FROM books b
-                LEFT JOIN book_genres g ON g.book_id = b.id
-                GROUP BY b.id, b.title, b.author, b.year, b.description, b.cover, b.pages;
-            """)
-            rows = cur.fetchall()
+            if conn.closed:
+                # соединение умерло, пока лежало в пуле
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            conn.autocommit = True
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
         finally:
-            cur.close()
+            self.pool.putconn(conn, close=broken or bool(conn.closed))
 
-        books = []
-        for r in rows:
-            books.append({
-                "id": r[0],
-                "title": r[1],
-                "author": r[2],
-                "year": r[3],
-                "description": r[4],
-                "cover": r[5],
-                "pages": r[6],
-                "genres": list(dict.fromkeys(r[7])) if r[7] else []
-            })
-        return books
+    def _query(self, sql: str, params: Any = None, prepare: str = None) -> List[Tuple[Any, ...]]:
+        # один повтор на свежем соединении, если старое оборвалось
+        for attempt in (1, 2):
+            try:
+                with self._connection() as conn, conn.cursor() as cur:
+                    if prepare and conn not in self._prepared:
+                        cur.execute(prepare)
+                        self._prepared.add(conn)
+                    cur.execute(sql, params)
+                    return cur.fetchall()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt == 2:
+                    raise
+                log.warning("DB connection lost, retrying on a new one")
+
+    # ORDER BY: каталог приходит в одном порядке при каждом запуске и в каждом воркере,
+    # иначе строки не совпадают по порядку с сохранёнными эмбеддингами (EmbeddingStore)
+    _BOOKS_SQL = """
+        SELECT b.id, b.title, b.author, b.year, b.description, b.cover, b.pages,
+               COALESCE(array_agg(g.genre) FILTER (WHERE g.genre IS NOT NULL), '{{}}') AS genres
+        FROM books b
+        LEFT JOIN book_genres g ON g.book_id = b.id
+        {where}
+        GROUP BY b.id, b.title, b.author, b.year, b.description, b.cover, b.pages
+        ORDER BY b.id;
+    """
+
+    _GENRES_SQL = """
+        PREPARE genres_by_titles(text[], text[]) AS
+        SELECT b.title, b.author, COALESCE(array_agg(g.genre) FILTER (WHERE g.genre IS NOT NULL), '{}') AS genres
+        FROM unnest($1, $2) AS v(title, author)
+        JOIN books b ON lower(b.title) = lower(v.title) AND coalesce(b.author,'') = coalesce(v.author,'')
+        LEFT JOIN book_genres g ON g.book_id = b.id
+        GROUP BY b.title, b.author;
+    """
+
+    @staticmethod
+    def _row_to_book(r) -> Dict[str, Any]:
+        return {
+            "id": r[0],
+            "title": r[1],
+            "author": r[2],
+            "year": r[3],
+            "description": r[4],
+            "cover": r[5],
+            "pages": r[6],
+            "genres": list(dict.fromkeys(r[7])) if r[7] else []
+        }
+
+    def get_all_books(self) -> List[Dict[str, Any]]:
+        return [self._row_to_book(r) for batch in self.iter_book_rows() for r in batch]
+
+    def iter_book_rows(self, batch_size: int = 2000) -> Iterator[List[Tuple[Any, ...]]]:
+        # именованный (серверный) курсор: строки приходят пачками по batch_size,
+        # весь результат никогда не лежит в памяти целиком
+        with self._connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name="catalog_stream") as cur:
+                    cur.itersize = batch_size
+                    cur.execute(self._BOOKS_SQL.format(where=""))
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+            finally:
+                conn.rollback()
+
+    def get_book_ids(self) -> List[Any]:
+        return [r[0] for r in self._query("SELECT id FROM books;")]
+
+    def get_books_by_ids(self, ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Книги с указанными id — используется для инкрементального обновления каталога."""
+        # books.id — uuid: сравниваем в родном типе, чтобы работал индекс первичного ключа
+        valid = []
+        for i in ids:
+            try:
+                valid.append(str(uuid.UUID(str(i))))
+            except ValueError:
+                log.warning("Skipping non-uuid book id %r", i)
+        if not valid:
+            return []
+
+        rows = self._query(self._BOOKS_SQL.format(where="WHERE b.id = ANY(%s::uuid[])"), (valid,))
+        return [self._row_to_book(r) for r in rows]
 
     def get_genres_for_titles(self, titles_and_authors: Iterable[Dict[str, str]]) -> Dict[str, List[str]]:
         """
         Принимает итерацию {'title':..., 'author':...} и возвращает map key -> [genres],
         где key = 'title|||author' lowercased.
-        Реализовано безопасно через временную таблицу VALUES(...) + JOIN.
+        Один подготовленный запрос на соединение; lower(b.title) обслуживается
+        функциональным индексом из migrations/0001_books_lower_title.sql.
         """
         pairs = []
         for t in titles_and_authors:
@@ -84,25 +196,10 @@ class DBBookRepository(BookRepository):
         if not pairs:
             return {}
 
-        cur = self.conn.cursor()
-        try:
-            # формируем безопасно VALUES через mogrify
-            values_sql = ",".join(cur.mogrify("(%s,%s)", p).decode("utf-8") for p in pairs)
-            query = f"""
-                WITH v(title, author) AS (VALUES {values_sql})
-                SELECT b.title, b.author, COALESCE(array_agg(g.genre) FILTER (WHERE g.genre IS NOT NULL), '{{}}') AS genres
-                FROM v
-                JOIN books b ON lower(b.title) = lower(v.title) AND coalesce(b.author,'') = coalesce(v.author,'')
-                LEFT JOIN book_genres g ON g.book_id = b.id
-                GROUP BY b.title, b.author;
-            """
-            cur.execute(query)
-            rows = cur.fetchall()
-        finally:
-            cur.close()
+        titles, authors = [p[0] for p in pairs], [p[1] for p in pairs]
+        rows = self._query("EXECUTE genres_by_titles(%s, %s);", (titles, authors), prepare=self._GENRES_SQL)
 
         res = {}
         for r in rows:
-            key = (r[0] or "").strip().lower() + "|||" + (r[1] or "").strip().lower()
-            res[key] = list(dict.fromkeys(r[2])) if r[2] else []
+            res[book_key(r[0], r[1])] = list(dict.fromkeys(r[2])) if r[2] else []
         return res
@@ -0,0 +1,338 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+from model.server.utils.metrics import REGISTRY
+from .http_client import HttpClientPool
+
+try:
+    import fcntl
+    _HAS_FCNTL = True
+except ImportError:
+    _HAS_FCNTL = False
+
+log = logging.getLogger(__name__)
+
+# 4xx answers that are still worth retrying
+_RETRYABLE_STATUS = {408, 425, 429}
+
+
+class CallbackQueue:
+    """
+    Outbound delivery of recommendation callbacks to the backend.
+    Handlers enqueue and return at once; worker tasks POST in the background, retrying
+    failures with exponential backoff and full jitter. With a journal path every job is
+    appended to a JSONL journal and marked done on delivery, so undelivered callbacks
+    survive a restart. Journal records are buffered and written by one background task in
+    a thread, off the event loop; once the journal holds journal_compact records and at
+    most half of them are undelivered jobs, it is rewritten with just those jobs.
+    Each worker process writes a journal of its own: journal_path, journal_path.1, ... whichever
+    it holds an fcntl lock on first. On start a worker also takes over the journals no live
+    worker holds (left by a worker that is gone), so every undelivered callback is replayed
+    by exactly one worker and no compaction drops another worker's jobs.
+    If the backend exposes a batch endpoint (batch_url), up to batch_size queued callbacks
+    are sent in one POST.
+    stop() first drains the queue, pending retries included, for up to drain_timeout
+    seconds and logs how many callbacks were left undelivered.
+    """
+
+    def __init__(self, http: HttpClientPool, workers: int = 4, max_attempts: int = 8,
+                 base_delay: float = 0.5, max_delay: float = 60.0, timeout: float = 15.0,
+                 journal_path: Optional[str] = None, batch_url: Optional[str] = None, batch_size: int = 20,
+                 drain_timeout: float = 10.0, journal_compact: int = 1000):
+        self.http = http
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.journal_path = journal_path
+        self.batch_url = batch_url
+        self.batch_size = max(1, batch_size)
+        self.drain_timeout = drain_timeout
+        self.journal_compact = max(1, journal_compact)
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._journal = None
+        # the journal file this process holds, and the open lock file that holds it
+        self.journal_file: Optional[str] = None
+        self._journal_lock = None
+        # undelivered jobs by id, what a compacted journal holds
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # serialized records waiting for the journal writer, records in the journal file
+        self._journal_lines: List[str] = []
+        self._journal_records = 0
+        self._journal_wake = asyncio.Event()
+        self._journal_closing = False
+        self._journal_task: Optional[asyncio.Task] = None
+        # job id -> (timer, job) of retries waiting for their backoff
+        self._delayed: Dict[str, Tuple[asyncio.TimerHandle, Dict[str, Any]]] = {}
+        # jobs taken by workers and not yet delivered or rescheduled
+        self._in_flight = 0
+        self._stopping = False
+
+        # enqueue -> delivered, seconds
+        self.latency = REGISTRY.histogram(
+            "callback_delivery_seconds", "Time from enqueue to delivery of backend callbacks", ("kind",)
+        )
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def start(self):
+        if self.journal_path:
+            for job in await asyncio.to_thread(self._open_journal):
+                self._pending[job["id"]] = job
+                self._queue.put_nowait(job)
+            self._journal_records = len(self._pending)
+            self._journal = await asyncio.to_thread(open, self.journal_file, "a", encoding="utf-8")
+            self._journal_closing = False
+            self._journal_task = asyncio.create_task(self._journal_writer())
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        # retries waiting for their backoff get their attempt now
+        for timer, job in list(self._delayed.values()):
+            timer.cancel()
+            self._queue.put_nowait(job)
+        self._delayed.clear()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        # failed jobs come back through _delayed, so the queue alone may look empty
+        while self._tasks and (self._queue.qsize() or self._in_flight or self._delayed):
+            if loop.time() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+
+        left = self._queue.qsize() + self._in_flight + len(self._delayed)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for timer, _ in self._delayed.values():
+            timer.cancel()
+        self._delayed.clear()
+
+        if left:
+            log.error("Callback queue stopped with %d undelivered callback(s)%s", left,
+                      ", kept in the journal" if self._journal is not None else ", dropped")
+        self._stopping = False
+        if self._journal_task is not None:
+            # the writer exits once the last records are written
+            self._journal_closing = True
+            self._journal_wake.set()
+            await self._journal_task
+            self._journal_task = None
+            await asyncio.to_thread(self._journal.close)
+            self._journal = None
+            self._journal_lock.close()
+            self._journal_lock = None
+
+    def enqueue(self, url: str, payload: Dict[str, Any]) -> None:
+        job = {"id": str(uuid.uuid4()), "url": url, "payload": payload, "attempts": 0, "enqueued_at": time.time()}
+        if self._journal is not None:
+            self._pending[job["id"]] = job
+        self._write_journal({"op": "add", **job})
+        self._queue.put_nowait(job)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": self.depth, "delivered": self.delivered, "retried": self.retried,
+                "failed": self.failed, "latency": self.latency.snapshot()}
+
+    async def _worker(self):
+        while True:
+            jobs = [await self._queue.get()]
+            if self.batch_url:
+                while len(jobs) < self.batch_size and not self._queue.empty():
+                    jobs.append(self._queue.get_nowait())
+
+            self._in_flight += len(jobs)
+            try:
+                await self._post(jobs)
+            except Exception as e:
+                for job in jobs:
+                    self._retry(job, e)
+            else:
+                now = time.time()
+                for job in jobs:
+                    self.delivered += 1
+                    self.latency.observe("callback", now - job["enqueued_at"])
+                    self._done(job)
+            finally:
+                self._in_flight -= len(jobs)
+                for _ in jobs:
+                    self._queue.task_done()
+
+    async def _post(self, jobs: List[Dict[str, Any]]):
+        if self.batch_url:
+            body = [{"callbackUrl": job["url"], **job["payload"]} for job in jobs]
+            resp = await self.http.post(self.batch_url, json=body, timeout=self.timeout)
+        else:
+            resp = await self.http.post(jobs[0]["url"], json=jobs[0]["payload"], timeout=self.timeout)
+        resp.raise_for_status()
+
+    def _retry(self, job: Dict[str, Any], error: Exception):
+        job["attempts"] += 1
+        permanent = (isinstance(error, httpx.HTTPStatusError)
+                     and error.response.status_code < 500
+                     and error.response.status_code not in _RETRYABLE_STATUS)
+
+        if permanent or job["attempts"] >= self.max_attempts:
+            self.failed += 1
+            log.error("Callback to %s dropped after %d attempt(s): %s", job["url"], job["attempts"], error)
+            self._done(job)
+            return
+
+        self.retried += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (job["attempts"] - 1)))
+        if self._stopping:
+            # no backoff while draining: stop() gives up on whatever is left at its deadline
+            delay = min(delay, self.base_delay)
+        log.warning("Callback to %s failed (%s), retry %d in %.1fs", job["url"], error, job["attempts"], delay)
+        timer = asyncio.get_running_loop().call_later(delay, self._requeue, job)
+        self._delayed[job["id"]] = (timer, job)
+
+    def _requeue(self, job: Dict[str, Any]):
+        self._delayed.pop(job["id"], None)
+        self._queue.put_nowait(job)
+
+    def _done(self, job: Dict[str, Any]):
+        self._pending.pop(job["id"], None)
+        self._write_journal({"op": "done", "id": job["id"]})
+
+    @staticmethod
+    def _line(record: Dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+    def _write_journal(self, record: Dict[str, Any]):
+        # only buffered here, _journal_writer does the file I/O
+        if self._journal is None:
+            return
+        self._journal_lines.append(self._line(record))
+        self._journal_wake.set()
+
+    async def _journal_writer(self):
+        while True:
+            await self._journal_wake.wait()
+            self._journal_wake.clear()
+            if self._journal_lines:
+                lines, self._journal_lines = self._journal_lines, []
+                self._journal_records += len(lines)
+                try:
+                    if self._journal_records >= self.journal_compact and 2 * len(self._pending) <= self._journal_records:
+                        # _pending already reflects every buffered record, they are not needed
+                        lines = [self._line({"op": "add", **job}) for job in self._pending.values()]
+                        self._journal_records = len(lines)
+                        await asyncio.to_thread(self._rewrite_journal, lines)
+                    else:
+                        await asyncio.to_thread(self._append_journal, lines)
+                except Exception:
+                    # delivery goes on, only the restart guarantee is weakened
+                    log.exception("Cannot write callback journal %s", self.journal_file)
+            if self._journal_closing and not self._journal_lines:
+                return
+
+    def _append_journal(self, lines: List[str]):
+        self._journal.writelines(lines)
+        self._journal.flush()
+
+    def _rewrite_journal(self, lines: List[str]):
+        self._write_file(self.journal_file, lines)
+        self._journal.close()
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+
+    @staticmethod
+    def _write_file(path: str, lines: Iterable[str]):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.writelines(lines)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _try_lock(path: str):
+        """Open lock file of a journal, held exclusively; None if another process holds it."""
+        fh = open(path + ".lock", "w")
+        if not _HAS_FCNTL:
+            return fh
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return None
+        return fh
+
+    def _journal_files(self) -> List[str]:
+        slots = [p for p in glob.glob(glob.escape(self.journal_path) + ".*") if p.rsplit(".", 1)[1].isdigit()]
+        return [self.journal_path] + sorted(slots, key=lambda p: int(p.rsplit(".", 1)[1]))
+
+    def _open_journal(self) -> List[Dict[str, Any]]:
+        """
+        Locks a journal of this process, takes over the journals nobody holds and returns their
+        undelivered jobs; the own journal is compacted to just those, the others are removed.
+        """
+        slot = 0
+        while True:
+            path = self.journal_path if slot == 0 else f"{self.journal_path}.{slot}"
+            lock = self._try_lock(path)
+            if lock is not None:
+                break
+            slot += 1
+        self.journal_file, self._journal_lock = path, lock
+
+        pending = self._replay_journal(path)
+        adopted = []
+        if _HAS_FCNTL:
+            for other in self._journal_files():
+                if other == path:
+                    continue
+                other_lock = self._try_lock(other)
+                if other_lock is None:
+                    continue
+                jobs = self._replay_journal(other)
+                log.info("Taking over %d undelivered callback(s) from %s", len(jobs), other)
+                pending.update(jobs)
+                adopted.append((other, other_lock))
+
+        # the jobs are in the own journal before the journals they came from are removed
+        self._write_file(path, (self._line({"op": "add", **job}) for job in pending.values()))
+        for other, other_lock in adopted:
+            if os.path.exists(other):
+                os.remove(other)
+            other_lock.close()
+
+        if pending:
+            log.info("Replaying %d undelivered callback(s) from %s", len(pending), path)
+        return list(pending.values())
+
+    @staticmethod
+    def _replay_journal(path: str) -> Dict[str, Dict[str, Any]]:
+        """Undelivered jobs of a journal by id."""
+        pending: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    op = record.pop("op", None)
+                    if op == "add":
+                        pending[record["id"]] = record
+                    elif op == "done":
+                        pending.pop(record.get("id"), None)
+        return pending
@@ -0,0 +1,263 @@
+import copy
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# column order of catalog rows, as streamed by BookRepository.iter_book_rows
+BOOK_FIELDS: Tuple[str, ...] = ("id", "title", "author", "year", "description", "cover", "pages", "genres")
+
+
+class _Column:
+    def extend(self, values: Iterable[Any]): ...
+    def __len__(self) -> int: ...
+    def __getitem__(self, i: int) -> Any: ...
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self[i] for i in range(len(self)))
+
+    def __add__(self, other: "_Column") -> "_Column":
+        res = copy.deepcopy(self)
+        res.extend(other)
+        return res
+
+
+class StringColumn(_Column):
+    """Strings packed into one UTF-8 buffer with an end offset per row; None is kept in a null mask."""
+
+    def __init__(self, values: Iterable[Optional[str]] = ()):
+        self._blob = bytearray()
+        self._ends = array("q")
+        self._null = bytearray()
+        self.extend(values)
+
+    def extend(self, values: Iterable[Optional[str]]):
+        for v in values:
+            if v is None:
+                self._null.append(1)
+            else:
+                self._blob += str(v).encode("utf-8")
+                self._null.append(0)
+            self._ends.append(len(self._blob))
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        if self._null[i]:
+            return None
+        start = self._ends[i - 1] if i > 0 else 0
+        return self._blob[start:self._ends[i]].decode("utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._blob) + self._ends.itemsize * len(self._ends) + len(self._null)
+
+
+class IntColumn(_Column):
+    """Optional integers in a flat int64 array, None stored as a sentinel."""
+
+    _NULL = -(2 ** 63)
+
+    def __init__(self, values: Iterable[Optional[int]] = ()):
+        self._values = array("q")
+        self.extend(values)
+
+    def extend(self, values: Iterable[Optional[int]]):
+        self._values.extend(self._NULL if v is None else int(v) for v in values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __getitem__(self, i: int) -> Optional[int]:
+        v = self._values[i]
+        return None if v == self._NULL else v
+
+    @property
+    def nbytes(self) -> int:
+        return self._values.itemsize * len(self._values)
+
+
+class CodeColumn(_Column):
+    """Low-cardinality strings (authors): an int32 code per row into a table of distinct values."""
+
+    def __init__(self, values: Iterable[Optional[str]] = ()):
+        self._codes = array("i")
+        self.values: List[str] = []
+        self._code_of: Dict[str, int] = {}
+        self.extend(values)
+
+    def code(self, value: str) -> int:
+        c = self._code_of.get(value)
+        if c is None:
+            c = self._code_of[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+    def extend(self, values: Iterable[Optional[str]]):
+        self._codes.extend(-1 if v is None else self.code(v) for v in values)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def __getitem__(self, i: int) -> Optional[str]:
+        c = self._codes[i]
+        return None if c < 0 else self.values[c]
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes.itemsize * len(self._codes)
+
+
+class GenresColumn(CodeColumn):
+    """Genre lists: codes of all rows in one int32 array plus an end offset per row."""
+
+    def __init__(self, values: Iterable[Optional[Sequence[str]]] = ()):
+        self._ends = array("q")
+        super().__init__(values)
+
+    def extend(self, values: Iterable[Optional[Sequence[str]]]):
+        for genres in values:
+            if genres:
+                self._codes.extend(self.code(g) for g in dict.fromkeys(genres))
+            self._ends.append(len(self._codes))
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, i: int) -> Tuple[str, ...]:
+        start = self._ends[i - 1] if i > 0 else 0
+        return tuple(self.values[c] for c in self._codes[start:self._ends[i]])
+
+    @property
+    def nbytes(self) -> int:
+        return super().nbytes + self._ends.itemsize * len(self._ends)
+
+
+class BookColumns:
+    """
+    Catalog as a struct of arrays: ids, titles, descriptions and covers packed into UTF-8
+    buffers with offsets, authors and genres as int32 codes into tables of distinct values,
+    year and pages as int64 arrays. Rows are appended straight from database batches and a
+    dict is materialized only when a single book is read (books[i]), i.e. for the handful
+    of books a request returns.
+    """
+
+    def __init__(self):
+        self.ids = StringColumn()
+        self.titles = StringColumn()
+        self.authors = CodeColumn()
+        self.years = IntColumn()
+        self.descriptions = StringColumn()
+        self.covers = StringColumn()
+        self.pages = IntColumn()
+        self.genres = GenresColumn()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence[Any]]) -> "BookColumns":
+        cols = cls()
+        cols.append_rows(rows)
+        return cols
+
+    @classmethod
+    def from_dicts(cls, books: Iterable[Dict[str, Any]]) -> "BookColumns":
+        return cls.from_rows(tuple(b.get(f) for f in BOOK_FIELDS) for b in books)
+
+    def _columns(self) -> Tuple[_Column, ...]:
+        # same order as BOOK_FIELDS
+        return (self.ids, self.titles, self.authors, self.years, self.descriptions, self.covers, self.pages,
+                self.genres)
+
+    def append_rows(self, rows: Iterable[Sequence[Any]]):
+        rows = rows if isinstance(rows, list) else list(rows)
+        for j, column in enumerate(self._columns()):
+            column.extend(r[j] for r in rows)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __add__(self, other: Union["BookColumns", List[Dict[str, Any]]]) -> "BookColumns":
+        if not isinstance(other, BookColumns):
+            other = BookColumns.from_dicts(other)
+        res = BookColumns.__new__(BookColumns)
+        for name, column in vars(self).items():
+            setattr(res, name, column + getattr(other, name))
+        return res
+
+    def take(self, order: Iterable[int], batch_size: int = 2000) -> "BookColumns":
+        """New columns with the rows in the given order, rebuilt batch by batch."""
+        cols = BookColumns()
+        columns = self._columns()
+        batch: List[Tuple[Any, ...]] = []
+        for i in order:
+            batch.append(tuple(c[i] for c in columns))
+            if len(batch) == batch_size:
+                cols.append_rows(batch)
+                batch = []
+        cols.append_rows(batch)
+        return cols
+
+    @property
+    def nbytes(self) -> int:
+        return sum(c.nbytes for c in self._columns())
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {
+            "id": self.ids[i],
+            "title": self.titles[i],
+            "author": self.authors[i],
+            "year": self.years[i],
+            "description": self.descriptions[i],
+            "cover": self.covers[i],
+            "pages": self.pages[i],
+            "genres": list(self.genres[i]),
+        }
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        if isinstance(i, slice):
+            return [self.row(j) for j in range(*i.indices(len(self)))]
+        return self.row(i)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return (self.row(i) for i in range(len(self)))
+
+
+def str_hashes(values: Iterable[Optional[str]]) -> np.ndarray:
+    """Per-process 64-bit hashes of the strings, for HashIndex."""
+    return np.fromiter((hash(v) for v in values), dtype=np.int64)
+
+
+class HashIndex:
+    """
+    String -> row lookup as two int64 arrays: the 64-bit hashes of the strings, sorted, and
+    the row of each. 16 bytes per entry instead of a dict slot plus a str and an int object;
+    a lookup is a binary search. Hashes may collide, so the caller checks the returned row
+    against its own column and treats a mismatch as a miss. Never mutated: add() returns a
+    new index, as snapshots built over it are copy-on-write.
+    """
+
+    def __init__(self, hashes: Optional[np.ndarray] = None, rows: Optional[np.ndarray] = None):
+        hashes = np.empty(0, dtype=np.int64) if hashes is None else np.asarray(hashes, dtype=np.int64)
+        rows = np.empty(0, dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        # stable: among equal hashes the earlier entry is found first
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.rows = rows[order]
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, hashes: np.ndarray, rows: np.ndarray) -> "HashIndex":
+        return HashIndex(np.concatenate([self.hashes, hashes]), np.concatenate([self.rows, rows]))
+
+    def find(self, hashes: np.ndarray) -> np.ndarray:
+        """Row of the first entry with each hash, -1 where there is none."""
+        hashes = np.asarray(hashes, dtype=np.int64)
+        if not len(self.hashes):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.where(self.hashes[pos] == hashes, self.rows[pos], -1)
+
+    @property
+    def nbytes(self) -> int:
+        return self.hashes.nbytes + self.rows.nbytes
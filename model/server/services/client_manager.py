@@ -1,27 +1,75 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
 import uuid
 from datetime import datetime, timezone
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, Set
 
 from model.server.models import Client
-from .client_store import BaseClientStore
+from .client_store import BaseClientStore, RedisClientStore
 
 
 class ClientManager:
-    def __init__(self, store: BaseClientStore):
+    """
+    Клиенты со свободными слотами лежат в куче по (загрузка, ping), поэтому выбор клиента —
+    O(log n) без чтения всего хранилища: сначала наименее загруженный, при равной загрузке —
+    с меньшим ping. Записи в куче не удаляются, а устаревают: у каждого клиента есть версия,
+    которая растёт при любом изменении, и старые записи пропускаются.
+    acquire() атомарно занимает слот лучшего клиента под аренду (обычно id задачи),
+    release() освобождает её. Аренда истекает через lease_ttl секунд: если клиент так и не
+    прислал результат, слот возвращается сам, а не утекает навсегда.
+    acquire_wait() ждёт освобождения слота, только если живые клиенты есть и все заняты.
+    in_flight меняется прямо в объекте клиента, без store.register: работа, отданная клиенту,
+    не продлевает его срок жизни, продлевает только register/heartbeat.
+    """
+
+    # None: ждущих будит release этого процесса; число — ещё и опрос хранилища, если слот
+    # может освободиться в другом воркере
+    poll_interval: Optional[float] = None
+
+    def __init__(self, store: BaseClientStore, lease_ttl: float = 300):
         self.store = store
+        self.lease_ttl = lease_ttl
+        self._clients: Dict[str, Client] = {}
+        # monotonic-время последнего register/ping
+        self._seen: Dict[str, float] = {}
+        self._version: Dict[str, int] = {}
+        self._ready: List[Tuple[float, float, int, str, int]] = []
+        # запросы, ждущие свободного слота
+        self._waiters: List[asyncio.Future] = []
+        # аренды слотов: lease_id -> (client_id, monotonic-время истечения), и куча истечений
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._lease_heap: List[Tuple[float, str]] = []
+        # открытые аренды каждого клиента, чтобы снять их вместе с забытым клиентом
+        self._client_leases: Dict[str, Set[str]] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
 
-    def register(self, address: str, model_name: Optional[str] = None) -> Client:
+        for client in self.store.all():
+            self._track(client)
+
+    def register(self, address: str, model_name: Optional[str] = None, capacity: int = 1) -> Client:
         client_id = str(uuid.uuid4())
         client = Client(
             client_id=client_id,
             model_name=model_name or "maziyarpanahi/mistral-7b-instruct-v0.3",
-            address=address
+            address=address,
+            capacity=max(1, capacity)
         )
         self.store.register(client_id, client)
+        self._track(client)
         return client
 
     def heartbeat(self, client_id: str, ping: Optional[int] = None) -> Optional[Client]:
-        client = self.store.get(client_id)
+        with self._lock:
+            # ping опоздал: клиент уже истёк, пусть регистрируется заново
+            if client_id in self._seen and self._expired(client_id, time.monotonic()):
+                self._forget(client_id)
+                self.store.delete(client_id)
+                return None
+        client = self._clients.get(client_id) or self.store.get(client_id)
 
         if not client:
             return None
@@ -31,23 +79,215 @@ class ClientManager:
 
         client.last_update = datetime.now(timezone.utc).isoformat()
         self.store.register(client_id, client)
+        self._track(client)
         return client
 
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
     def get_all_clients(self) -> List[Client]:
         return self.store.all()
 
     def get_best_client(self) -> Optional[Client]:
-        # выбираем только свободных клиентов
-        clients = [client for client in self.store.all() if not client.busy]
+        """Лучший свободный клиент, без захвата (см. acquire)."""
+        with self._lock:
+            client_id = self._peek()
+            return self._clients[client_id].model_copy() if client_id else None
 
-        if not clients:
-            return None
+    def has_live_clients(self) -> bool:
+        now = time.monotonic()
+        return any(not self._expired(client_id, now) for client_id in list(self._seen))
 
-        # используем очень большое число, если ping None
-        return min(clients, key=lambda c: c.ping if c.ping is not None else 999999)
+    def acquire(self, lease_id: Optional[str] = None) -> Optional[Client]:
+        """
+        Занимает слот наименее загруженного клиента под аренду lease_id (по умолчанию
+        случайный); None, если свободных слотов нет.
+        """
+        lease_id = lease_id or str(uuid.uuid4())
+        with self._lock:
+            self._reclaim()
+            # та же аренда ещё держит слот (повтор валидации): сначала отпускаем её
+            self._free(lease_id)
+            client_id = self._peek()
+            if client_id is None:
+                return None
+            heapq.heappop(self._ready)
+            client = self._clients[client_id]
+            client.in_flight += 1
+            self._requeue(client)
+            expires = time.monotonic() + self.lease_ttl
+            self._leases[lease_id] = (client_id, expires)
+            self._client_leases.setdefault(client_id, set()).add(lease_id)
+            heapq.heappush(self._lease_heap, (expires, lease_id))
+            return client.model_copy()
+
+    async def acquire_wait(self, timeout: float, lease_id: Optional[str] = None) -> Optional[Client]:
+        """
+        Как acquire, но до timeout секунд ждёт, пока у кого-то освободится слот.
+        Без живых клиентов ждать нечего — None сразу.
+        """
+        client = self.acquire(lease_id)
+        if client is not None or timeout <= 0 or not self.has_live_clients():
+            return client
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            wait = remaining if self.poll_interval is None else min(remaining, self.poll_interval)
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                if self.poll_interval is None:
+                    return None
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+            client = self.acquire(lease_id)
+            if client is not None or not self.has_live_clients():
+                return client
+
+    def release(self, lease_id: str) -> bool:
+        """Освобождает слот аренды; False, если аренды нет (истекла или уже освобождена)."""
+        with self._lock:
+            if not self._free(lease_id):
+                return False
+
+        self._wake()
+        return True
 
     def remove_client(self, client_id: str) -> Optional[Client]:
+        with self._lock:
+            self._forget(client_id)
         return self.store.delete(client_id)
 
+    def _track(self, client: Client):
+        with self._lock:
+            self._clients[client.client_id] = client
+            self._seen[client.client_id] = time.monotonic()
+            self._requeue(client)
+        self._wake()
+
+    def _requeue(self, client: Client):
+        # новая версия делает все прежние записи клиента в куче устаревшими
+        version = self._version.get(client.client_id, 0) + 1
+        self._version[client.client_id] = version
+
+        client.busy = client.in_flight >= client.capacity
+        if client.busy:
+            return
+
+        load = client.in_flight / client.capacity
+        # используем очень большое число, если ping None
+        ping = client.ping if client.ping is not None else 999999
+        heapq.heappush(self._ready, (load, ping, next(self._seq), client.client_id, version))
+
+        # частые ping свободных клиентов копят устаревшие записи — иногда чистим кучу целиком
+        if len(self._ready) > 2 * len(self._clients) + 64:
+            self._ready = [e for e in self._ready if self._version.get(e[3]) == e[4]]
+            heapq.heapify(self._ready)
+
+    def _peek(self) -> Optional[str]:
+        # снимаем с вершины устаревшие записи и клиентов, переставших присылать ping
+        now = time.monotonic()
+        while self._ready:
+            _, _, _, client_id, version = self._ready[0]
+            if self._version.get(client_id) != version:
+                heapq.heappop(self._ready)
+                continue
+            if self._expired(client_id, now):
+                heapq.heappop(self._ready)
+                self._forget(client_id)
+                self.store.delete(client_id)
+                continue
+            return client_id
+        return None
+
+    def _expired(self, client_id: str, now: float) -> bool:
+        ttl = getattr(self.store, "ttl", None)
+        return ttl is not None and now - self._seen.get(client_id, 0) > ttl
+
+    def _wake(self):
+        # будим одного ждущего; если слот перехватят, он снова встанет в очередь
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(self._resolve, waiter)
+                return
+
+    @staticmethod
+    def _resolve(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _reclaim(self):
+        # истёкшие аренды: клиент не ответил, слот возвращаем
+        now = time.monotonic()
+        while self._lease_heap and self._lease_heap[0][0] <= now:
+            expires, lease_id = heapq.heappop(self._lease_heap)
+            lease = self._leases.get(lease_id)
+            if lease is None or lease[1] != expires:
+                continue
+            self._free(lease_id)
+
+    def _free(self, lease_id: str) -> bool:
+        # снимает аренду и возвращает её слот клиенту; False, если аренды нет
+        lease = self._leases.pop(lease_id, None)
+        client = self._clients.get(lease[0]) if lease else None
+        if client is None:
+            return False
+        self._client_leases[client.client_id].discard(lease_id)
+        client.in_flight = max(0, client.in_flight - 1)
+        self._requeue(client)
+        return True
+
+    def _forget(self, client_id: str):
+        # аренды забытого клиента снимаются, счётчики обнуляются: если тот же объект
+        # вернётся из хранилища, занятых слотов за ним не останется
+        for lease_id in self._client_leases.pop(client_id, ()):
+            self._leases.pop(lease_id, None)
+        client = self._clients.pop(client_id, None)
+        if client is not None:
+            client.in_flight = 0
+            client.busy = False
+        self._seen.pop(client_id, None)
+        self._version.pop(client_id, None)
+
+
+class RedisClientManager(ClientManager):
+    """
+    Слоты клиентов живут в RedisClientStore: выбор, захват и освобождение слота — атомарные
+    Lua-скрипты, общие для всех воркеров, поэтому клиент, зарегистрированный в одном воркере,
+    виден всем, а release из /generate/result срабатывает, в какой бы воркер тот ни пришёл.
+    Локально хранятся только ждущие запросы: слот, освобождённый другим воркером, они
+    замечают опросом раз в poll_interval секунд.
+    """
+
+    def __init__(self, store: RedisClientStore, lease_ttl: float = 300, poll_interval: float = 0.1):
+        self.poll_interval = poll_interval
+        super().__init__(store, lease_ttl)
+
+    def _track(self, client: Client):
+        # состояние слотов целиком в redis, здесь только будим ждущих
+        self._wake()
+
+    def has_live_clients(self) -> bool:
+        return self.store.live_count() > 0
+
+    def get_best_client(self) -> Optional[Client]:
+        return self.store.peek()
 
+    def acquire(self, lease_id: Optional[str] = None) -> Optional[Client]:
+        return self.store.acquire(lease_id or str(uuid.uuid4()), self.lease_ttl)
 
+    def release(self, lease_id: str) -> bool:
+        if not self.store.release(lease_id):
+            return False
+        self._wake()
+        return True
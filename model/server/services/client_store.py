@@ -1,6 +1,7 @@
-import json
+import heapq
+import time
 from datetime import datetime, timezone
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
 import redis
 
@@ -16,86 +17,298 @@ class BaseClientStore:
 
 
 class MemoryClientStore(BaseClientStore):
+    """
+    Клиенты хранятся готовыми объектами Client, срок жизни считается по monotonic-часам.
+    Истечения лежат в куче (время, id): протухшие снимаются с вершины, так что чтение
+    не разбирает timestamp каждого клиента, а лишь смотрит на вершину кучи.
+    Возвращаемые объекты — те же, что в хранилище: изменения в них видны сразу,
+    register ещё и продлевает срок жизни клиента.
+    """
+
     def __init__(self, ttl: int = 600):
-        self.clients: Dict[str, dict] = {}
+        self.clients: Dict[str, Client] = {}
         self.ttl = ttl
+        self._expires: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
 
     def register(self, client_id: str, client: Client) -> Optional[Client]:
         client.last_update = datetime.now(timezone.utc).isoformat()
-        # храним dict, не pydantic объект
-        self.clients[client_id] = client.model_dump()
-        return Client(**self.clients[client_id])
+        self.clients[client_id] = client
+        self._touch(client_id)
+        return client
 
     def get(self, client_id: str) -> Optional[Client]:
-        raw = self.clients.get(client_id)
-        if not raw:
+        if self._expires.get(client_id, 0) <= time.monotonic():
+            self._reap()
             return None
-        return Client(**raw)
+        return self.clients.get(client_id)
 
     def all(self) -> List[Client]:
-        self._cleanup()
-        return [Client(**i) for i in self.clients.values()]
+        self._reap()
+        return list(self.clients.values())
 
     def delete(self, client_id: str) -> Optional[Client]:
-        raw = self.clients.pop(client_id, None)
-        if not raw:
-            return None
-        return Client(**raw)
+        self._expires.pop(client_id, None)
+        return self.clients.pop(client_id, None)
 
     def update(self, client_id: str) -> Optional[Client]:
-        if client_id in self.clients:
-            self.clients[client_id]["last_update"] = datetime.now(timezone.utc).isoformat()
-        return self.get(client_id)
+        client = self.get(client_id)
+        if client is None:
+            return None
+        client.last_update = datetime.now(timezone.utc).isoformat()
+        self._touch(client_id)
+        return client
+
+    def _touch(self, client_id: str):
+        expires = time.monotonic() + self.ttl
+        self._expires[client_id] = expires
+        heapq.heappush(self._heap, (expires, client_id))
 
-    def _cleanup(self):
-        now = datetime.now(timezone.utc)
+        # каждое продление оставляет в куче старую запись — иногда пересобираем её
+        if len(self._heap) > 2 * len(self._expires) + 64:
+            self._heap = [(e, i) for i, e in self._expires.items()]
+            heapq.heapify(self._heap)
 
-        for client_id, client in list(self.clients.items()):
-            if (now - datetime.fromisoformat(client["last_update"])).total_seconds() > self.ttl:
+    def _reap(self):
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            expires, client_id = heapq.heappop(self._heap)
+            # запись могла устареть: клиент продлён или уже удалён
+            if self._expires.get(client_id) == expires:
                 self.delete(client_id)
 
 
+# Общая часть скриптов RedisClientStore. Раскладка KEYS одна для всех:
+#   1 clients (id -> json)      2 clients:expires (id -> unix-время истечения)
+#   3 clients:last_update       4 clients:ready (клиенты со свободными слотами, score = загрузка, ping)
+#   5 clients:in_flight         6 clients:capacity          7 clients:ping
+#   8 clients:leases (аренда -> unix-время истечения)       9 clients:lease_owner (аренда -> id)
+# Score в clients:ready двухуровневый, как (загрузка, ping) в куче ClientManager: загрузка
+# n / cap округляется вниз до шага 1e-6 (различные загрузки различимы при capacity до 1000)
+# и умножается на 1e6, ping занимает младшие разряды [0, 999999]. Score не больше 1e12,
+# double хранит его с запасом точности, и ping никогда не перевешивает загрузку.
+_SLOTS_LUA = """
+local function requeue(id)
+  local cap = tonumber(redis.call('HGET', KEYS[6], id))
+  if not cap then
+    redis.call('ZREM', KEYS[4], id)
+    return
+  end
+  local n = tonumber(redis.call('HGET', KEYS[5], id) or '0')
+  if n < cap then
+    local ping = math.max(math.min(tonumber(redis.call('HGET', KEYS[7], id) or '999999'), 999999), 0)
+    redis.call('ZADD', KEYS[4], math.floor(n * 1e6 / cap) * 1e6 + ping, id)
+  else
+    redis.call('ZREM', KEYS[4], id)
+  end
+end
+
+local function forget(id)
+  redis.call('HDEL', KEYS[1], id)
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('HDEL', KEYS[3], id)
+  redis.call('ZREM', KEYS[4], id)
+  redis.call('HDEL', KEYS[5], id)
+  redis.call('HDEL', KEYS[6], id)
+  redis.call('HDEL', KEYS[7], id)
+end
+
+local function reap(now)
+  for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    forget(id)
+  end
+end
+
+local function free(lease)
+  local id = redis.call('HGET', KEYS[9], lease)
+  redis.call('ZREM', KEYS[8], lease)
+  redis.call('HDEL', KEYS[9], lease)
+  if not id then return 0 end
+  if redis.call('HEXISTS', KEYS[6], id) == 1 then
+    if redis.call('HINCRBY', KEYS[5], id, -1) < 0 then redis.call('HSET', KEYS[5], id, 0) end
+    requeue(id)
+  end
+  return 1
+end
+
+local function reclaim(now)
+  for _, lease in ipairs(redis.call('ZRANGEBYSCORE', KEYS[8], '-inf', now)) do
+    free(lease)
+  end
+end
+
+-- лучший живой клиент со свободным слотом, протухших по пути удаляем
+local function best(now)
+  while true do
+    local top = redis.call('ZRANGE', KEYS[4], 0, 0)
+    if #top == 0 then return nil end
+    local expires = redis.call('ZSCORE', KEYS[2], top[1])
+    if expires and tonumber(expires) > now then return top[1] end
+    forget(top[1])
+  end
+end
+
+local function view(id)
+  return {redis.call('HGET', KEYS[1], id), redis.call('HGET', KEYS[5], id) or '0',
+          redis.call('HGET', KEYS[3], id) or ''}
+end
+"""
+
+# ARGV: id, json, now, ttl, capacity, ping или ""; in_flight сохраняется между ping
+_REGISTER_LUA = _SLOTS_LUA + """
+local now = tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HSET', KEYS[6], ARGV[1], ARGV[5])
+if ARGV[6] ~= '' then redis.call('HSET', KEYS[7], ARGV[1], ARGV[6]) else redis.call('HDEL', KEYS[7], ARGV[1]) end
+redis.call('HSETNX', KEYS[5], ARGV[1], 0)
+requeue(ARGV[1])
+return redis.call('HGET', KEYS[5], ARGV[1])
+"""
+
+# ARGV: now. Протухшие клиенты находятся и удаляются тем же атомарным вызовом, который
+# читает живых, поэтому клиент, успевший прислать ping, не может быть удалён по устаревшему score
+_ALL_LUA = _SLOTS_LUA + """
+reap(tonumber(ARGV[1]))
+return {redis.call('HGETALL', KEYS[1]), redis.call('HGETALL', KEYS[5]), redis.call('HGETALL', KEYS[3])}
+"""
+
+# ARGV: id, now, ttl, last_update
+_UPDATE_LUA = _SLOTS_LUA + """
+local expires = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if not expires or tonumber(expires) <= tonumber(ARGV[2]) then return false end
+redis.call('ZADD', KEYS[2], 'XX', tonumber(ARGV[2]) + tonumber(ARGV[3]), ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+return view(ARGV[1])
+"""
+
+# ARGV: id
+_DELETE_LUA = _SLOTS_LUA + """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+forget(ARGV[1])
+return raw
+"""
+
+# ARGV: now
+_PEEK_LUA = _SLOTS_LUA + """
+local now = tonumber(ARGV[1])
+reclaim(now)
+local id = best(now)
+if not id then return false end
+return view(id)
+"""
+
+# ARGV: now, lease, lease ttl
+_ACQUIRE_LUA = _SLOTS_LUA + """
+local now = tonumber(ARGV[1])
+reclaim(now)
+-- та же аренда ещё держит слот (повтор валидации): сначала отпускаем её
+free(ARGV[2])
+local id = best(now)
+if not id then return false end
+redis.call('HINCRBY', KEYS[5], id, 1)
+requeue(id)
+redis.call('ZADD', KEYS[8], now + tonumber(ARGV[3]), ARGV[2])
+redis.call('HSET', KEYS[9], ARGV[2], id)
+return view(id)
+"""
+
+# ARGV: lease
+_RELEASE_LUA = _SLOTS_LUA + """
+return free(ARGV[1])
+"""
+
 
 class RedisClientStore(BaseClientStore):
-    def __init__(self, host: str, port: int, password: Optional[str] = None, ttl: int = 600):
-        self.redis = redis.Redis(host=host, port=port, password=password, decode_responses=True)
+    """
+    Все клиенты в одном hash (clients: id -> json), срок жизни — в zset clients:expires
+    (id -> unix-время истечения), время последнего продления — в clients:last_update.
+    Каждая операция — один round trip (pipeline или Lua-скрипт), и объект возвращается
+    без повторного чтения.
+    Слоты валидации тоже здесь, общие для всех воркеров: zset clients:ready держит клиентов
+    со свободными слотами по (загрузка, ping), in_flight и capacity лежат числами в отдельных
+    hash, занятый слот — аренда с истечением в clients:leases. acquire/release — Lua-скрипты,
+    так что два воркера не могут занять один и тот же последний слот.
+    Имена ключей начинаются с hash tag {clients}: скрипты работают с несколькими ключами,
+    и в Redis Cluster все они должны лежать в одном слоте.
+    """
+
+    def __init__(self, host: str, port: int, password: Optional[str] = None, ttl: int = 600,
+                 key: str = "{clients}", client: Optional[redis.Redis] = None):
+        # client — готовое соединение (например, fakeredis в проверках)
+        self.redis = client or redis.Redis(host=host, port=port, password=password, decode_responses=True)
         self.ttl = ttl
+        self.key = key
+        self.expires_key = f"{key}:expires"
+        self._keys = [key, self.expires_key, f"{key}:last_update", f"{key}:ready", f"{key}:in_flight",
+                      f"{key}:capacity", f"{key}:ping", f"{key}:leases", f"{key}:lease_owner"]
+        self._register = self.redis.register_script(_REGISTER_LUA)
+        self._all = self.redis.register_script(_ALL_LUA)
+        self._update = self.redis.register_script(_UPDATE_LUA)
+        self._delete = self.redis.register_script(_DELETE_LUA)
+        self._peek = self.redis.register_script(_PEEK_LUA)
+        self._acquire = self.redis.register_script(_ACQUIRE_LUA)
+        self._release = self.redis.register_script(_RELEASE_LUA)
+
+    @staticmethod
+    def _client(raw: str, in_flight: Optional[str], last_update: Optional[str]) -> Client:
+        client = Client.model_validate_json(raw)
+        client.in_flight = int(in_flight or 0)
+        client.busy = client.in_flight >= client.capacity
+        if last_update:
+            client.last_update = last_update
+        return client
 
     def register(self, client_id: str, client: Client) -> Optional[Client]:
         client.last_update = datetime.now(timezone.utc).isoformat()
-        self.redis.setex(f"client:{client_id}", self.ttl, json.dumps(client))
-        return self.get(client_id)
+        in_flight = self._register(keys=self._keys, args=[
+            client_id, client.model_dump_json(), time.time(), self.ttl, client.capacity,
+            client.ping if client.ping is not None else ""
+        ])
+        client.in_flight = int(in_flight or 0)
+        client.busy = client.in_flight >= client.capacity
+        return client
 
     def get(self, client_id: str) -> Optional[Client]:
-        raw = self.redis.get(f"client:{client_id}")
-        return Client(**json.loads(raw)) if raw else None
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.key, client_id)
+        pipe.zscore(self.expires_key, client_id)
+        pipe.hget(self._keys[4], client_id)
+        pipe.hget(self._keys[2], client_id)
+        raw, expires, in_flight, last_update = pipe.execute()
+        if not raw or expires is None or expires < time.time():
+            return None
+        return self._client(raw, in_flight, last_update)
 
     def all(self) -> List[Client]:
-        result = []
-        for key in self.redis.scan_iter("client:*"):
-            raw = self.redis.get(key)
-            if not raw:
-                continue
-            data = json.loads(raw)
-            # key looks like client:<id>
-            client_id = key.split(":", 1)[1]
-            data["client_id"] = client_id
-            result.append(Client(**data))
-        return result
+        clients, in_flight, last_update = (
+            dict(zip(flat[::2], flat[1::2])) for flat in self._all(keys=self._keys, args=[time.time()])
+        )
+        return [self._client(raw, in_flight.get(client_id), last_update.get(client_id))
+                for client_id, raw in clients.items()]
 
     def delete(self, client_id: str) -> Optional[Client]:
-        client = self.get(client_id)
-        self.redis.delete(f"client:{client_id}")
-        return client
+        raw = self._delete(keys=self._keys, args=[client_id])
+        return Client.model_validate_json(raw) if raw else None
 
     def update(self, client_id: str) -> Optional[Client]:
-        key = f"client:{client_id}"
-        raw = self.redis.get(key)
+        res = self._update(keys=self._keys, args=[client_id, time.time(), self.ttl,
+                                                  datetime.now(timezone.utc).isoformat()])
+        return self._client(*res) if res else None
+
+    def live_count(self) -> int:
+        return self.redis.zcount(self.expires_key, f"({time.time()}", "+inf")
+
+    def peek(self) -> Optional[Client]:
+        """Лучший клиент со свободным слотом, без захвата."""
+        res = self._peek(keys=self._keys, args=[time.time()])
+        return self._client(*res) if res else None
 
-        if raw:
-            data = json.loads(raw)
-            data["last_update"] = datetime.now(timezone.utc).isoformat()
-            self.redis.setex(key, self.ttl, json.dumps(data))
-            return self.get(client_id)
+    def acquire(self, lease_id: str, lease_ttl: float) -> Optional[Client]:
+        """Атомарно занимает слот лучшего клиента под аренду lease_id."""
+        res = self._acquire(keys=self._keys, args=[time.time(), lease_id, lease_ttl])
+        return self._client(*res) if res else None
 
-        return None
+    def release(self, lease_id: str) -> bool:
+        return bool(self._release(keys=self._keys, args=[lease_id]))
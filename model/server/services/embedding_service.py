@@ -1,13 +1,25 @@
+import threading
+import time
 import numpy as np
-from typing import List, Optional, Dict, Any
-from collections import Counter
+from typing import List, Optional, Dict, Any, Iterable, Tuple
+from collections import Counter, OrderedDict
 import logging
 
 from model.server.models import Book
-from model.server.services.book_repository import BookRepository, DBBookRepository
+from model.server.services.book_repository import BookRepository, DBBookRepository, book_key
+from model.server.services.catalog import BookColumns, HashIndex, str_hashes
+from model.server.services.embedding_store import EmbeddingStore, content_hash
+from model.server.services.retrieval import RetrievalConfig, build_retriever
+from model.server.utils.metrics import REGISTRY
 
 log = logging.getLogger(__name__)
 
+# encode / score / select per batch, genre_lookup per user; the stages do not overlap,
+# select excludes the genre lookups of its users
+STAGE_SECONDS = REGISTRY.histogram(
+    "recommendation_stage_seconds", "Time spent in each recommendation stage", ("stage",)
+)
+
 try:
     from sentence_transformers import SentenceTransformer
     _HAS_ST = True
@@ -20,103 +32,462 @@ try:
 except Exception:
     _HAS_SK = False
 
+MODEL_NAME = "all-MiniLM-L6-v2"
+# version of the text a book is encoded from; bump it whenever embedding_text changes,
+# stored embeddings of another version are re-encoded
+EMBEDDING_SCHEMA_VERSION = 1
+# catalog rows whose texts are built and encoded at a time; the texts of the whole
+# catalog are never held at once
+ENCODE_BATCH_SIZE = 1024
+
+
+def embedding_text(title: Optional[str], author: Optional[str], description: Optional[str]) -> str:
+    """Canonical text a book is encoded from, shared by catalog rows and read books."""
+    return " — ".join([str(title or ""), str(author or ""), str(description or "")])
+
+
+class CatalogSnapshot:
+    """
+    Catalog books, their embedding matrix and the lookup indexes built over them.
+    A snapshot is never mutated: a refresh builds a new one and swaps the reference,
+    so a request keeps a consistent view for its whole lifetime.
+    """
+
+    def __init__(self, books: BookColumns, embeddings: np.ndarray, retriever):
+        self.books = books
+        self.embeddings = embeddings
+        # exact or approximate search over embeddings, see services.retrieval
+        self.retriever = retriever
+        self.built_at = time.time()
+        # row of the first occurrence of each normalized 'title|||author' key
+        # and that row number per catalog row (equal for all editions of a book)
+        self.key_index = HashIndex()
+        self.key_codes = np.empty(0, dtype=np.int64)
+        # catalog row of each book id
+        self.id_index = HashIndex()
+        # inverted genre index: genre -> sorted catalog rows
+        self.genre_rows: Dict[str, np.ndarray] = {}
+        # genres merged over all editions by the first row of the key, only for keys with
+        # several catalog rows; see genres_of
+        self.key_genres: Dict[int, Tuple[str, ...]] = {}
+        self._index_rows(books, 0)
+
+    def __len__(self) -> int:
+        return len(self.books)
+
+    @property
+    def index_nbytes(self) -> int:
+        """Memory of the key and id lookups, on top of books.nbytes."""
+        return self.key_index.nbytes + self.id_index.nbytes + self.key_codes.nbytes
+
+    def _key_at(self, row: int) -> str:
+        return book_key(self.books.titles[row], self.books.authors[row])
+
+    def _index_rows(self, books: BookColumns, offset: int):
+        keys = [book_key(t, a) for t, a in zip(books.titles, books.authors)]
+        hashes = str_hashes(keys)
+        own = np.arange(offset, offset + len(keys), dtype=np.int64)
+
+        # first row of each key: a row of the snapshot extended, else its first row in this batch
+        _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        codes = self.key_index.find(hashes)
+        new = codes < 0
+        codes[new] = (offset + first[inverse])[new]
+        # a key that only shares the hash of another one keeps its own row as code
+        for i in np.flatnonzero(codes != own):
+            c = int(codes[i])
+            if (keys[c - offset] if c >= offset else self._key_at(c)) != keys[i]:
+                codes[i] = own[i]
+        firsts = new & (codes == own)
+        self.key_index = self.key_index.add(hashes[firsts], own[firsts])
+        self.key_codes = np.concatenate([self.key_codes, codes])
+        self.id_index = self.id_index.add(str_hashes(books.ids), own)
+
+        rows: Dict[str, List[int]] = {}
+        for i, (first_row, genres) in enumerate(zip(codes.tolist(), books.genres), offset):
+            if first_row != i and genres:
+                known = self.key_genres.get(first_row) or self.books.genres[first_row]
+                self.key_genres[first_row] = tuple(dict.fromkeys(known + genres))
+            for g in genres:
+                rows.setdefault(g, []).append(i)
+        for g, r in rows.items():
+            added = np.asarray(r, dtype=np.int64)
+            self.genre_rows[g] = np.concatenate([self.genre_rows[g], added]) if g in self.genre_rows else added
+
+    def extend(self, books: BookColumns, embeddings: np.ndarray) -> "CatalogSnapshot":
+        """New snapshot with the books appended; indexes are extended, not rebuilt."""
+        snap = CatalogSnapshot.__new__(CatalogSnapshot)
+        snap.books = self.books + books
+        snap.embeddings = embeddings
+        snap.retriever = self.retriever.extend(embeddings)
+        snap.built_at = time.time()
+        snap.key_index = self.key_index
+        snap.key_codes = self.key_codes
+        snap.id_index = self.id_index
+        snap.genre_rows = dict(self.genre_rows)
+        snap.key_genres = dict(self.key_genres)
+        snap._index_rows(books, len(self.books))
+        return snap
+
+    def row_of_key(self, key: str) -> Optional[int]:
+        """First catalog row of a 'title|||author' key, None if the catalog does not know it."""
+        row = int(self.key_index.find(str_hashes([key]))[0])
+        return row if row >= 0 and self._key_at(row) == key else None
+
+    def rows_of_ids(self, book_ids: List[str]) -> np.ndarray:
+        """Catalog row of each book id, -1 for ids the catalog does not know."""
+        rows = self.id_index.find(str_hashes(book_ids))
+        for i in np.flatnonzero(rows >= 0):
+            if self.books.ids[rows[i]] != book_ids[i]:
+                rows[i] = -1
+        return rows
+
+    def genres_of(self, key: str) -> Optional[Tuple[str, ...]]:
+        """Genres of a 'title|||author' key, None if the catalog does not know it."""
+        row = self.row_of_key(key)
+        if row is None:
+            return None
+        merged = self.key_genres.get(row)
+        return merged if merged is not None else self.books.genres[row]
+
+    def key_codes_of(self, keys: Iterable[str]) -> np.ndarray:
+        rows = (self.row_of_key(k) for k in keys)
+        return np.fromiter((r for r in rows if r is not None), dtype=np.int64)
+
+    def genre_affinity(self, weights: Dict[str, float], rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Per-row sum of the weights of the favorite genres the book belongs to, for every
+        catalog row or only for the given sorted rows (a binary search per genre, no pass over N).
+        """
+        if rows is None:
+            affinity = np.zeros(len(self.books), dtype=np.float32)
+            for g, w in weights.items():
+                in_genre = self.genre_rows.get(g)
+                if in_genre is not None:
+                    affinity[in_genre] += w
+            return affinity
+
+        affinity = np.zeros(len(rows), dtype=np.float32)
+        for g, w in weights.items():
+            in_genre = self.genre_rows.get(g)
+            if in_genre is None or not len(in_genre):
+                continue
+            pos = np.minimum(np.searchsorted(in_genre, rows), len(in_genre) - 1)
+            affinity[in_genre[pos] == rows] += w
+        return affinity
+
+    def rows_in_genres(self, genres: Iterable[str]) -> np.ndarray:
+        """Sorted catalog rows of books in any of the genres."""
+        parts = [self.genre_rows[g] for g in genres if g in self.genre_rows]
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
 
 class EmbeddingService:
-    def __init__(self, repo: BookRepository | None = None):
+    def __init__(
+        self,
+        repo: BookRepository | None = None,
+        cache_dir: Optional[str] = None,
+        retrieval: Optional[RetrievalConfig] = None,
+        query_cache_size: int = 10000,
+        encoder: str = "auto"
+    ):
         self.repo = repo or DBBookRepository()
-        self.catalog: List[Dict[str, Any]] = []  # will be loaded lazily
+        # auto: transformer, then TF-IDF, then hashing; "tfidf" / "hash" skip the earlier ones
+        # (offline runs and benchmarks never touch the model hub)
+        self.encoder = encoder
+        # persisted transformer embeddings of the catalog, reused across restarts
+        self.cache_dir = cache_dir
+        self.store = EmbeddingStore(cache_dir) if cache_dir else None
+        self.retrieval = retrieval or RetrievalConfig()
         self.model = None
         self.vectorizer = None
-        self._embeddings = None
+        # current catalog snapshot, loaded lazily and swapped whole by refresh_catalog
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._catalog_lock = threading.Lock()
+        # unix time of the last full load or incremental refresh check
+        self.refreshed_at: Optional[float] = None
+        # LRU of read-book vectors keyed by (book id, text hash), with hit/miss counters
+        self.query_cache_size = query_cache_size
+        self._query_cache: OrderedDict = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.query_cache_hits = 0
+        self.query_cache_catalog_hits = 0
+        self.query_cache_misses = 0
         # lazy load model only when needed
-        if _HAS_ST:
+        if _HAS_ST and encoder == "auto":
             try:
                 # do not force-load heavy model until first use
-                self.model = SentenceTransformer("all-MiniLM-L6-v2")
+                self.model = SentenceTransformer(MODEL_NAME)
             except Exception as e:
                 log.warning("SentenceTransformer not available: %s", e)
                 self.model = None
 
-        # build catalog lazily
-        self._catalog_loaded = False
+    @property
+    def catalog(self) -> BookColumns:
+        snap = self._snapshot
+        return snap.books if snap is not None else BookColumns()
+
+    def _load_catalog(self) -> CatalogSnapshot:
+        snap = self._snapshot
+        if snap is not None:
+            return snap
+        with self._catalog_lock:
+            if self._snapshot is None:
+                # streamed from the repository in batches straight into columns
+                books = self.repo.load_catalog()
+                books, embeddings = self._build_catalog_embeddings(books)
+                # a refitted vectorizer makes previously cached query vectors incomparable
+                with self._query_cache_lock:
+                    self._query_cache.clear()
+                retriever = build_retriever(embeddings, self.retrieval, self.cache_dir)
+                self._snapshot = CatalogSnapshot(books, embeddings, retriever)
+                self.refreshed_at = time.time()
+            return self._snapshot
+
+    def refresh_catalog(self) -> int:
+        """
+        Picks up books added to the repository since the current snapshot (the watermark
+        is the set of known ids), encodes only them and swaps in an extended snapshot.
+        Returns the number of added books.
+        """
+        if self._snapshot is None or not len(self._snapshot):
+            # nothing to extend yet: (re)load the catalog from scratch
+            with self._catalog_lock:
+                self._snapshot = None
+            return len(self._load_catalog())
+
+        with self._catalog_lock:
+            snap = self._snapshot
+            ids = self.repo.get_book_ids()
+            known = snap.rows_of_ids([str(i) for i in ids]) >= 0
+            new_ids = [i for i, k in zip(ids, known.tolist()) if not k]
+            self.refreshed_at = time.time()
+            if not new_ids:
+                return 0
+
+            added = BookColumns.from_dicts(self.repo.get_books_by_ids(new_ids))
+            if not len(added):
+                return 0
+
+            if self.model and self.store:
+                books = snap.books + added
+                embeddings, order = self._load_or_encode_catalog(books, fixed=len(snap))
+                if order is not None:
+                    added = added.take(order[len(snap):] - len(snap))
+            else:
+                embeddings = np.vstack([snap.embeddings, self._encode_rows(added, np.arange(len(added)))])
 
-    def _load_catalog(self):
-        if self._catalog_loaded:
-            return
-        self.catalog = self.repo.get_all_books()
-        self._build_catalog_embeddings()
-        self._catalog_loaded = True
+            self._snapshot = snap.extend(added, embeddings)
+            if self.cache_dir:
+                self._snapshot.retriever.save(self.cache_dir, embeddings)
+            log.info("Catalog refreshed: %d new books, %d total", len(added), len(self._snapshot))
+            return len(added)
 
-    def _text_of(self, item: Dict[str, Any]) -> str:
-        return " — ".join([str(item.get("title") or ""), str(item.get("author") or ""), str(item.get("description") or "")])
+    @staticmethod
+    def _iter_texts(books: BookColumns) -> Iterable[str]:
+        return (embedding_text(t, a, d) for t, a, d in zip(books.titles, books.authors, books.descriptions))
 
-    def _build_catalog_embeddings(self):
-        if not self.catalog:
-            self._embeddings = np.zeros((0, 1))
-            return
+    @staticmethod
+    def _text_at(books: BookColumns, row: int) -> str:
+        return embedding_text(books.titles[row], books.authors[row], books.descriptions[row])
 
-        texts = [self._text_of(b) for b in self.catalog]
+    def _build_catalog_embeddings(self, books: BookColumns) -> Tuple[BookColumns, np.ndarray]:
+        """Catalog embeddings and the books in their row order (the embedding store's order, if it differs)."""
+        if not len(books):
+            return books, np.zeros((0, 1))
 
-        if self.model:
-            embs = self.model.encode(texts, convert_to_numpy=True)
-            norms = np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12
-            self._embeddings = embs / norms
-            return
+        if self.model and self.store:
+            embeddings, order = self._load_or_encode_catalog(books)
+            return (books.take(order) if order is not None else books), embeddings
 
-        if _HAS_SK:
+        if not self.model and _HAS_SK and self.encoder != "hash":
             self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), max_features=20000)
-            mat = self.vectorizer.fit_transform(texts).toarray()
-            norms = np.linalg.norm(mat, axis=1, keepdims=True) + 1e-12
-            self._embeddings = mat / norms
-            return
+            self.vectorizer.fit(self._iter_texts(books))
+
+        return books, self._encode_rows(books, np.arange(len(books)))
 
+    @staticmethod
+    def _hash_encode(texts: List[str]) -> np.ndarray:
         # fallback hashing
         arr = []
         for t in texts:
             x = np.frombuffer(t.encode("utf-8")[:512].ljust(512, b"\0"), dtype=np.uint8).astype(float)
-            vec = np.mean(x.reshape(-1, 16), axis=1)
-            vec = vec / (np.linalg.norm(vec) + 1e-12)
-            arr.append(vec)
-        self._embeddings = np.vstack(arr)
+            arr.append(np.mean(x.reshape(-1, 16), axis=1))
+        return np.vstack(arr)
 
-    def _encode_books(self, books: List[Book]) -> np.ndarray:
-        if not books:
-            # return empty array with shape (0, dim) — if catalog exists, use its dim
-            if self._embeddings is None or self._embeddings.size == 0:
-                return np.zeros((0, 1))
-            return np.zeros((0, self._embeddings.shape[1]))
-
-        texts = [ (b.title or "") + " " + (b.description or "") for b in books ]
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
         if self.model:
-            embs = self.model.encode(texts, convert_to_numpy=True)
+            embs = np.asarray(self.model.encode(texts, convert_to_numpy=True), dtype=np.float32)
         elif self.vectorizer:
             embs = self.vectorizer.transform(texts).toarray()
         else:
-            arr = []
-            for t in texts:
-                x = np.frombuffer(t.encode("utf-8")[:512].ljust(512, b"\0"), dtype=np.uint8).astype(float)
-                vec = np.mean(x.reshape(-1, 16), axis=1)
-                arr.append(vec)
-            embs = np.vstack(arr)
+            embs = self._hash_encode(texts)
         norms = np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12
-        return embs / norms
-
-    def get_recommendations(
-        self,
-        user_books: List[Book],
-        similar_top: int = 10,
-        novel_top: int = 10,
-        genre_top: int = 10,
-        novel_sim_min: float = 0.55,
-        novel_sim_max: float = 0.75,
-        exclude_read: bool = True
-    ):
-        # ensure catalog loaded
-        self._load_catalog()
+        # float32 everywhere: half the memory of NumPy's default float64 and what BLAS,
+        # the store and FAISS expect
+        return (embs / norms).astype(np.float32, copy=False)
+
+    def _encode_rows(self, books: BookColumns, rows: np.ndarray) -> np.ndarray:
+        """Embeddings of the given catalog rows, their texts built ENCODE_BATCH_SIZE rows at a time."""
+        out = None
+        for start in range(0, len(rows), ENCODE_BATCH_SIZE):
+            chunk = rows[start:start + ENCODE_BATCH_SIZE]
+            vectors = self._encode_texts([self._text_at(books, r) for r in chunk.tolist()])
+            if out is None:
+                out = np.empty((len(rows), vectors.shape[1]), dtype=np.float32)
+            out[start:start + len(chunk)] = vectors
+        return out
+
+    def _load_or_encode_catalog(self, books: BookColumns, fixed: int = 0) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Reuses stored rows whose id and content hash are unchanged and encodes only the rest.
+        Returns the memory-mapped matrix from the store and the row order of the books in it:
+        when the store already holds exactly these books in another order, the file is reused
+        as is and books row order[r] is stored row r (the first `fixed` rows, an existing
+        snapshot, must keep their place); None when the books are in store order.
+        """
+        # one text at a time: only the stale rows below are encoded, again in batches
+        hashes = np.fromiter((content_hash(t) for t in self._iter_texts(books)), dtype=np.uint64, count=len(books))
+
+        with self.store.lock():
+            cached = self.store.load(MODEL_NAME, EMBEDDING_SCHEMA_VERSION)
+            reuse = np.full(len(books), -1, dtype=np.int64)
+            if cached is not None:
+                cached_ids, cached_hashes, cached_matrix = cached
+                reuse = self._stored_rows(books, hashes, cached_ids, cached_hashes)
+                if len(cached_ids) == len(books) and np.array_equal(reuse, np.arange(len(books))):
+                    log.info("Loaded %d catalog embeddings from %s", len(books), self.store.path)
+                    return cached_matrix, None
+                # the same rows in another order: a permutation instead of rewriting the file,
+                # which would also stop workers sharing its pages
+                if len(cached_ids) == len(books) and (reuse >= 0).all() and len(np.unique(reuse)) == len(books):
+                    order = np.empty(len(books), dtype=np.int64)
+                    order[reuse] = np.arange(len(books))
+                    if np.array_equal(order[:fixed], np.arange(fixed)):
+                        log.info("Loaded %d catalog embeddings from %s in stored order", len(books), self.store.path)
+                        return cached_matrix, order
+
+            stale = np.flatnonzero(reuse < 0)
+            log.info("Encoding %d of %d catalog books", len(stale), len(books))
+            fresh = self._encode_rows(books, stale) if len(stale) else None
+
+            dim = fresh.shape[1] if fresh is not None else cached[2].shape[1]
+            matrix = np.empty((len(books), dim), dtype=np.float32)
+            kept = np.flatnonzero(reuse >= 0)
+            if len(kept):
+                matrix[kept] = cached[2][reuse[kept]]
+            if fresh is not None:
+                matrix[stale] = fresh
+
+            # the id array is built only to rewrite the store
+            ids = np.array(list(books.ids))
+            self.store.save(MODEL_NAME, EMBEDDING_SCHEMA_VERSION, ids, hashes, matrix)
+            return self.store.load(MODEL_NAME, EMBEDDING_SCHEMA_VERSION)[2], None
+
+    @staticmethod
+    def _stored_rows(books: BookColumns, hashes: np.ndarray, cached_ids: np.ndarray,
+                     cached_hashes: np.ndarray) -> np.ndarray:
+        """
+        Store row of each book whose id and content hash are unchanged, -1 for the rest.
+        A HashIndex over the stored ids is probed with the hashes of the id column, so no
+        second copy of the ids is built; hash collisions are checked and read as misses.
+        """
+        index = HashIndex(str_hashes(cached_ids), np.arange(len(cached_ids), dtype=np.int64))
+        reuse = index.find(str_hashes(books.ids))
+        found = np.flatnonzero(reuse >= 0)
+        stale = found[cached_hashes[reuse[found]] != hashes[found]]
+        reuse[stale] = -1
+        for r in np.flatnonzero(reuse >= 0).tolist():
+            if cached_ids[reuse[r]] != books.ids[r]:
+                reuse[r] = -1
+        return reuse
+
+    def _encode_books(self, books: List[Book], snap: CatalogSnapshot) -> np.ndarray:
+        if not books:
+            # return empty array with shape (0, dim) — if catalog exists, use its dim
+            if snap.embeddings.size == 0:
+                return np.zeros((0, 1))
+            return np.zeros((0, snap.embeddings.shape[1]))
+
+        texts = [embedding_text(b.title, b.author, b.description) for b in books]
+        keys = [(str(b.id), content_hash(t)) for b, t in zip(books, texts)]
+
+        vectors: List[Optional[np.ndarray]] = [None] * len(books)
+        # books already in the catalog with the same text reuse their catalog row
+        catalog_hits = 0
+        rows = snap.rows_of_ids([str(b.id) for b in books]).tolist()
+        for i, (row, t) in enumerate(zip(rows, texts)):
+            if row >= 0 and self._text_at(snap.books, row) == t:
+                vectors[i] = np.asarray(snap.embeddings[row])
+                catalog_hits += 1
+
+        with self._query_cache_lock:
+            self.query_cache_catalog_hits += catalog_hits
+            for i, k in enumerate(keys):
+                if vectors[i] is not None:
+                    continue
+                vec = self._query_cache.get(k)
+                if vec is not None:
+                    self._query_cache.move_to_end(k)
+                    vectors[i] = vec
+                    self.query_cache_hits += 1
+            missing = [i for i, v in enumerate(vectors) if v is None]
+            self.query_cache_misses += len(missing)
+
+        if missing:
+            fresh = self._encode_texts([texts[i] for i in missing])
+            with self._query_cache_lock:
+                for i, vec in zip(missing, fresh):
+                    vectors[i] = vec
+                    if self.query_cache_size > 0:
+                        self._query_cache[keys[i]] = vec
+                        self._query_cache.move_to_end(keys[i])
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+
+        return np.vstack(vectors)
+
+    def catalog_stats(self) -> Dict[str, Optional[float]]:
+        """Catalog size and ages in seconds; never triggers a load."""
+        snap = self._snapshot
+        now = time.time()
+        return {
+            "rows": len(snap) if snap is not None else 0,
+            "built_age": now - snap.built_at if snap is not None else None,
+            "refresh_age": now - self.refreshed_at if self.refreshed_at is not None else None,
+        }
 
-        if not self.catalog:
-            return {"similar": [], "novel": [], "genre_similar": []}
+    def query_cache_stats(self) -> Dict[str, int]:
+        with self._query_cache_lock:
+            return {
+                "hits": self.query_cache_hits,
+                "catalog_hits": self.query_cache_catalog_hits,
+                "misses": self.query_cache_misses,
+                "size": len(self._query_cache),
+                "capacity": self.query_cache_size,
+            }
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Indices of the k highest scores among rows allowed by mask, best first;
+        only the k winners get sorted.
+        """
+        cand = np.flatnonzero(mask) if mask is not None else np.arange(scores.shape[0])
+        n = cand.shape[0]
+        if k <= 0 or n == 0:
+            return np.empty(0, dtype=np.intp)
+        sub = scores[cand]
+        if k < n:
+            part = np.argpartition(-sub, k - 1)[:k]
+        else:
+            part = np.arange(n)
+        return cand[part[np.argsort(-sub[part], kind="stable")]]
 
+    @staticmethod
+    def _normalize_books(user_books: List[Book]) -> List[Book]:
         # user_books may be list of dicts; try to normalize
         norm_user_books: List[Book] = []
         for ub in user_books:
@@ -127,85 +498,166 @@ class EmbeddingService:
                     norm_user_books.append(Book(**ub))
                 except Exception:
                     continue
+        return norm_user_books
 
-        # if no user books provided — fall back to top popular (just top similar)
-        if not norm_user_books:
-            # return top-N catalog items as similar
-            top = [{
-                "title": b["title"], "author": b.get("author"), "year": b.get("year"), "description": b.get("description")
-            } for b in self.catalog[:similar_top]]
-            return {"similar": top, "novel": [], "genre_similar": []}
-
-        user_embs = self._encode_books(norm_user_books)  # shape (n_user, dim)
-        cat_embs = self._embeddings  # shape (N, dim)
-
-        # compute sims: for each catalog vector, max over user_embs
-        sims = []
-        for i, emb in enumerate(cat_embs):
-            if user_embs.size == 0:
-                sim = 0.0
-            else:
-                vals = (user_embs @ emb).squeeze()
-                sim = float(np.max(vals)) if np.size(vals) > 0 else 0.0
-            sims.append((i, sim))
-
-        sims.sort(key=lambda x: -x[1])
-
-        scored = []
-        for idx, sim in sims:
-            entry = dict(self.catalog[idx])
-            entry["similarity"] = sim
-            scored.append(entry)
+    def get_recommendations(
+        self,
+        user_books: List[Book],
+        similar_top: int = 10,
+        novel_top: int = 10,
+        genre_top: int = 10,
+        novel_sim_min: float = 0.55,
+        novel_sim_max: float = 0.75,
+        exclude_read: bool = True,
+        favorite_genres: int = 1,
+        exclude: Optional[List[Book]] = None
+    ):
+        params = {
+            "similar_top": similar_top, "novel_top": novel_top, "genre_top": genre_top,
+            "novel_sim_min": novel_sim_min, "novel_sim_max": novel_sim_max,
+            "exclude_read": exclude_read, "favorite_genres": favorite_genres, "exclude": exclude,
+        }
+        return self.get_recommendations_batch([(user_books, params)])[0]
 
-        # exclude read
-        read_keys = { (b.title or "").strip().lower() + "|||" + (b.author or "").strip().lower() for b in norm_user_books }
-        filtered = [b for b in scored if not (exclude_read and ((b.get("title") or "").strip().lower() + "|||" + (b.get("author") or "").strip().lower() in read_keys))]
+    def get_recommendations_batch(self, requests: List[Tuple[List[Book], Dict[str, Any]]]) -> List[Dict[str, List[dict]]]:
+        """
+        Recommendations for several users: (user_books, get_recommendations kwargs) pairs.
+        All read books go through the encoder in one pass and are scored against the
+        catalog in one matmul, selection then runs per user.
+        """
+        # ensure catalog loaded; the whole batch works on this one snapshot
+        snap = self._load_catalog()
 
-        similar_list = filtered[:similar_top]
+        if not len(snap):
+            return [{"similar": [], "novel": [], "genre_similar": []} for _ in requests]
 
-        similar_keys = { (b.get("title") or "").strip().lower() + "|||" + (b.get("author") or "").strip().lower() for b in similar_list }
+        normalized = [self._normalize_books(books) for books, _ in requests]
+        results: List[Optional[Dict[str, List[dict]]]] = [None] * len(requests)
 
-        novel_candidates = [
-            b for b in filtered
-            if (b["similarity"] >= novel_sim_min and b["similarity"] <= novel_sim_max)
-               and ((b.get("title") or "").strip().lower() + "|||" + (b.get("author") or "").strip().lower() not in similar_keys)
-        ]
-        novel_list = novel_candidates[:novel_top]
+        # if no user books provided — fall back to top popular (just top similar)
+        for i, books in enumerate(normalized):
+            if not books:
+                # return top-N catalog items as similar
+                top = [{
+                    "title": b["title"], "author": b.get("author"), "year": b.get("year"), "description": b.get("description")
+                } for b in snap.books[:requests[i][1].get("similar_top", 10)]]
+                results[i] = {"similar": top, "novel": [], "genre_similar": []}
+
+        scored = [i for i, books in enumerate(normalized) if books]
+        if scored:
+            all_books = [b for i in scored for b in normalized[i]]
+            with STAGE_SECONDS.time("encode"):
+                user_embs = self._encode_books(all_books, snap)  # shape (sum n_user, dim)
+            offsets = np.cumsum([0] + [len(normalized[i]) for i in scored[:-1]])
+            # per user (rows, max similarity to any of the user's read books): every row for
+            # exact search, only the rows an approximate index found otherwise
+            with STAGE_SECONDS.time("score"):
+                candidates = snap.retriever.candidates_batch(user_embs, offsets)
+            bounds = list(offsets) + [user_embs.shape[0]]
+            select_seconds = 0.0
+            for row, i in enumerate(scored):
+                with STAGE_SECONDS.time("genre_lookup"):
+                    genres_map = self._user_genres(snap, normalized[i])
+                start = time.perf_counter()
+                results[i] = self._select(
+                    snap, normalized[i], candidates[row], genres_map, **requests[i][1],
+                    queries=user_embs[bounds[row]:bounds[row + 1]]
+                )
+                select_seconds += time.perf_counter() - start
+            STAGE_SECONDS.observe("select", select_seconds)
+
+        return results
+
+    def _user_genres(self, snap: CatalogSnapshot, norm_user_books: List[Book]) -> Dict[str, Iterable[str]]:
+        # genres of the user's books come from the catalog key index,
+        # only books the snapshot does not know yet are looked up in the repo
+        user_keys = [book_key(ub.title, ub.author) for ub in norm_user_books]
+        genres_map = {k: g for k, g in ((k, snap.genres_of(k)) for k in user_keys) if g is not None}
+        missing = [{"title": ub.title, "author": ub.author}
+                   for ub, k in zip(norm_user_books, user_keys) if k not in genres_map]
+        if missing:
+            try:
+                genres_map.update(self.repo.get_genres_for_titles(missing))
+            except Exception:
+                pass
+        return genres_map
 
-        # genre logic: get genres for user_books via repo, determine favorite genre
-        titles_and_authors = [{"title": ub.title, "author": ub.author} for ub in norm_user_books]
-        try:
-            genres_map = self.repo.get_genres_for_titles(titles_and_authors)
-        except Exception:
-            genres_map = {}
+    def _select(
+        self,
+        snap: CatalogSnapshot,
+        norm_user_books: List[Book],
+        candidates: Tuple[Optional[np.ndarray], np.ndarray],
+        genres_map: Dict[str, Iterable[str]],
+        similar_top: int = 10,
+        novel_top: int = 10,
+        genre_top: int = 10,
+        novel_sim_min: float = 0.55,
+        novel_sim_max: float = 0.75,
+        exclude_read: bool = True,
+        favorite_genres: int = 1,
+        exclude: Optional[List[Book]] = None,
+        queries: Optional[np.ndarray] = None
+    ) -> Dict[str, List[dict]]:
+        # selection works on positions in the candidate rows and boolean masks over them
+        # (every catalog row for exact search); catalog dicts are copied for the returned rows alone
+        rows, sims = candidates
+        codes = snap.key_codes if rows is None else snap.key_codes[rows]
+        blocked = set()
+        if exclude_read:
+            blocked |= {book_key(b.title, b.author) for b in norm_user_books}
+        if exclude:
+            # e.g. books a validation client rejected
+            blocked |= {book_key(b.title, b.author) for b in self._normalize_books(exclude)}
+        blocked_codes = snap.key_codes_of(blocked)
+        allowed = ~np.isin(codes, blocked_codes)
+
+        similar_pos = self._top_k(sims, similar_top, allowed)
+        used = np.isin(codes, codes[similar_pos])
+
+        # an approximate retriever has only the rows near the reader's books unless
+        # band_candidates searches it deeper, see RetrievalConfig
+        band = (sims >= novel_sim_min) & (sims <= novel_sim_max)
+        novel_pos = self._top_k(sims, novel_top, allowed & band & ~used)
+
+        def catalog_rows(pos):
+            return pos if rows is None else rows[pos]
+
+        similar_idx, novel_idx = catalog_rows(similar_pos), catalog_rows(novel_pos)
 
         genre_counter = Counter()
         for ub in norm_user_books:
-            key = (ub.title or "").strip().lower() + "|||" + (ub.author or "").strip().lower()
-            gens = genres_map.get(key, [])
+            gens = genres_map.get(book_key(ub.title, ub.author), [])
             for g in gens:
                 genre_counter[g] += 1
 
-        favorite_genre = genre_counter.most_common(1)[0][0] if genre_counter else None
-
-        genre_similar_list = []
-        if favorite_genre:
-            used_keys = similar_keys.union(((b.get("title") or "").strip().lower() + "|||" + (b.get("author") or "").strip().lower()) for b in novel_list)
-            for b in filtered:
-                gens = b.get("genres") or []
-                if favorite_genre in gens:
-                    k = (b.get("title") or "").strip().lower() + "|||" + (b.get("author") or "").strip().lower()
-                    if k in used_keys:
-                        continue
-                    genre_similar_list.append(b)
-                    if len(genre_similar_list) >= genre_top:
-                        break
+        # favorite genres weighted by their share relative to the most common one;
+        # with a single genre this is a plain masked argmax over similarity
+        top_genres = genre_counter.most_common(favorite_genres)
+        genre_weights = {g: c / top_genres[0][1] for g, c in top_genres}
+
+        genre_idx = np.empty(0, dtype=np.intp)
+        if genre_weights:
+            used |= np.isin(codes, codes[novel_pos])
+            affinity = snap.genre_affinity(genre_weights, rows)
+            genre_pos = self._top_k(sims * affinity, genre_top, allowed & (affinity > 0) & ~used)
+            genre_idx = catalog_rows(genre_pos)
+
+            if rows is not None and len(genre_idx) < genre_top and queries is not None:
+                # the favorite genres barely reach the rows near the reader's books:
+                # a search restricted to them, bounded by the retriever
+                taken = np.concatenate([blocked_codes, codes[similar_pos], codes[novel_pos]])
+                depth = genre_top + len(taken)
+                g_rows, g_sims = snap.retriever.search_within(queries, snap.rows_in_genres(genre_weights), depth)
+                g_codes = snap.key_codes[g_rows]
+                g_pos = self._top_k(g_sims * snap.genre_affinity(genre_weights, g_rows), genre_top,
+                                    ~np.isin(g_codes, taken))
+                genre_idx = g_rows[g_pos]
 
         def clean(d):
             return {"id": d.get("id"), "title": d.get("title"), "author": d.get("author"), "genre": d.get("genre"), "year": d.get("year"), "description": d.get("description"), "cover": d.get("cover"), "pages": d.get("pages")}
 
         return {
-            "similar": [clean(b) for b in similar_list],
-            "novel": [clean(b) for b in novel_list],
-            "genre_similar": [clean(b) for b in genre_similar_list]
+            "similar": [clean(snap.books[i]) for i in similar_idx],
+            "novel": [clean(snap.books[i]) for i in novel_idx],
+            "genre_similar": [clean(snap.books[i]) for i in genre_idx]
         }
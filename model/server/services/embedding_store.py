@@ -0,0 +1,89 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+    _HAS_FCNTL = True
+except ImportError:
+    _HAS_FCNTL = False
+
+log = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> int:
+    """64-bit hash of the text a catalog row is encoded from."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class EmbeddingStore:
+    """
+    On-disk catalog embeddings: a float32 (N, dim) matrix, the row ids and a content hash
+    per row, each in its own .npy file, plus meta.json with the encoder and the version
+    of the embedding text schema the rows were built with.
+    The matrix is opened with mmap_mode="r", so workers on one host share its pages.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._matrix_file = os.path.join(path, "embeddings.npy")
+        self._ids_file = os.path.join(path, "ids.npy")
+        self._hashes_file = os.path.join(path, "hashes.npy")
+        self._meta_file = os.path.join(path, "meta.json")
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Exclusive lock around a rebuild, so parallel workers encode the catalog only once."""
+        os.makedirs(self.path, exist_ok=True)
+        if not _HAS_FCNTL:
+            yield
+            return
+        with open(os.path.join(self.path, ".lock"), "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def load(self, encoder: str, schema: int) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Returns (ids, hashes, matrix) or None if nothing usable is stored for this encoder and schema."""
+        try:
+            with open(self._meta_file, encoding="utf-8") as fh:
+                meta = json.load(fh)
+            if meta.get("encoder") != encoder or meta.get("schema") != schema:
+                log.info("Embedding store %s was built by %s (schema %s), ignoring",
+                         self.path, meta.get("encoder"), meta.get("schema"))
+                return None
+            ids = np.load(self._ids_file)
+            hashes = np.load(self._hashes_file)
+            matrix = np.load(self._matrix_file, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Embedding store %s is unreadable: %s", self.path, e)
+            return None
+
+        if not (len(ids) == len(hashes) == matrix.shape[0]):
+            log.warning("Embedding store %s is inconsistent, ignoring", self.path)
+            return None
+        return ids, hashes, matrix
+
+    def save(self, encoder: str, schema: int, ids: np.ndarray, hashes: np.ndarray, matrix: np.ndarray) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        # every file is written aside and renamed into place, meta.json goes last
+        for target, arr in ((self._matrix_file, np.asarray(matrix, dtype=np.float32)),
+                            (self._ids_file, ids),
+                            (self._hashes_file, hashes)):
+            tmp = target + ".tmp.npy"
+            np.save(tmp, arr)
+            os.replace(tmp, target)
+
+        tmp = self._meta_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"encoder": encoder, "schema": schema, "rows": int(matrix.shape[0]), "dim": int(matrix.shape[1])}, fh)
+        os.replace(tmp, self._meta_file)
@@ -0,0 +1,57 @@
+import asyncio
+import importlib.util
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from model.server.utils.metrics import REGISTRY
+
+
+class HttpClientPool:
+    """
+    One keep-alive httpx.AsyncClient for the whole app (validation dispatch to clients and
+    callbacks to the backend) instead of a new connection and TLS handshake per POST.
+    HTTP/2 is used when the h2 package is installed. Requests per destination host are
+    capped and their latency is recorded per host.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, per_host: int = 20,
+                 keepalive_expiry: float = 30.0):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.per_host = per_host
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self.latency = REGISTRY.histogram("http_client_request_seconds", "Outgoing HTTP request latency", ("host",))
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # used outside the app lifespan (scripts, tests)
+            self._client = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+        return self._client
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        host = urlsplit(url).netloc or url
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+
+        async with slots:
+            start = time.perf_counter()
+            try:
+                return await self.client.post(url, **kwargs)
+            finally:
+                self.latency.observe(host, time.perf_counter() - start)
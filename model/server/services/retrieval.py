@@ -0,0 +1,340 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+log = logging.getLogger(__name__)
+
+try:
+    import faiss
+    _HAS_FAISS = True
+except Exception:
+    _HAS_FAISS = False
+
+
+class RetrievalConfig(BaseModel):
+    # exact | hnsw | ivfpq
+    backend: str = "exact"
+    # rows fetched from an approximate index per read book
+    candidates: int = 200
+    # the novel similarity band lies below the nearest neighbours by design: above `candidates`
+    # the index is searched this deep for it. Off (0) by default, a search thousands of rows
+    # deep costs about as much as exact search. A favorite genre missing from the rows found
+    # is scored exactly up to this many rows, above that through a search restricted to the genre
+    band_candidates: int = 0
+    # HNSW graph degree, build-time and search-time beam width
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    # IVF lists (0 = 4 * sqrt(N)), lists probed per query, PQ sub-quantizers (0 = dim / 8)
+    nlist: int = 0
+    nprobe: int = 16
+    pq_m: int = 0
+    # storage of the exact search matrix: float32 | float16 | int8 (per-row scale);
+    # the best `rescore` rows per user are then rescored against the float32 matrix.
+    # Only used when that matrix is memory-mapped from the embedding store
+    dtype: str = "float32"
+    rescore: int = 200
+
+
+def _single(queries: np.ndarray) -> np.ndarray:
+    return np.zeros(1 if queries.size else 0, dtype=np.intp)
+
+
+def _is_mapped(a: np.ndarray) -> bool:
+    # memory-mapped from a file (the embedding store), directly or as a view of a mapping
+    while a is not None:
+        if isinstance(a, (np.memmap, mmap.mmap)):
+            return True
+        a = getattr(a, "base", None)
+    return False
+
+
+def quantize(embeddings: np.ndarray, dtype: str, chunk_rows: int = 32768) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    (matrix, per-row scale) in the given storage dtype; scale is None except for int8,
+    where row i is approximately matrix[i] * scale[i]. Converted block by block,
+    so a memory-mapped float32 matrix is never materialized whole.
+    """
+    if dtype == "float32":
+        return np.asarray(embeddings, dtype=np.float32), None
+    if dtype == "float16":
+        return np.asarray(embeddings, dtype=np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"Unknown embedding dtype {dtype!r}")
+
+    n = embeddings.shape[0]
+    codes = np.empty(embeddings.shape, dtype=np.int8)
+    scale = np.empty(n, dtype=np.float32)
+    for start in range(0, n, chunk_rows):
+        block = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float32)
+        s = np.abs(block).max(axis=1) / 127
+        s[s == 0] = 1
+        codes[start:start + block.shape[0]] = np.rint(block / s[:, None])
+        scale[start:start + block.shape[0]] = s
+    return codes, scale
+
+
+class ExactRetriever:
+    """
+    Brute-force cosine search: matmul over the whole (normalized) catalog matrix.
+    With a float16 or int8 dtype the scan runs over the quantized copy (each block is widened
+    to float32 for BLAS) and the best `rescore` rows per user are rescored exactly against
+    the float32 matrix, which is memory-mapped from the embedding store, so only those rows
+    are paged in. A float32 matrix on the heap (no store) stays resident anyway, so a
+    quantized copy would only add to it: such a matrix is scanned as float32.
+    """
+
+    backend = "exact"
+    # catalog rows per matmul block, bounds the (rows, n_queries) temporary
+    chunk_rows = 32768
+
+    def __init__(self, embeddings: np.ndarray, dtype: str = "float32", rescore: int = 200,
+                 quantized: Optional[Tuple[np.ndarray, Optional[np.ndarray]]] = None):
+        if dtype != "float32" and quantized is None and not _is_mapped(embeddings):
+            log.info("Catalog matrix is not memory-mapped, scanning it as float32 instead of %s", dtype)
+            dtype = "float32"
+        self.embeddings = embeddings
+        self.dtype = dtype
+        self.rescore = rescore
+        # for float32 this is the catalog matrix itself, not a copy
+        self.matrix, self.scale = quantized or quantize(embeddings, dtype, self.chunk_rows)
+
+    @property
+    def resident_bytes(self) -> int:
+        """Heap memory of the search: the quantized copy plus the float32 matrix unless it is mapped."""
+        size = 0 if _is_mapped(self.embeddings) else self.embeddings.nbytes
+        if self.matrix is not self.embeddings and not _is_mapped(self.matrix):
+            size += self.matrix.nbytes
+        return size + (self.scale.nbytes if self.scale is not None else 0)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Max similarity of every catalog row to the queries, shape (N,)."""
+        if queries.size == 0 or self.embeddings.size == 0:
+            return np.zeros(self.embeddings.shape[0], dtype=np.float32)
+        return self.scores_batch(queries, _single(queries))[0]
+
+    def scores_batch(self, queries: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Scores for several users at once: queries holds every user's books back to back,
+        offsets the index of each user's first row. One (rows, dim) @ (dim, n_queries)
+        product per block, max-reduced per user; shape (n_users, N).
+        """
+        n = self.matrix.shape[0]
+        queries = np.asarray(queries, dtype=np.float32)
+        out = np.empty((len(offsets), n), dtype=np.float32)
+        for start in range(0, n, self.chunk_rows):
+            block = np.asarray(self.matrix[start:start + self.chunk_rows], dtype=np.float32) @ queries.T
+            if self.scale is not None:
+                block *= self.scale[start:start + block.shape[0], None]
+            out[:, start:start + block.shape[0]] = np.maximum.reduceat(block, offsets, axis=1).T
+
+        if self.dtype != "float32" and self.rescore > 0:
+            self._rescore(out, queries, offsets)
+        return out
+
+    def candidates_batch(self, queries: np.ndarray, offsets: np.ndarray) -> List[Tuple[Optional[np.ndarray], np.ndarray]]:
+        """Per user (rows, scores) as FaissRetriever returns them; rows is None: every catalog row is scored."""
+        return [(None, s) for s in self.scores_batch(queries, offsets)]
+
+    def _rescore(self, out: np.ndarray, queries: np.ndarray, offsets: np.ndarray):
+        k = min(self.rescore, out.shape[1])
+        if k == 0:
+            return
+        bounds = list(offsets) + [queries.shape[0]]
+        for u in range(len(offsets)):
+            # sorted rows read the memory-mapped matrix front to back
+            cand = np.sort(np.argpartition(-out[u], k - 1)[:k])
+            out[u, cand] = (np.asarray(self.embeddings[cand], dtype=np.float32) @ queries[bounds[u]:bounds[u + 1]].T).max(axis=1)
+
+    def extend(self, embeddings: np.ndarray) -> "ExactRetriever":
+        if self.dtype == "float32" or not _is_mapped(embeddings):
+            # the new matrix is searched as is, nothing to carry over
+            return ExactRetriever(embeddings, self.dtype, self.rescore)
+        # only the appended rows are quantized
+        added, added_scale = quantize(embeddings[self.matrix.shape[0]:], self.dtype, self.chunk_rows)
+        matrix = np.concatenate([self.matrix, added])
+        scale = np.concatenate([self.scale, added_scale]) if self.scale is not None else None
+        return ExactRetriever(embeddings, self.dtype, self.rescore, (matrix, scale))
+
+    def save(self, cache_dir: str, embeddings: np.ndarray) -> None:
+        pass
+
+
+class FaissRetriever:
+    """
+    Approximate search through a FAISS HNSW or IVF-PQ index. candidates_batch returns per user
+    only the rows the index found near the user's read books, with their exact scores against
+    the catalog matrix (so PQ distortion does not reach the ranking); nothing is allocated per
+    catalog row. It searches `band_candidates` deep for the novel band when that is set; rows
+    below the search depth are never seen, so a band far from the reader's books can come up short.
+    """
+
+    def __init__(self, index, embeddings: np.ndarray, config: RetrievalConfig):
+        self.index = index
+        self.embeddings = embeddings
+        self.config = config
+        self.backend = config.backend
+        self._apply_search_params()
+
+    def _apply_search_params(self):
+        if self.backend == "hnsw":
+            self.index.hnsw.efSearch = max(self.config.ef_search, self.config.candidates)
+        else:
+            self.index.nprobe = self.config.nprobe
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        if queries.size == 0 or self.index.ntotal == 0:
+            return np.full(self.index.ntotal, -np.inf, dtype=np.float32)
+        return self.scores_batch(queries, _single(queries))[0]
+
+    def scores_batch(self, queries: np.ndarray, offsets: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+        """Dense (n_users, N) view of the `candidates` nearest rows, -inf elsewhere; for benchmarks."""
+        out = np.full((len(offsets), self.index.ntotal), -np.inf, dtype=np.float32)
+        for u, (rows, scores) in enumerate(self._candidates(queries, offsets, k or self.config.candidates)):
+            out[u, rows] = scores
+        return out
+
+    def candidates_batch(self, queries: np.ndarray, offsets: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Per user (sorted rows, exact scores), `max(candidates, band_candidates)` rows per read book."""
+        return self._candidates(queries, offsets, max(self.config.candidates, self.config.band_candidates))
+
+    def search_within(self, queries: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (rows, scores) of the best of the given sorted catalog rows for the queries: all of them,
+        scored exactly, when there are at most `band_candidates`, otherwise the k nearest found
+        through the index restricted to those rows.
+        """
+        if len(rows) <= max(k, self.config.band_candidates):
+            return rows, self._score(rows, queries)
+        selector = faiss.IDSelectorBatch(np.ascontiguousarray(rows, dtype=np.int64))
+        if self.backend == "hnsw":
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(self.index.hnsw.efSearch, k))
+        else:
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.config.nprobe)
+        _, found = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k, params=params)
+        cand = np.unique(found[found >= 0])
+        return cand, self._score(cand, queries)
+
+    def _candidates(self, queries: np.ndarray, offsets: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # one index search for all users' queries, then a per-user union and rescoring
+        k = min(k, self.index.ntotal)
+        if queries.size == 0 or k == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in offsets]
+        search = {}
+        if self.backend == "hnsw" and k > self.index.hnsw.efSearch:
+            # per call, the shared index keeps its efSearch for concurrent searches
+            search["params"] = faiss.SearchParametersHNSW(efSearch=k)
+        _, rows = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k, **search)
+        bounds = list(offsets) + [queries.shape[0]]
+        res = []
+        for u in range(len(offsets)):
+            lo, hi = bounds[u], bounds[u + 1]
+            found = rows[lo:hi]
+            cand = np.unique(found[found >= 0])
+            res.append((cand, self._score(cand, queries[lo:hi])))
+        return res
+
+    def _score(self, rows: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        # sorted rows read a memory-mapped matrix front to back
+        return (np.asarray(self.embeddings[rows], dtype=np.float32) @ np.asarray(queries, dtype=np.float32).T).max(axis=1)
+
+    def extend(self, embeddings: np.ndarray) -> "FaissRetriever":
+        """New retriever over the grown matrix; the current index stays untouched for readers."""
+        index = faiss.clone_index(self.index)
+        index.add(np.ascontiguousarray(embeddings[index.ntotal:], dtype=np.float32))
+        return FaissRetriever(index, embeddings, self.config)
+
+    def save(self, cache_dir: str, embeddings: np.ndarray) -> None:
+        """Writes the index next to a sidecar with the matrix fingerprint and build parameters."""
+        index_file, meta_file = _index_files(cache_dir, self.config)
+        os.makedirs(cache_dir, exist_ok=True)
+        faiss.write_index(self.index, index_file + ".tmp")
+        os.replace(index_file + ".tmp", index_file)
+        with open(meta_file, "w", encoding="utf-8") as fh:
+            json.dump({"fingerprint": _fingerprint(embeddings), "params": _build_params(self.config)}, fh)
+
+
+def _index_files(cache_dir: str, config: RetrievalConfig):
+    index_file = os.path.join(cache_dir, f"index.{config.backend}.faiss")
+    return index_file, index_file + ".json"
+
+
+def _build_params(config: RetrievalConfig) -> dict:
+    return config.model_dump(include={"backend", "hnsw_m", "ef_construction", "nlist", "pq_m"})
+
+
+def _fingerprint(embeddings: np.ndarray) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(embeddings.shape).encode())
+    h.update(np.ascontiguousarray(embeddings, dtype=np.float32).data)
+    return h.hexdigest()
+
+
+def _build_faiss_index(embeddings: np.ndarray, config: RetrievalConfig):
+    n, dim = embeddings.shape
+    data = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    if config.backend == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.ef_construction
+        index.add(data)
+        return index
+
+    nlist = config.nlist or int(4 * np.sqrt(n))
+    pq_m = config.pq_m or max(1, dim // 8)
+    # IVF-PQ needs enough rows to train the coarse and the 8-bit product quantizers
+    if n < max(nlist * 39, 256) or dim % pq_m:
+        return None
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    index.train(data)
+    index.add(data)
+    return index
+
+
+def build_retriever(embeddings: np.ndarray, config: RetrievalConfig, cache_dir: Optional[str] = None):
+    """
+    Retriever for the catalog matrix. An approximate index is loaded from cache_dir when it
+    was built from the same matrix with the same build parameters, otherwise it is rebuilt
+    and saved there. Falls back to exact search if FAISS is missing or the catalog is too small.
+    """
+    def exact():
+        return ExactRetriever(embeddings, config.dtype, config.rescore)
+
+    if config.backend == "exact" or embeddings.size == 0:
+        return exact()
+    if config.backend not in ("hnsw", "ivfpq"):
+        log.warning("Unknown retrieval backend %r, using exact search", config.backend)
+        return exact()
+    if not _HAS_FAISS:
+        log.warning("faiss is not installed, using exact search")
+        return exact()
+
+    if cache_dir:
+        index_file, meta_file = _index_files(cache_dir, config)
+        try:
+            with open(meta_file, encoding="utf-8") as fh:
+                meta = json.load(fh)
+            if meta.get("params") == _build_params(config) and meta.get("fingerprint") == _fingerprint(embeddings):
+                log.info("Loaded %s index from %s", config.backend, index_file)
+                return FaissRetriever(faiss.read_index(index_file), embeddings, config)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Cannot load %s: %s", index_file, e)
+
+    index = _build_faiss_index(embeddings, config)
+    if index is None:
+        log.info("Catalog too small for %s, using exact search", config.backend)
+        return exact()
+
+    retriever = FaissRetriever(index, embeddings, config)
+    if cache_dir:
+        retriever.save(cache_dir, embeddings)
+    return retriever
@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class PoolSaturated(Exception):
+    """All workers are busy and the waiting queue is full."""
+
+
+class ScoringPool:
+    """
+    Bounded thread pool for blocking recommendation work (model encoding, NumPy scoring,
+    psycopg2 queries), so it never runs on the event loop.
+    Admission control: at most `workers` jobs run and `queue_size` more wait,
+    anything beyond that is rejected with PoolSaturated instead of piling up.
+    """
+
+    def __init__(self, workers: int = 2, queue_size: int = 16):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scoring")
+        # only touched from the event loop thread
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if self._pending >= self.workers + self.queue_size:
+            raise PoolSaturated()
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,40 +1,66 @@
+import time
 import uuid
 from datetime import datetime, timezone
-from typing import Optional, List
+from typing import Optional, List, Dict
 
-from model.server.models import Task, GenerationRequest
+from model.server.models import Task, TaskRecord, GenerationRequest
 from model.server.models import BackendGenerationRequest as BackendReq  # убедись path корректен
+from .task_store import BaseTaskStore, MemoryTaskStore
 
 
 class TaskManager:
-    def __init__(self):
-        self.tasks: dict[str, Task] = {}
+    """
+    Задачи генерации поверх хранилища: MemoryTaskStore для одного процесса,
+    RedisTaskStore — когда задачу создаёт один воркер, а /generate/result приходит в другой.
+    Переходы статусов атомарны, поэтому завершить задачу (и отправить callback) можно только один раз.
+    """
 
-    def create(self, req: BackendReq) -> Task:
+    def __init__(self, store: Optional[BaseTaskStore] = None):
+        self.store = store or MemoryTaskStore()
+
+    def create(self, req: BackendReq, result: Optional[list] = None) -> Task:
         # BackendReq содержит userId, books, callbackUrl, requestId
         # GenerationRequest в модели Task ожидает поле books: List[Book], count: Optional[int]
         gen_req = GenerationRequest(books=req.books, count=getattr(req, "count", None))
 
-        t = Task(task_id=str(uuid.uuid4()), request=gen_req)
+        t = Task(task_id=str(uuid.uuid4()), request=gen_req, result=result)
         # сохраняем также метаданные
-        t.backend_request_id = getattr(req, "requestId", None)
+        t.backend_request_id = str(req.requestId) if getattr(req, "requestId", None) is not None else None
         t.backend_user_id = getattr(req, "userId", None)
         t.backend_callback = getattr(req, "callbackUrl", None)
-        self.tasks[t.task_id] = t
+
+        self.store.add(t)
         return t
 
     def get(self, task_id: str) -> Optional[Task]:
-        return self.tasks.get(task_id, None)
+        """Активная задача целиком; для завершённых см. get_record."""
+        return self.store.get(task_id)
+
+    def get_record(self, task_id: str) -> Optional[TaskRecord]:
+        return self.store.get_record(task_id)
+
+    def find_by_request(self, backend_request_id: str) -> Optional[TaskRecord]:
+        return self.store.find_by_request(str(backend_request_id))
+
+    def set_status(self, task_id: str, status: str, result: Optional[list] = None) -> bool:
+        return self.store.transition(task_id, status, result=result)
+
+    def dispatched(self, task_id: str, address: str) -> bool:
+        """Задача ушла на валидацию клиенту address: статус processing и время отправки."""
+        return self.store.transition(task_id, "processing", dispatched_at=time.time(), dispatched_to=address)
 
     def complete(self, task_id: str, result: List[dict]) -> bool:
-        task = self.get(task_id)
-        if not task:
-            return False
-        task.result = result
-        task.status = "done"
-        task.completed_at = datetime.now(timezone.utc).isoformat()
-        return True
+        """False, если задачи нет или её уже завершил другой запрос/воркер."""
+        return self.store.transition(
+            task_id, "done", result=result, completed_at=datetime.now(timezone.utc).isoformat()
+        )
+
+    def by_status(self, status: str) -> List[TaskRecord]:
+        return self.store.by_status(status)
+
+    def counts(self) -> Dict[str, int]:
+        return self.store.counts()
 
     def all(self) -> list:
-        # возвращаем serializable представление
-        return [t.model_dump() for t in self.tasks.values()]
+        # компактное serializable представление, без запросов и результатов
+        return [r.model_dump() for r in self.store.all()]
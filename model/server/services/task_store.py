@@ -0,0 +1,351 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict, Set, Iterable
+
+import redis
+
+from model.server.models import Task, TaskRecord
+
+# статусы, из которых задача ещё может перейти в другой
+ACTIVE_STATUSES = ("queued", "processing")
+
+
+class BaseTaskStore:
+    def add(self, task: Task) -> None: ...
+    def get(self, task_id: str) -> Optional[Task]: ...
+    def get_record(self, task_id: str) -> Optional[TaskRecord]: ...
+    def find_by_request(self, backend_request_id: str) -> Optional[TaskRecord]: ...
+    def transition(self, task_id: str, to_status: str, from_statuses: Iterable[str] = ACTIVE_STATUSES,
+                   result: Optional[list] = None, completed_at: Optional[str] = None,
+                   dispatched_at: Optional[float] = None, dispatched_to: Optional[str] = None) -> bool: ...
+    def by_status(self, status: str) -> List[TaskRecord]: ...
+    def counts(self) -> Dict[str, int]: ...
+    def all(self) -> List[TaskRecord]: ...
+
+
+class MemoryTaskStore(BaseTaskStore):
+    """
+    Активные задачи (queued/processing) хранятся целиком, завершённые — только компактной
+    записью TaskRecord в LRU с TTL и ограничением по размеру.
+    Индексы по статусу и по backend_request_id позволяют не перебирать все задачи.
+    """
+
+    def __init__(self, finished_ttl: float = 3600, max_finished: int = 10000, active_ttl: float = 3600):
+        self.tasks: dict[str, Task] = {}
+        self.finished: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self.finished_ttl = finished_ttl
+        self.max_finished = max_finished
+        # задачи, по которым клиент так и не ответил, тоже не живут вечно
+        self.active_ttl = active_ttl
+
+        self._by_status: Dict[str, Set[str]] = {}
+        self._by_request: Dict[str, str] = {}
+        # monotonic-время, после которого запись удаляется
+        self._expires: Dict[str, float] = {}
+
+    def add(self, task: Task) -> None:
+        self._evict()
+        self.tasks[task.task_id] = task
+        self._expires[task.task_id] = time.monotonic() + self.active_ttl
+        self._by_status.setdefault(task.status, set()).add(task.task_id)
+        if task.backend_request_id:
+            self._by_request[task.backend_request_id] = task.task_id
+
+    def get(self, task_id: str) -> Optional[Task]:
+        return self.tasks.get(task_id, None)
+
+    def get_record(self, task_id: str) -> Optional[TaskRecord]:
+        task = self.tasks.get(task_id)
+        if task is not None:
+            return TaskRecord.of(task)
+        return self.finished.get(task_id)
+
+    def find_by_request(self, backend_request_id: str) -> Optional[TaskRecord]:
+        task_id = self._by_request.get(str(backend_request_id))
+        return self.get_record(task_id) if task_id else None
+
+    def transition(self, task_id: str, to_status: str, from_statuses: Iterable[str] = ACTIVE_STATUSES,
+                   result: Optional[list] = None, completed_at: Optional[str] = None,
+                   dispatched_at: Optional[float] = None, dispatched_to: Optional[str] = None) -> bool:
+        task = self.tasks.get(task_id)
+        if task is None or task.status not in from_statuses:
+            return False
+
+        self._unindex_status(task_id, task.status)
+        task.status = to_status
+        if result is not None:
+            task.result = result
+        if completed_at is not None:
+            task.completed_at = completed_at
+        if dispatched_at is not None:
+            task.dispatched_at, task.dispatched_to = dispatched_at, dispatched_to
+
+        if to_status in ACTIVE_STATUSES:
+            self._by_status.setdefault(to_status, set()).add(task_id)
+            return True
+
+        self.tasks.pop(task_id, None)
+        self.finished[task_id] = TaskRecord.of(task)
+        self.finished.move_to_end(task_id)
+        self._expires[task_id] = time.monotonic() + self.finished_ttl
+        self._by_status.setdefault(to_status, set()).add(task_id)
+        self._evict()
+        return True
+
+    def by_status(self, status: str) -> List[TaskRecord]:
+        self._evict()
+        return [r for r in (self.get_record(i) for i in list(self._by_status.get(status, ()))) if r]
+
+    def counts(self) -> Dict[str, int]:
+        self._evict()
+        return {status: len(ids) for status, ids in self._by_status.items() if ids}
+
+    def all(self) -> List[TaskRecord]:
+        self._evict()
+        return [TaskRecord.of(t) for t in self.tasks.values()] + list(self.finished.values())
+
+    def _evict(self):
+        now = time.monotonic()
+
+        # завершённые упорядочены по времени завершения — снимаем с головы
+        while self.finished:
+            task_id, record = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_finished and self._expires.get(task_id, 0) > now:
+                break
+            self.finished.popitem(last=False)
+            self._drop(task_id, record.status, record.backend_request_id)
+
+        # активные упорядочены по времени создания
+        while self.tasks:
+            task_id, task = next(iter(self.tasks.items()))
+            if self._expires.get(task_id, 0) > now:
+                break
+            self.tasks.pop(task_id)
+            self._drop(task_id, task.status, task.backend_request_id)
+
+    def _unindex_status(self, task_id: str, status: str):
+        ids = self._by_status.get(status)
+        if ids is not None:
+            ids.discard(task_id)
+
+    def _drop(self, task_id: str, status: str, backend_request_id: Optional[str]):
+        self._unindex_status(task_id, status)
+        self._expires.pop(task_id, None)
+        if backend_request_id and self._by_request.get(backend_request_id) == task_id:
+            del self._by_request[backend_request_id]
+
+
+# Every key the script touches comes in KEYS, all under the {tasks} hash tag, so they share
+# one cluster slot. Trimming the finished set would need the keys of the evicted tasks, which
+# are only known inside the script: it pops them and returns them, and the caller deletes
+# their keys (a task that is not cleaned up still expires by its own TTL).
+# KEYS: task hash, to-status zset, finished zset, set of known statuses,
+#       zset of each allowed from-status in the order of ARGV[12..]
+# ARGV: task_id, to_status, now (unix), active ttl, finished ttl, max finished,
+#       result json or "", completed_at or "", result size, dispatched_at or "", dispatched_to,
+#       allowed from-statuses...
+# Returns false when the transition is not allowed, otherwise {evicted ids, known statuses}.
+_TRANSITION_LUA = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if not status then return false end
+local from = nil
+for i = 12, #ARGV do
+  if ARGV[i] == status then from = KEYS[i - 7] end
+end
+if not from then return false end
+
+local now = tonumber(ARGV[3])
+redis.call('ZREM', from, ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[2])
+redis.call('HSET', KEYS[1], 'status', ARGV[2])
+if ARGV[7] ~= '' then
+  redis.call('HSET', KEYS[1], 'result', ARGV[7], 'result_size', ARGV[9])
+end
+if ARGV[8] ~= '' then redis.call('HSET', KEYS[1], 'completed_at', ARGV[8]) end
+if ARGV[10] ~= '' then redis.call('HSET', KEYS[1], 'dispatched_at', ARGV[10], 'dispatched_to', ARGV[11]) end
+
+if ARGV[2] == 'queued' or ARGV[2] == 'processing' then
+  redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+  redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[1])
+  return {{}, {}}
+end
+
+-- finished: keep only the compact record, bounded by TTL and count
+redis.call('HDEL', KEYS[1], 'request', 'result', 'callback', 'dispatched_at', 'dispatched_to')
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[5]))
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[1])
+redis.call('ZADD', KEYS[3], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - tonumber(ARGV[5]))
+local evicted = {}
+local excess = redis.call('ZCARD', KEYS[3]) - tonumber(ARGV[6])
+if excess > 0 then
+  local old = redis.call('ZPOPMIN', KEYS[3], excess)
+  for i = 1, #old, 2 do evicted[#evicted + 1] = old[i] end
+  return {evicted, redis.call('SMEMBERS', KEYS[4])}
+end
+return {evicted, {}}
+"""
+
+# общий hash tag: ключи задач в одном слоте Redis Cluster, как того требуют Lua-скрипт и MULTI
+PREFIX = "{tasks}"
+STATUSES_KEY = f"{PREFIX}:statuses"
+FINISHED_KEY = f"{PREFIX}:finished"
+
+
+class RedisTaskStore(BaseTaskStore):
+    """
+    Задачи в Redis, общие для всех воркеров и хостов:
+      {tasks}:task:<id>                 hash (полная задача пока активна, компактная запись после)
+      {tasks}:by_status:<status>        zset id задач, score — unix-время истечения ключа задачи
+      {tasks}:statuses                  set статусов, которые встречались (вместо SCAN по ключам)
+      {tasks}:request:<id>              backend_request_id -> task_id
+      {tasks}:finished                  zset завершённых задач по времени, для ограничения размера
+    Запись — одним pipeline, смена статуса — атомарно Lua-скриптом. Задача, чей ключ истёк
+    по TTL, выпадает из индекса статусов по score, без отдельной чистки.
+    """
+
+    def __init__(self, host: str, port: int, password: Optional[str] = None,
+                 finished_ttl: float = 3600, max_finished: int = 10000, active_ttl: float = 3600,
+                 client: Optional[redis.Redis] = None):
+        # client — готовое соединение (например, fakeredis в проверках)
+        self.redis = client or redis.Redis(host=host, port=port, password=password, decode_responses=True)
+        self.finished_ttl = int(finished_ttl)
+        self.max_finished = max_finished
+        self.active_ttl = int(active_ttl)
+        self._transition = self.redis.register_script(_TRANSITION_LUA)
+
+    @staticmethod
+    def _key(task_id: str) -> str:
+        return f"{PREFIX}:task:{task_id}"
+
+    @staticmethod
+    def _status_key(status: str) -> str:
+        return f"{PREFIX}:by_status:{status}"
+
+    @staticmethod
+    def _request_key(backend_request_id: str) -> str:
+        return f"{PREFIX}:request:{backend_request_id}"
+
+    def add(self, task: Task) -> None:
+        fields = {
+            "task_id": task.task_id,
+            "status": task.status,
+            "created_at": task.created_at,
+            "request": task.request.model_dump_json() if task.request else "",
+            "result": json.dumps(task.result, default=str) if task.result is not None else "",
+            "result_size": TaskRecord.size_of(task.result),
+            "callback": task.backend_callback or "",
+            "backend_request_id": task.backend_request_id or "",
+            "backend_user_id": str(task.backend_user_id) if task.backend_user_id is not None else "",
+        }
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self._key(task.task_id), mapping=fields)
+        pipe.expire(self._key(task.task_id), self.active_ttl)
+        pipe.zadd(self._status_key(task.status), {task.task_id: time.time() + self.active_ttl})
+        pipe.sadd(STATUSES_KEY, task.status)
+        if task.backend_request_id:
+            pipe.set(self._request_key(task.backend_request_id), task.task_id,
+                     ex=self.active_ttl + self.finished_ttl)
+        pipe.execute()
+
+    def get(self, task_id: str) -> Optional[Task]:
+        raw = self.redis.hgetall(self._key(task_id))
+        if not raw or raw.get("status") not in ACTIVE_STATUSES:
+            return None
+        return Task(
+            task_id=raw["task_id"],
+            status=raw["status"],
+            created_at=raw["created_at"],
+            completed_at=raw.get("completed_at") or None,
+            request=json.loads(raw["request"]) if raw.get("request") else None,
+            result=json.loads(raw["result"]) if raw.get("result") else None,
+            backend_callback=raw.get("callback") or None,
+            backend_request_id=raw.get("backend_request_id") or None,
+            backend_user_id=raw.get("backend_user_id") or None,
+            dispatched_at=float(raw["dispatched_at"]) if raw.get("dispatched_at") else None,
+            dispatched_to=raw.get("dispatched_to") or None,
+        )
+
+    @staticmethod
+    def _record(raw: Dict[str, str]) -> TaskRecord:
+        return TaskRecord(
+            task_id=raw["task_id"],
+            status=raw["status"],
+            created_at=raw["created_at"],
+            completed_at=raw.get("completed_at") or None,
+            backend_request_id=raw.get("backend_request_id") or None,
+            backend_user_id=raw.get("backend_user_id") or None,
+            result_size=int(raw.get("result_size") or 0),
+        )
+
+    def _records(self, task_ids: List[str]) -> List[TaskRecord]:
+        fields = ("task_id", "status", "created_at", "completed_at", "backend_request_id",
+                  "backend_user_id", "result_size")
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hmget(self._key(task_id), fields)
+        records = []
+        for values in pipe.execute():
+            if values[0] is not None:
+                records.append(self._record(dict(zip(fields, values))))
+        return records
+
+    def get_record(self, task_id: str) -> Optional[TaskRecord]:
+        records = self._records([task_id])
+        return records[0] if records else None
+
+    def find_by_request(self, backend_request_id: str) -> Optional[TaskRecord]:
+        task_id = self.redis.get(self._request_key(backend_request_id))
+        return self.get_record(task_id) if task_id else None
+
+    def transition(self, task_id: str, to_status: str, from_statuses: Iterable[str] = ACTIVE_STATUSES,
+                   result: Optional[list] = None, completed_at: Optional[str] = None,
+                   dispatched_at: Optional[float] = None, dispatched_to: Optional[str] = None) -> bool:
+        from_statuses = list(from_statuses)
+        res = self._transition(
+            keys=[self._key(task_id), self._status_key(to_status), FINISHED_KEY, STATUSES_KEY,
+                  *(self._status_key(s) for s in from_statuses)],
+            args=[task_id, to_status, time.time(), self.active_ttl, self.finished_ttl, self.max_finished,
+                  json.dumps(result, default=str) if result is not None else "", completed_at or "",
+                  TaskRecord.size_of(result), repr(dispatched_at) if dispatched_at is not None else "",
+                  dispatched_to or "", *from_statuses],
+        )
+        if not res:
+            return False
+
+        evicted, statuses = res
+        if evicted:
+            # вытесненные скриптом завершённые задачи
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(*(self._key(i) for i in evicted))
+            for status in statuses:
+                pipe.zrem(self._status_key(status), *evicted)
+            pipe.execute()
+        return True
+
+    def by_status(self, status: str) -> List[TaskRecord]:
+        key = self._status_key(status)
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        # id задач с истёкшим ключом убираем из индекса здесь же
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zrangebyscore(key, now, "+inf")
+        task_ids = pipe.execute()[1]
+        return [r for r in self._records(task_ids) if r.status == status]
+
+    def counts(self) -> Dict[str, int]:
+        statuses = sorted(self.redis.smembers(STATUSES_KEY))
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for status in statuses:
+            pipe.zremrangebyscore(self._status_key(status), "-inf", now)
+            pipe.zcard(self._status_key(status))
+        res = pipe.execute()[1::2]
+        return {status: n for status, n in zip(statuses, res) if n}
+
+    def all(self) -> List[TaskRecord]:
+        records = []
+        for status in sorted(self.redis.smembers(STATUSES_KEY)):
+            records.extend(self.by_status(status))
+        return records
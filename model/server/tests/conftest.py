@@ -0,0 +1,66 @@
+"""
+Store fixtures run every test against both backends: the in-process memory stores and the
+Redis stores over fakeredis with its Lua runtime (requirements-test.txt); the redis variant
+is skipped when it is not installed. The make_redis_* fixtures are for redis-only tests.
+"""
+import pytest
+
+from model.server.services.client_manager import ClientManager, RedisClientManager
+from model.server.services.client_store import MemoryClientStore, RedisClientStore
+from model.server.services.task_store import MemoryTaskStore, RedisTaskStore
+
+
+@pytest.fixture
+def redis_client():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def make_redis_task_store(redis_client):
+    def make(**kw) -> RedisTaskStore:
+        return RedisTaskStore("", 0, client=redis_client, **kw)
+    return make
+
+
+@pytest.fixture
+def make_redis_client_store(redis_client):
+    def make(**kw) -> RedisClientStore:
+        return RedisClientStore("", 0, client=redis_client, **kw)
+    return make
+
+
+@pytest.fixture
+def make_task_store(backend, request):
+    if backend == "redis":
+        return request.getfixturevalue("make_redis_task_store")
+    return lambda **kw: MemoryTaskStore(**kw)
+
+
+@pytest.fixture
+def make_client_store(backend, request):
+    if backend == "redis":
+        return request.getfixturevalue("make_redis_client_store")
+    return lambda **kw: MemoryClientStore(**kw)
+
+
+@pytest.fixture
+def make_client_managers(backend, request):
+    if backend == "redis":
+        make_store = request.getfixturevalue("make_redis_client_store")
+
+        # воркеры с общим redis
+        def make(n: int):
+            return [RedisClientManager(make_store(), lease_ttl=60, poll_interval=0.05) for _ in range(n)]
+        return make
+
+    # в памяти слоты не разделить между процессами: все «воркеры» — один менеджер
+    def make(n: int):
+        return [ClientManager(MemoryClientStore(), lease_ttl=60)] * n
+    return make
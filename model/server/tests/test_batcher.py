@@ -0,0 +1,36 @@
+"""
+RecommendationBatcher: concurrent requests share one batch, the running batch is referenced
+until it finishes.
+"""
+import asyncio
+import gc
+
+from model.server.services.batcher import RecommendationBatcher
+from model.server.services.scoring_pool import ScoringPool
+
+
+class StubService:
+    def __init__(self):
+        self.batches = []
+
+    def get_recommendations_batch(self, requests):
+        self.batches.append(len(requests))
+        return [{"similar": [books]} for books, _ in requests]
+
+
+def test_batch_survives_garbage_collection():
+    service = StubService()
+    batcher = RecommendationBatcher(service, ScoringPool(1, 4), max_wait_ms=1, max_batch=3)
+
+    async def run():
+        calls = [asyncio.ensure_future(batcher.recommend(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert len(batcher._runs) == 1
+        gc.collect()
+        results = await asyncio.wait_for(asyncio.gather(*calls), 2)
+        await asyncio.sleep(0)
+        return results
+
+    results = asyncio.run(run())
+    assert [r["similar"] for r in results] == [[0], [1], [2]]
+    assert service.batches == [3] and not batcher._runs
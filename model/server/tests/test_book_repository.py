@@ -0,0 +1,176 @@
+"""
+DBBookRepository over a fake psycopg2 pool: one retry on a fresh connection when the old one
+breaks, the catalog streamed through a named cursor in batches, and the parameter shapes of
+the uuid[] and unnest queries.
+"""
+import uuid
+from pathlib import Path
+
+import psycopg2
+import psycopg2.pool
+import pytest
+
+from model.server.services.book_repository import DBBookRepository, book_key
+
+ROWS = [(f"00000000-0000-0000-0000-00000000000{i}", f"Book {i}", "Author", 2000 + i, "text", None, 100,
+         ["drama", "drama", "poetry"] if i == 0 else None) for i in range(5)]
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn, self.name = conn, name
+        self.itersize = None
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.conn.fail:
+            self.conn.fail -= 1
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.conn.executed.append((sql, params))
+        self.rows = list(self.conn.pool.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        self.conn.fetched.append(len(batch))
+        return batch
+
+
+class FakeConnection:
+    def __init__(self, pool, fail=0):
+        self.pool = pool
+        self.fail = fail
+        self.closed = 0
+        self.autocommit = None
+        self.executed, self.fetched, self.cursors = [], [], []
+        self.rollbacks = 0
+
+    def cursor(self, name=None):
+        cur = FakeCursor(self, name)
+        self.cursors.append(cur)
+        return cur
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.idle, self.opened, self.returned = [], [], []
+        self.rows = ROWS
+        # сколько следующих новых соединений оборвутся на первом запросе
+        self.failing = 0
+
+    def getconn(self):
+        if self.idle:
+            return self.idle.pop()
+        conn = FakeConnection(self, fail=1 if self.failing else 0)
+        self.failing = max(self.failing - 1, 0)
+        self.opened.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+        if not close:
+            self.idle.append(conn)
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    return DBBookRepository(1, 2)
+
+
+def test_query_retries_once_on_fresh_connection(repo):
+    repo.pool.failing = 1
+    assert repo.get_book_ids() == [r[0] for r in ROWS]
+
+    broken, fresh = repo.pool.opened
+    assert broken.executed == [] and fresh.executed == [("SELECT id FROM books;", None)]
+    # оборванное соединение закрыто, а не возвращено в пул
+    assert repo.pool.returned == [(broken, True), (fresh, False)]
+
+    repo.pool.failing = 2
+    repo.pool.idle.clear()
+    with pytest.raises(psycopg2.OperationalError):
+        repo.get_book_ids()
+    assert len(repo.pool.opened) == 4
+
+
+def test_closed_pooled_connection_replaced(repo):
+    stale = FakeConnection(repo.pool)
+    stale.closed = 1
+    repo.pool.idle.append(stale)
+
+    repo.get_book_ids()
+    assert stale.executed == [] and repo.pool.returned[0] == (stale, True)
+    assert len(repo.pool.opened) == 1 and repo.pool.opened[0].executed
+
+
+def test_catalog_streamed_in_batches(repo):
+    batches = list(repo.iter_book_rows(batch_size=2))
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+    (conn,) = repo.pool.opened
+    (cur,) = conn.cursors
+    assert cur.name == "catalog_stream" and cur.itersize == 2
+    assert conn.fetched == [2, 2, 1, 0]
+    assert conn.autocommit is False and conn.rollbacks == 1
+    assert "ORDER BY b.id" in conn.executed[0][0] and "{where}" not in conn.executed[0][0]
+
+    books = repo.get_all_books()
+    assert [b["title"] for b in books] == [r[1] for r in ROWS]
+    assert books[0]["genres"] == ["drama", "poetry"] and books[1]["genres"] == []
+
+
+def test_books_by_ids_pass_one_uuid_array(repo):
+    wanted = [uuid.UUID(ROWS[0][0]), ROWS[1][0].upper(), "not-a-uuid"]
+    repo.get_books_by_ids(wanted)
+
+    ((sql, params),) = repo.pool.opened[0].executed
+    assert "b.id = ANY(%s::uuid[])" in sql
+    assert params == ([ROWS[0][0], ROWS[1][0]],)
+
+    assert repo.get_books_by_ids(["x", "y"]) == []
+    assert len(repo.pool.opened[0].executed) == 1
+
+
+def test_genres_prepared_once_per_connection(repo):
+    repo.pool.rows = [("Dune", "Herbert", ["sci-fi", "sci-fi"]), ("Emma", "", None)]
+    books = [{"title": " Dune ", "author": "Herbert"}, {"title": "", "author": ""}, {"title": "Emma"}]
+
+    assert repo.get_genres_for_titles(books) == {book_key("Dune", "Herbert"): ["sci-fi"], book_key("Emma", ""): []}
+    repo.get_genres_for_titles(books)
+    assert repo.get_genres_for_titles([{"title": " "}]) == {}
+
+    (conn,) = repo.pool.opened
+    prepare, execute, again = conn.executed
+    assert prepare[0].strip().startswith("PREPARE genres_by_titles(text[], text[])")
+    assert "unnest($1, $2)" in prepare[0]
+    # JOIN по lower(b.title) обслуживает функциональный индекс из миграции
+    migration = Path(__file__).parents[1] / "migrations" / "0001_books_lower_title.sql"
+    assert "lower(b.title) = lower(v.title)" in prepare[0]
+    assert "ON books (lower(title))" in migration.read_text(encoding="utf-8")
+    # два параллельных массива, пустая пара отброшена
+    assert execute == ("EXECUTE genres_by_titles(%s, %s);", (["Dune", "Emma"], ["Herbert", ""]))
+    assert again == execute
+
+
+def test_genres_prepared_again_after_reconnect(repo):
+    repo.get_genres_for_titles([{"title": "Dune"}])
+    repo.pool.idle.clear()
+    repo.pool.failing = 1
+    repo.get_genres_for_titles([{"title": "Dune"}])
+
+    first, broken, fresh = repo.pool.opened
+    assert broken.executed == []
+    assert [sql.strip().split()[0] for sql, _ in fresh.executed] == ["PREPARE", "EXECUTE"]
@@ -0,0 +1,92 @@
+"""
+CallbackQueue journal: compacted while the queue runs, undelivered callbacks survive a restart.
+"""
+import asyncio
+
+import httpx
+
+from model.server.services.callback_queue import CallbackQueue
+
+
+class FakeHttp:
+    """Answers a POST with `status`, or 503 for urls under one of the `down` prefixes, in place of HttpClientPool."""
+
+    def __init__(self):
+        self.status = 204
+        self.down = ()
+
+    async def post(self, url, **kwargs):
+        status = 503 if url.startswith(tuple(self.down)) else self.status
+        return httpx.Response(status, request=httpx.Request("POST", url))
+
+
+def lines(path) -> int:
+    with open(path, encoding="utf-8") as fh:
+        return sum(1 for _ in fh)
+
+
+def test_journal_compacted_and_replayed(tmp_path):
+    journal = str(tmp_path / "callbacks.jsonl")
+    http = FakeHttp()
+
+    async def run():
+        queue = CallbackQueue(http, base_delay=0.01, max_attempts=1000, journal_path=journal,
+                              journal_compact=50, drain_timeout=0.1)
+        await queue.start()
+        peak = 0
+        for i in range(1000):
+            queue.enqueue(f"http://backend/{i}", {"i": i})
+            if i % 20 == 0:
+                await asyncio.sleep(0.005)
+                peak = max(peak, lines(journal))
+        while queue.delivered < 1000:
+            await asyncio.sleep(0.01)
+
+        http.status = 503
+        for i in range(3):
+            queue.enqueue(f"http://backend/left/{i}", {"i": i})
+        await queue.stop()
+        return peak
+
+    # 1000 deliveries write 2000 records, compaction keeps the file near journal_compact
+    assert asyncio.run(run()) < 100
+    left = CallbackQueue._replay_journal(journal).values()
+    assert sorted(job["url"] for job in left) == [f"http://backend/left/{i}" for i in range(3)]
+
+
+def test_workers_keep_separate_journals(tmp_path):
+    journal = str(tmp_path / "callbacks.jsonl")
+    http = FakeHttp()
+    # b's retries land at random moments: its urls fail whenever they come
+    http.down = ("http://backend/b/", "http://backend/a/left")
+
+    async def run():
+        # два воркера с одним CALLBACK_JOURNAL
+        a, b = (CallbackQueue(http, base_delay=10, max_attempts=1000, journal_path=journal,
+                              journal_compact=1, drain_timeout=0) for _ in range(2))
+        await a.start()
+        await b.start()
+        assert a.journal_file != b.journal_file
+        for i in range(3):
+            b.enqueue(f"http://backend/b/{i}", {"i": i})
+        await asyncio.sleep(0.05)
+        # a compacts its journal on every record, b's jobs stay where they are
+        for i in range(5):
+            a.enqueue(f"http://backend/a/{i}", {"i": i})
+            await asyncio.sleep(0.01)
+        a.enqueue("http://backend/a/left", {})
+        await asyncio.sleep(0.05)
+        await a.stop()
+        await b.stop()
+
+        # after a restart with a single worker, each undelivered callback comes back once
+        c = CallbackQueue(http, journal_path=journal, workers=0)
+        await c.start()
+        urls = sorted(job["url"] for job in c._pending.values())
+        files = c._journal_files()
+        await c.stop()
+        return urls, files
+
+    urls, files = asyncio.run(run())
+    assert urls == ["http://backend/a/left"] + [f"http://backend/b/{i}" for i in range(3)]
+    assert files == [journal]
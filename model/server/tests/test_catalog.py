@@ -0,0 +1,119 @@
+"""
+Catalog columns: values read back exactly as they were appended.
+Catalog snapshot: key and id lookups over hashed arrays, extended copy-on-write.
+"""
+import sys
+
+import numpy as np
+
+from model.server.services import embedding_service
+from model.server.services.book_repository import book_key
+from model.server.services.catalog import BookColumns, CodeColumn, GenresColumn, IntColumn, StringColumn
+from model.server.services.embedding_service import CatalogSnapshot
+from model.server.services.retrieval import ExactRetriever
+
+BOOKS = [
+    {"id": "1", "title": "Мастер и Маргарита", "author": "Булгаков", "year": 1967, "description": None,
+     "cover": "", "pages": 480, "genres": ["классика", "fantasy"]},
+    {"id": "2", "title": "", "author": None, "year": None, "description": "日本語 ✓",
+     "cover": None, "pages": 0, "genres": []},
+    {"id": "3", "title": "Dune", "author": "Herbert", "year": -(2 ** 63) + 1, "description": "spice",
+     "cover": "c.jpg", "pages": None, "genres": ["sci-fi", "sci-fi", "classics"]},
+]
+
+
+def expected(book):
+    # повторы жанров схлопываются, порядок сохраняется
+    return {**book, "genres": list(dict.fromkeys(book["genres"]))}
+
+
+def test_string_column_nulls_and_utf8():
+    values = ["Мастер", None, "", "日本語", None, "x" * 1000]
+    col = StringColumn(values)
+    assert len(col) == len(values) and list(col) == values
+
+
+def test_int_column_sentinel():
+    values = [0, None, -1, 2 ** 63 - 1, -(2 ** 63) + 1, None]
+    assert list(IntColumn(values)) == values
+
+
+def test_code_columns():
+    authors = CodeColumn(["a", None, "b", "a"])
+    assert list(authors) == ["a", None, "b", "a"] and authors.values == ["a", "b"]
+
+    genres = GenresColumn([["x", "y"], [], None, ["y", "y"], ["z"]])
+    assert list(genres) == [("x", "y"), (), (), ("y",), ("z",)]
+
+
+def test_book_columns_round_trip():
+    cols = BookColumns.from_dicts(BOOKS)
+    assert len(cols) == 3
+    assert list(cols) == [expected(b) for b in BOOKS]
+    assert cols[1:] == [expected(b) for b in BOOKS[1:]]
+
+
+def test_add_dicts_leaves_operands_unchanged():
+    base = BookColumns.from_dicts(BOOKS[:2])
+    before = list(base)
+
+    grown = base + BOOKS[2:]
+    assert list(grown) == [expected(b) for b in BOOKS]
+    # copy-on-write: the snapshot the refresh started from is not touched
+    assert list(base) == before and len(base) == 2
+
+    again = grown + BookColumns.from_dicts([BOOKS[1]])
+    assert list(again) == [expected(b) for b in BOOKS + [BOOKS[1]]] and len(grown) == 3
+
+
+def test_take_reorders_rows():
+    cols = BookColumns.from_dicts(BOOKS)
+    assert list(cols.take([2, 0, 1], batch_size=2)) == [expected(BOOKS[i]) for i in (2, 0, 1)]
+    assert len(cols.take([])) == 0
+
+
+def snapshot(books):
+    cols = BookColumns.from_dicts(books)
+    embeddings = np.zeros((len(cols), 4), dtype=np.float32)
+    return CatalogSnapshot(cols, embeddings, ExactRetriever(embeddings))
+
+
+def edition(i, title, author, genres):
+    return {"id": f"id-{i}", "title": title, "author": author, "genres": genres}
+
+
+def test_snapshot_key_and_id_lookups():
+    snap = snapshot([edition(0, "Dune", "Herbert", ["sci-fi"]), edition(1, "Emma", "Austen", ["classics"]),
+                     edition(2, " dune ", "HERBERT", ["classics"])])
+    assert snap.row_of_key(book_key("Dune", "Herbert")) == 0 and snap.row_of_key("missing|||") is None
+    assert snap.key_codes.tolist() == [0, 1, 0]
+    assert snap.genres_of(book_key("Dune", "Herbert")) == ("sci-fi", "classics")
+    assert snap.rows_of_ids(["id-2", "id-9", "id-0"]).tolist() == [2, -1, 0]
+
+    grown = snap.extend(BookColumns.from_dicts([edition(3, "Emma", "Austen", ["romance"]),
+                                                edition(4, "Ulysses", "Joyce", [])]), np.zeros((5, 4)))
+    assert grown.key_codes.tolist() == [0, 1, 0, 1, 4]
+    assert grown.genres_of(book_key("Emma", "Austen")) == ("classics", "romance")
+    assert grown.rows_of_ids(["id-4", "id-3"]).tolist() == [4, 3]
+    # the snapshot that was extended is left as it was
+    assert snap.rows_of_ids(["id-4"]).tolist() == [-1] and snap.genres_of(book_key("Emma", "Austen")) == ("classics",)
+
+
+def test_hash_collisions_read_as_misses(monkeypatch):
+    monkeypatch.setattr(embedding_service, "str_hashes", lambda values: np.zeros(len(list(values)), dtype=np.int64))
+    snap = snapshot([edition(0, "Dune", "Herbert", []), edition(1, "Emma", "Austen", [])])
+    assert snap.key_codes.tolist() == [0, 1]
+    assert snap.row_of_key(book_key("Dune", "Herbert")) == 0 and snap.row_of_key(book_key("Emma", "Austen")) is None
+    assert snap.rows_of_ids(["id-0", "id-1"]).tolist() == [0, -1]
+
+
+def test_snapshot_indexes_smaller_than_dicts():
+    n = 20000
+    snap = snapshot([edition(i, f"Title {i % 15000}", f"Author {i % 3000}", []) for i in range(n)])
+    keys = {book_key(t, a): i for i, (t, a) in enumerate(zip(snap.books.titles, snap.books.authors))}
+    ids = {book_id: i for i, book_id in enumerate(snap.books.ids)}
+    as_dicts = sum(sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items())
+                   for d in (keys, ids))
+
+    assert snap.index_nbytes <= 40 * n
+    assert snap.index_nbytes * 4 < as_dicts
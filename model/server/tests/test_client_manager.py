@@ -0,0 +1,103 @@
+"""
+Client managers (memory and redis): workers never hand out more slots than clients have,
+and a waiter sees a slot released elsewhere. ClientManager over MemoryClientStore: only
+register/heartbeat keep a client alive.
+"""
+import asyncio
+import time
+
+from model.server.services import ClientManager, MemoryClientStore
+
+
+def test_workers_do_not_oversubscribe(make_client_managers):
+    managers = make_client_managers(3)
+    managers[0].register("http://a", capacity=2)
+    managers[1].register("http://b", capacity=1)
+
+    leases = [m.acquire(f"t{i}") for i, m in enumerate(managers * 2)]
+    assert sum(c is not None for c in leases) == 3
+    assert all(m.acquire() is None for m in managers)
+
+
+def test_waiter_sees_release_from_other_worker(make_client_managers):
+    a, b = make_client_managers(2)
+    a.register("http://a")
+    assert a.acquire("t1") is not None
+
+    async def run():
+        waiting = asyncio.create_task(b.acquire_wait(2, "t2"))
+        await asyncio.sleep(0.1)
+        # /generate/result пришёл в другой воркер
+        assert a.release("t1")
+        return await waiting
+
+    assert asyncio.run(run()) is not None
+
+
+def test_no_live_clients_returns_immediately(make_client_managers):
+    (manager,) = make_client_managers(1)
+    assert asyncio.run(asyncio.wait_for(manager.acquire_wait(5), 0.5)) is None
+
+
+def test_memory_dispatch_is_not_a_heartbeat():
+    manager = ClientManager(MemoryClientStore(ttl=0.3), lease_ttl=60)
+    client = manager.register("http://a")
+
+    # только работа, без ping: клиент всё равно истекает
+    for _ in range(3):
+        assert manager.acquire("t") is not None
+        assert manager.release("t")
+        time.sleep(0.08)
+    time.sleep(0.1)
+
+    assert manager.acquire("t") is None
+    assert manager.store.get(client.client_id) is None
+
+
+def test_memory_expired_client_leaves_no_leases():
+    manager = ClientManager(MemoryClientStore(ttl=0.3), lease_ttl=60)
+    client = manager.register("http://a")
+    assert manager.acquire("t1").client_id == client.client_id
+    manager.release("t1")
+    assert manager.acquire("t2") is not None
+
+    time.sleep(0.4)
+    # истёкший клиент забыт вместе с арендой
+    assert manager.acquire("t3") is None
+    assert manager.heartbeat(client.client_id, 5) is None
+    assert not manager.release("t2")
+
+    again = manager.register("http://a")
+    leased = manager.acquire("t4")
+    assert leased.client_id == again.client_id and leased.in_flight == 1
+    assert manager.release("t4") and manager.get_best_client().in_flight == 0
+
+
+def test_memory_heartbeat_keeps_leased_client():
+    manager = ClientManager(MemoryClientStore(ttl=0.3), lease_ttl=60)
+    client = manager.register("http://a", capacity=2)
+    assert manager.acquire("t1") is not None
+
+    time.sleep(0.2)
+    manager.heartbeat(client.client_id, 5)
+    time.sleep(0.2)
+
+    assert manager.acquire("t2").in_flight == 2
+    assert manager.release("t1") and manager.release("t2")
+    assert manager.get_best_client().in_flight == 0
+
+
+def test_memory_reacquired_lease_holds_one_slot():
+    manager = ClientManager(MemoryClientStore(), lease_ttl=0.2)
+    manager.register("http://a", capacity=2)
+
+    # повторная валидация той же задачи занимает слот заново, а не второй
+    assert manager.acquire("t").in_flight == 1
+    assert manager.acquire("t").in_flight == 1
+    assert manager.release("t") and not manager.release("t")
+    assert manager.get_best_client().in_flight == 0
+
+    manager.acquire("t")
+    manager.acquire("t")
+    time.sleep(0.3)
+    assert manager.acquire("u").in_flight == 1
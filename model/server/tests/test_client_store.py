@@ -0,0 +1,109 @@
+"""
+Client stores (memory and redis): registration and expiry. RedisClientStore also keeps the
+validation slots shared between workers, ClientManager does it for the memory store.
+"""
+import time
+
+from redis.crc import key_slot
+
+from model.server.models import Client
+from model.server.services import ClientManager, MemoryClientStore
+
+
+def test_register_get_update_delete(make_client_store):
+    store = make_client_store()
+    store.register("c1", Client(client_id="c1", address="http://a", ping=12))
+
+    assert store.get("c1").ping == 12
+    updated = store.update("c1")
+    assert updated.client_id == "c1" and store.get("c1").last_update == updated.last_update
+    assert [c.client_id for c in store.all()] == ["c1"]
+
+    assert store.delete("c1").client_id == "c1"
+    assert store.get("c1") is None and store.update("c1") is None and store.all() == []
+
+
+def test_expired_clients_removed_refreshed_kept(make_client_store):
+    store = make_client_store(ttl=1)
+    store.register("c1", Client(client_id="c1", address="http://a"))
+    store.register("c2", Client(client_id="c2", address="http://b"))
+
+    time.sleep(0.6)
+    store.update("c2")
+    time.sleep(0.6)
+
+    assert store.update("c1") is None
+    assert [c.client_id for c in store.all()] == ["c2"]
+    assert store.get("c1") is None and store.get("c2") is not None
+
+
+def test_acquire_release_share_slots_between_stores(make_redis_client_store):
+    # два воркера с общим redis
+    a, b = make_redis_client_store(), make_redis_client_store()
+    a.register("c1", Client(client_id="c1", address="http://a", capacity=2, ping=50))
+    a.register("c2", Client(client_id="c2", address="http://b", capacity=1, ping=10))
+
+    assert b.peek().client_id == "c2"
+    assert b.acquire("t1", 60).client_id == "c2"
+    assert a.acquire("t2", 60).client_id == "c1"
+    assert b.acquire("t3", 60).client_id == "c1"
+    assert a.acquire("t4", 60) is None and b.peek() is None
+    assert {c.client_id: c.busy for c in a.all()} == {"c1": True, "c2": True}
+
+    assert a.release("t1") and not b.release("t1")
+    # ping не сбрасывает занятые слоты
+    b.register("c1", Client(client_id="c1", address="http://a", capacity=2, ping=5))
+    assert b.get("c1").in_flight == 2
+    assert a.acquire("t5", 60).client_id == "c2"
+
+
+def test_expired_lease_returns_slot(make_redis_client_store):
+    store = make_redis_client_store()
+    store.register("c1", Client(client_id="c1", address="http://a"))
+
+    assert store.acquire("t1", 0.3).client_id == "c1"
+    assert store.acquire("t2", 60) is None
+    time.sleep(0.4)
+    assert store.acquire("t2", 60).client_id == "c1"
+    assert not store.release("t1") and store.release("t2")
+    assert store.get("c1").in_flight == 0
+
+
+def test_deleted_client_leaves_no_slots(make_redis_client_store):
+    store = make_redis_client_store()
+    store.register("c1", Client(client_id="c1", address="http://a"))
+    store.acquire("t1", 60)
+    store.delete("c1")
+
+    assert store.peek() is None and store.live_count() == 0
+    assert store.release("t1")
+    assert not store.redis.hexists("{clients}:in_flight", "c1")
+    # скрипты трогают несколько ключей: в Redis Cluster они должны быть в одном слоте
+    assert len({key_slot(k.encode()) for k in store._keys}) == 1
+
+
+def test_ready_order_matches_memory_manager(make_redis_client_store):
+    # загрузка важнее ping и при capacity > 10, и при больших ping
+    clients = [("http://a", 100, 10), ("http://b", 100, 200000), ("http://c", 12, 5000)]
+    store = make_redis_client_store()
+    manager = ClientManager(MemoryClientStore(), lease_ttl=60)
+    for i, (address, capacity, ping) in enumerate(clients):
+        store.register(f"c{i}", Client(client_id=f"c{i}", address=address, capacity=capacity, ping=ping))
+        manager.heartbeat(manager.register(address, capacity=capacity).client_id, ping)
+
+    redis_order = [store.acquire(f"t{i}", 60).address for i in range(30)]
+    memory_order = [manager.acquire(f"t{i}").address for i in range(30)]
+    assert redis_order[:3] == ["http://a", "http://c", "http://b"]
+    assert redis_order == memory_order
+
+
+def test_memory_heap_stays_bounded():
+    store = MemoryClientStore(ttl=60)
+    store.register("c1", Client(client_id="c1", address="http://a"))
+    store.register("c2", Client(client_id="c2", address="http://b"))
+    # каждый ping кладёт в кучу новую запись, старые выбрасываются пересборкой
+    for _ in range(1000):
+        store.update("c1")
+
+    assert len(store._heap) <= 2 * len(store._expires) + 65
+    assert store.delete("c1") is not None and store.all() == [store.get("c2")]
@@ -0,0 +1,273 @@
+"""
+EmbeddingService over an in-memory catalog with a deterministic stub encoder: batched,
+quantized and approximate selection against a brute-force reference, catalog refresh,
+reuse of stored embeddings and the read-book vector cache.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from model.server.benchmarks.recommendation import MemoryBookRepository
+from model.server.models import Book
+from model.server.services.book_repository import book_key
+from model.server.services import embedding_service
+from model.server.services.embedding_service import EmbeddingService, embedding_text
+from model.server.services.embedding_store import content_hash
+from model.server.services.retrieval import RetrievalConfig, _is_mapped
+from model.server.utils.metrics import REGISTRY
+
+GENRES = ("fantasy", "detective", "classics", "poetry")
+TOPICS = 5
+CATALOG = [{"id": f"b{i}", "title": f"Book {i}", "author": f"Author {i % 7}", "genres": [GENRES[i % 4]],
+            "description": f"topic {i % TOPICS}"} for i in range(300)]
+# a second edition of book 0: same title and author, another id
+CATALOG.append({**CATALOG[0], "id": "b0-2nd", "genres": ["classics"]})
+
+
+class StubModel:
+    """
+    In place of SentenceTransformer: the vector of a text is its topic centroid plus noise
+    seeded by the text, so books of one topic land in the novel similarity band of each other.
+    """
+
+    dim = 32
+
+    def __init__(self):
+        self.encoded = 0
+        self.batches = []
+        self.centroids = np.random.default_rng(0).standard_normal((TOPICS + 1, self.dim))
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.encoded += len(texts)
+        self.batches.append(len(texts))
+        rows = []
+        for t in texts:
+            topic = int(t.rsplit("topic ", 1)[1]) if "topic " in t else TOPICS
+            noise = np.random.default_rng(content_hash(t)).standard_normal(self.dim)
+            rows.append(self.centroids[topic] + 0.8 * noise)
+        return np.asarray(rows, dtype=np.float32)
+
+
+def make_service(books=CATALOG, **kwargs) -> EmbeddingService:
+    service = EmbeddingService(MemoryBookRepository(books), encoder="hash", **kwargs)
+    service.model = StubModel()
+    return service
+
+
+def read_list(*rows, unknown=False):
+    books = [Book(**{k: v for k, v in CATALOG[r].items()}) for r in rows]
+    if unknown:
+        books.append(Book(id="x1", title="Not in the catalog", author="Nobody", description="topic 2"))
+    return books
+
+
+def ids(result):
+    return {name: [b["id"] for b in books] for name, books in result.items()}
+
+
+def reference(service, user_books, top=10, band=(0.55, 0.75)):
+    """Brute force over the catalog: similar and novel lists as get_recommendations defines them."""
+    snap = service._load_catalog()
+    queries = service._encode_texts([embedding_text(b.title, b.author, b.description) for b in user_books])
+    sims = (np.asarray(snap.embeddings, dtype=np.float32) @ queries.T).max(axis=1)
+    keys = [book_key(t, a) for t, a in zip(snap.books.titles, snap.books.authors)]
+    read = {book_key(b.title, b.author) for b in user_books}
+    order = [r for r in np.argsort(-sims, kind="stable") if keys[r] not in read]
+    similar = order[:top]
+    taken = {keys[r] for r in similar}
+    novel = [r for r in order if band[0] <= sims[r] <= band[1] and keys[r] not in taken][:top]
+    return {"similar": [snap.books.ids[r] for r in similar], "novel": [snap.books.ids[r] for r in novel]}
+
+
+def test_selection_matches_brute_force():
+    service = make_service()
+    for books in (read_list(1), read_list(3, 8, 13, unknown=True), read_list(0, 42)):
+        got = ids(service.get_recommendations(books, similar_top=10, novel_top=10))
+        expected = reference(service, books)
+        assert got["similar"] == expected["similar"]
+        assert got["novel"] == expected["novel"] and got["novel"]
+
+
+def test_batch_matches_single_requests():
+    service = make_service()
+    requests = [(read_list(1, 2), {"similar_top": 5}), ([], {"similar_top": 3}),
+                (read_list(7, unknown=True), {"genre_top": 4}), (read_list(9), {"exclude": read_list(10)})]
+    batch = service.get_recommendations_batch(requests)
+    assert batch == [service.get_recommendations(b, **p) for b, p in requests]
+    assert len(batch[1]["similar"]) == 3 and batch[1]["novel"] == []
+
+
+def test_exclusion_and_editions():
+    service = make_service()
+    books = read_list(1)
+    first = ids(service.get_recommendations(books, similar_top=8))
+    rejected = [Book(**CATALOG[int(i[1:])]) for i in first["similar"][:3]]
+
+    again = ids(service.get_recommendations(books, similar_top=8, exclude=rejected))
+    assert not set(again["similar"]) & {b.id for b in rejected}
+    assert again["similar"][:5] == first["similar"][3:]
+
+    # every edition of a read book is excluded, lists share no book
+    result = service.get_recommendations(read_list(0), similar_top=20, novel_top=20, genre_top=20)
+    keys = [book_key(b["title"], b["author"]) for lst in result.values() for b in lst]
+    assert book_key("Book 0", "Author 0") not in keys
+    assert len(set(keys)) == len(keys)
+
+
+def test_genre_similar_from_favorite_genre():
+    service = make_service()
+    # books 1 and 5 are fantasy, book 2 detective; the unknown book has no genres
+    result = service.get_recommendations(read_list(1, 5, 2, unknown=True), genre_top=6)
+    assert len(result["genre_similar"]) == 6
+    assert all(int(b["id"][1:]) % 4 == 1 for b in result["genre_similar"])
+
+    # genres of all editions are merged: the second edition of book 0 adds classics
+    snap = service._load_catalog()
+    assert snap.genres_of(book_key("Book 0", "Author 0")) == ("fantasy", "classics")
+
+
+def test_refresh_encodes_only_new_books():
+    service = make_service(CATALOG[:200])
+    old = service._load_catalog()
+    assert service.model.encoded == 200
+
+    service.repo = MemoryBookRepository(CATALOG)
+    assert service.refresh_catalog() == len(CATALOG) - 200
+    assert service.model.encoded == len(CATALOG)
+    assert service.refresh_catalog() == 0
+
+    snap = service._load_catalog()
+    assert len(old) == 200 and len(snap) == len(CATALOG)
+    assert list(snap.books.ids) == [b["id"] for b in CATALOG]
+    # the extended snapshot selects exactly like one loaded from scratch
+    fresh = make_service()
+    for books in (read_list(1), read_list(250, 270, unknown=True)):
+        assert ids(service.get_recommendations(books)) == ids(fresh.get_recommendations(books))
+
+
+def test_store_reused_across_restarts_and_reorders(tmp_path):
+    first = make_service(cache_dir=str(tmp_path))
+    expected = ids(first.get_recommendations(read_list(1, 2)))
+    assert first.model.encoded == len(CATALOG)
+
+    again = make_service(cache_dir=str(tmp_path))
+    snap = again._load_catalog()
+    assert again.model.encoded == 0 and _is_mapped(snap.embeddings)
+
+    # the database returns the rows in another order: the stored file is reused as is
+    reordered = make_service(CATALOG[::-1], cache_dir=str(tmp_path))
+    snap = reordered._load_catalog()
+    assert reordered.model.encoded == 0
+    assert list(snap.books.ids) == [b["id"] for b in CATALOG]
+    assert ids(reordered.get_recommendations(read_list(1, 2))) == expected
+
+    # a changed description is the only row encoded again
+    changed = [dict(b) for b in CATALOG]
+    changed[5]["description"] = "topic 3"
+    edited = make_service(changed, cache_dir=str(tmp_path))
+    edited._load_catalog()
+    assert edited.model.encoded == 1
+
+
+def test_catalog_encoded_in_row_batches(tmp_path, monkeypatch):
+    expected = make_service()._load_catalog().embeddings
+    monkeypatch.setattr(embedding_service, "ENCODE_BATCH_SIZE", 64)
+
+    service = make_service(cache_dir=str(tmp_path))
+    snap = service._load_catalog()
+    assert service.model.batches == [64] * 4 + [len(CATALOG) - 256]
+    assert np.allclose(snap.embeddings, expected)
+
+    service.repo = MemoryBookRepository(CATALOG + [{**b, "id": f"{b['id']}-new"} for b in CATALOG[:100]])
+    assert service.refresh_catalog() == 100
+    assert service.model.batches[5:] == [64, 36]
+
+
+def test_stored_rows_matched_by_id_and_hash(monkeypatch):
+    books = MemoryBookRepository(CATALOG[:4]).load_catalog()
+    cached_ids = np.array(["b2", "b0", "b9", "b1"])
+    hashes = np.array([10, 11, 12, 13], dtype=np.uint64)
+    cached_hashes = np.array([12, 10, 0, 99], dtype=np.uint64)
+    # b1 is stored with another text, b3 is new, b9 is gone
+    assert EmbeddingService._stored_rows(books, hashes, cached_ids, cached_hashes).tolist() == [1, -1, 0, -1]
+
+    # every id hashes alike: a collision reads as a miss, never as another book's row
+    monkeypatch.setattr(embedding_service, "str_hashes", lambda values: np.zeros(len(list(values)), dtype=np.int64))
+    assert EmbeddingService._stored_rows(books, hashes, cached_ids, cached_hashes).tolist() == [-1, -1, 0, -1]
+
+
+def test_query_cache_and_catalog_rows():
+    service = make_service(query_cache_size=2)
+    books = read_list(1, 2, unknown=True)
+    service.get_recommendations(books)
+    service.get_recommendations(books)
+    stats = service.query_cache_stats()
+    # catalog books reuse their catalog row, only the unknown book is encoded, once
+    assert (stats["catalog_hits"], stats["hits"], stats["misses"], stats["size"]) == (4, 1, 1, 1)
+
+    # a read book whose text differs from its catalog row is encoded from its own text
+    edited = Book(**{**CATALOG[1], "description": "topic 4"})
+    service.get_recommendations([edited])
+    assert service.query_cache_stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_matches_exact(tmp_path, dtype):
+    exact = make_service(cache_dir=str(tmp_path / "exact"))
+    quantized = make_service(cache_dir=str(tmp_path / dtype), retrieval=RetrievalConfig(dtype=dtype, rescore=50))
+    retriever = quantized._load_catalog().retriever
+    assert retriever.dtype == dtype and retriever.matrix.dtype == np.dtype(dtype)
+
+    for books in (read_list(1), read_list(3, 8, unknown=True)):
+        got = ids(quantized.get_recommendations(books, novel_top=0, genre_top=0))
+        assert got["similar"] == ids(exact.get_recommendations(books, novel_top=0, genre_top=0))["similar"]
+
+
+@pytest.mark.parametrize("backend", ["hnsw", "ivfpq"])
+def test_faiss_matches_exact(backend):
+    pytest.importorskip("faiss")
+    config = RetrievalConfig(backend=backend, candidates=len(CATALOG), nlist=4, nprobe=4, pq_m=4)
+    approximate = make_service(retrieval=config)
+    assert approximate._load_catalog().retriever.backend == backend
+    exact = make_service()
+
+    for books in (read_list(1), read_list(3, 8, unknown=True)):
+        # with every row a candidate the exact rescoring ranks like exact search
+        assert ids(approximate.get_recommendations(books)) == ids(exact.get_recommendations(books))
+
+    approximate.repo = MemoryBookRepository(CATALOG + [{**CATALOG[1], "id": "b1-new", "title": "New book"}])
+    assert approximate.refresh_catalog() == 1
+    assert approximate._load_catalog().retriever.index.ntotal == len(CATALOG) + 1
+
+
+class SlowGenresRepository(MemoryBookRepository):
+    def get_genres_for_titles(self, titles_and_authors):
+        time.sleep(0.05)
+        return super().get_genres_for_titles(titles_and_authors)
+
+
+def stage_counts():
+    snap = REGISTRY.get("recommendation_stage_seconds").snapshot()
+    return {stage: (v["count"], v["sum"]) for stage, v in snap.items()}
+
+
+def test_stage_timers_do_not_overlap():
+    service = EmbeddingService(SlowGenresRepository(CATALOG[:60]), encoder="hash")
+    service._load_catalog()
+    known = Book(**CATALOG[3])
+    unknown = Book(id="x", title="Not in the catalog", author="Nobody")
+
+    before = stage_counts()
+    service.get_recommendations_batch([([known], {}), ([unknown], {})])
+    after = stage_counts()
+
+    def delta(stage):
+        count, total = after[stage]
+        count0, total0 = before.get(stage, (0, 0.0))
+        return count - count0, total - total0
+
+    assert set(after) == {"encode", "score", "select", "genre_lookup"}
+    assert [delta(s)[0] for s in ("encode", "score", "select", "genre_lookup")] == [1, 1, 1, 2]
+    # the repository lookup of the unknown book is counted in genre_lookup only
+    assert delta("genre_lookup")[1] >= 0.05 > delta("select")[1]
@@ -0,0 +1,129 @@
+"""
+/generate/ with every validation slot taken: the response does not wait for a free slot,
+the task is dispatched in the background once one frees up, or completes without validation.
+"""
+import asyncio
+import time
+
+import httpx
+import psycopg2.pool
+import pytest
+from fastapi import FastAPI
+
+from model.server.services import ClientManager, MemoryClientStore, MemoryTaskStore, TaskManager
+from model.server.services.scoring_pool import PoolSaturated
+
+REQUEST = {"userId": "u1", "books": [{"id": "b1", "title": "Dune"}], "callbackUrl": "http://backend/cb",
+           "requestId": "r1"}
+RECOMMENDED = {"similar": [{"id": "e1", "title": "Emma", "author": "Austen"}], "novel": [], "genre_similar": []}
+
+
+class StubBatcher:
+    async def recommend(self, user_books, **params):
+        return RECOMMENDED
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def enqueue(self, url, payload):
+        self.calls.append((url, payload))
+
+
+@pytest.fixture
+def generate(monkeypatch):
+    # model.server.core opens the database pool on import
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", lambda *args, **kwargs: None)
+    from model.server.routes import generate as module
+
+    sent = []
+
+    async def send_validation(client, task_id, candidates):
+        sent.append((task_id, client.address))
+
+    monkeypatch.setattr(module, "client_manager", ClientManager(MemoryClientStore(), lease_ttl=60))
+    monkeypatch.setattr(module, "task_manager", TaskManager(MemoryTaskStore()))
+    monkeypatch.setattr(module, "recommendation_batcher", StubBatcher())
+    monkeypatch.setattr(module, "callback_queue", Recorder())
+    monkeypatch.setattr(module, "_send_validation", send_validation)
+    monkeypatch.setattr(module, "CLIENT_WAIT_TIMEOUT", 5.0)
+    monkeypatch.setattr(module, "sent", sent, raising=False)
+    return module
+
+
+def post(module, after=None, path="/generate/", body=REQUEST):
+    async def run():
+        app = FastAPI()
+        app.include_router(module.generate_router)
+        app.dependency_overrides[module.verify_api_key] = lambda: None
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            start = time.perf_counter()
+            resp = await http.post(path, json=body)
+            elapsed = time.perf_counter() - start
+            if after is not None:
+                await after()
+            return resp, elapsed
+
+    return asyncio.run(run())
+
+
+def test_saturated_clients_do_not_hold_the_response(generate):
+    generate.client_manager.register("http://a")
+    assert generate.client_manager.acquire("other-task") is not None
+
+    async def after():
+        await asyncio.sleep(0.05)
+        assert generate.sent == []
+        generate.client_manager.release("other-task")
+        await asyncio.sleep(0.05)
+
+    resp, elapsed = post(generate, after)
+    assert resp.status_code == 202 and resp.json()["status"] == "processing"
+    assert elapsed < 1
+    assert generate.sent == [(resp.json()["task"], "http://a")]
+    assert generate.callback_queue.calls == []
+
+
+def test_no_free_slot_completes_in_background(generate, monkeypatch):
+    monkeypatch.setattr(generate, "CLIENT_WAIT_TIMEOUT", 0.1)
+    generate.client_manager.register("http://a")
+    generate.client_manager.acquire("other-task")
+
+    async def after():
+        assert generate.callback_queue.calls == []
+        await asyncio.sleep(0.2)
+
+    resp, _ = post(generate, after)
+    assert resp.status_code == 202 and generate.sent == []
+    assert generate.task_manager.get_record(resp.json()["task"]).status == "done"
+    assert [url for url, _ in generate.callback_queue.calls] == ["http://backend/cb"]
+
+
+def test_no_live_clients_answers_at_once(generate):
+    resp, _ = post(generate)
+    assert resp.status_code == 200 and resp.json()["status"] == "done_without_validation"
+    assert len(generate.callback_queue.calls) == 1
+
+
+def test_saturated_pool_on_rejected_validation_completes_task(generate, monkeypatch):
+    generate.client_manager.register("http://a")
+    resp, _ = post(generate, lambda: asyncio.sleep(0.01))
+    task_id = resp.json()["task"]
+    assert generate.sent == [(task_id, "http://a")]
+
+    class SaturatedBatcher:
+        async def recommend(self, user_books, **params):
+            raise PoolSaturated()
+
+    monkeypatch.setattr(generate, "recommendation_batcher", SaturatedBatcher())
+    rejected = {"task_id": task_id, "ok": False, "invalid": [{"id": "e1", "title": "Emma", "author": "Austen"}]}
+    resp, _ = post(generate, path="/generate/result", body=rejected)
+
+    # задача уже принята: не 503, а прежний результат без повторной валидации
+    assert resp.status_code == 200 and resp.json()["status"] == "done_without_validation"
+    assert generate.task_manager.get_record(task_id).status == "done"
+    ((url, payload),) = generate.callback_queue.calls
+    assert url == "http://backend/cb" and payload["recommendations"][0][0]["title"] == "Emma"
+    assert generate.client_manager.get_best_client().in_flight == 0
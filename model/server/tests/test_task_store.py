@@ -0,0 +1,108 @@
+"""
+Task stores (memory and redis): status transitions, finished-task trimming and expiry of
+active tasks; the redis-only tests check the keys the store leaves behind.
+"""
+import time
+
+from redis.crc import key_slot
+
+from model.server.models import GenerationRequest, Task
+
+
+def make_task(n: int) -> Task:
+    return Task(task_id=f"t{n}", request=GenerationRequest(books=[]), result=[[{"title": "a"}], []],
+                backend_request_id=f"r{n}", backend_user_id="u")
+
+
+def test_add_get_transition(make_task_store):
+    store = make_task_store()
+    store.add(make_task(1))
+
+    task = store.get("t1")
+    assert task.status == "queued" and task.result == [[{"title": "a"}], []]
+    assert store.counts() == {"queued": 1}
+
+    assert store.transition("t1", "processing", result=[[{"title": "b"}]])
+    assert store.get("t1").result == [[{"title": "b"}]]
+    assert store.counts() == {"processing": 1}
+
+    assert store.transition("t1", "done", completed_at="now")
+    # второй complete не проходит: callback уходит один раз
+    assert not store.transition("t1", "done")
+    assert store.get("t1") is None
+
+    record = store.get_record("t1")
+    assert record.status == "done" and record.completed_at == "now" and record.result_size == 1
+    assert store.find_by_request("r1").task_id == "t1"
+    assert [r.task_id for r in store.by_status("done")] == ["t1"]
+    assert store.counts() == {"done": 1}
+
+
+def test_finished_trimmed_by_count(make_task_store):
+    store = make_task_store(max_finished=2)
+    for n in range(4):
+        store.add(make_task(n))
+        assert store.transition(f"t{n}", "done")
+
+    assert store.get_record("t0") is None and store.get_record("t1") is None
+    assert sorted(r.task_id for r in store.by_status("done")) == ["t2", "t3"]
+    assert store.counts() == {"done": 2}
+    assert sorted(r.task_id for r in store.all()) == ["t2", "t3"]
+
+
+def test_expired_active_tasks_leave_counts(make_task_store):
+    store = make_task_store(active_ttl=1)
+    store.add(make_task(1))
+    store.add(make_task(2))
+    store.transition("t2", "processing")
+    assert store.counts() == {"queued": 1, "processing": 1}
+
+    time.sleep(1.1)
+    assert store.counts() == {}
+    assert store.by_status("queued") == [] and store.by_status("processing") == []
+    assert store.get_record("t1") is None and store.all() == []
+
+
+def test_dispatch_time_kept_with_task(make_task_store):
+    store = make_task_store()
+    store.add(make_task(1))
+    assert store.get("t1").dispatched_at is None
+
+    assert store.transition("t1", "processing", dispatched_at=1700000000.25, dispatched_to="http://a")
+    task = store.get("t1")
+    assert task.dispatched_at == 1700000000.25 and task.dispatched_to == "http://a"
+
+
+def test_redis_finished_task_keeps_compact_record(make_redis_task_store):
+    store = make_redis_task_store(max_finished=2)
+    for n in range(3):
+        store.add(make_task(n))
+        store.transition(f"t{n}", "processing", dispatched_at=1.0, dispatched_to="http://a")
+        store.transition(f"t{n}", "done")
+
+    # тяжёлые поля завершённой задачи удалены, вытесненные задачи — целиком
+    assert store.redis.hget("{tasks}:task:t2", "request") is None
+    assert store.redis.hget("{tasks}:task:t2", "dispatched_at") is None
+    assert not store.redis.exists("{tasks}:task:t0")
+    assert store.redis.zrange("{tasks}:finished", 0, -1) == ["t1", "t2"]
+
+
+def test_redis_expired_tasks_leave_status_index(make_redis_task_store):
+    store = make_redis_task_store(active_ttl=0.3)
+    store.add(make_task(1))
+    time.sleep(0.4)
+    assert store.counts() == {}
+    assert store.redis.zcard("{tasks}:by_status:queued") == 0
+
+
+def test_keys_share_one_cluster_slot(make_redis_task_store):
+    store = make_redis_task_store(max_finished=1)
+    for n in range(3):
+        store.add(make_task(n))
+        store.transition(f"t{n}", "processing", dispatched_at=1.0, dispatched_to="http://a")
+        store.transition(f"t{n}", "done")
+
+    # the script and MULTI only work on Redis Cluster when every key hashes to one slot
+    assert {key_slot(k.encode()) for k in store.redis.keys()} == {key_slot(b"{tasks}")}
+    assert store.redis.zrange("{tasks}:finished", 0, -1) == ["t2"]
+    assert store.redis.zrange("{tasks}:by_status:done", 0, -1) == ["t2"]
@@ -0,0 +1,150 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# seconds; covers in-process stages as well as remote calls
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Union[str, Tuple[str, ...]]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """
+    Latency histogram per label (e.g. destination host). observe() is a bisect and
+    two increments under a lock, cheap enough for the hot path.
+    A label may be a tuple when the histogram has several label names.
+    """
+
+    def __init__(self, name: str = "", help: str = "", labels: Sequence[str] = ("label",),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[LabelValues, list] = {}
+        self._sums: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label: LabelValues, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(label)
+            if counts is None:
+                counts = self._counts[label] = [0] * (len(self.buckets) + 1)
+                self._sums[label] = 0.0
+            counts[i] += 1
+            self._sums[label] += value
+
+    @contextmanager
+    def time(self, label: LabelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label, time.perf_counter() - start)
+
+    def _items(self):
+        with self._lock:
+            return [(label, list(counts), self._sums[label]) for label, counts in self._counts.items()]
+
+    def snapshot(self) -> Dict[str, dict]:
+        """label -> {"count", "sum", "buckets": {upper bound: cumulative count}}"""
+        res = {}
+        for label, counts, total in self._items():
+            cumulative, running = {}, 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                running += c
+                cumulative[str(bound)] = running
+            key = label if isinstance(label, str) else "|".join(label)
+            res[key] = {"count": running, "sum": total, "buckets": cumulative}
+        return res
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, counts, total in self._items():
+            values = (label,) if isinstance(label, str) else label
+            running = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                running += c
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_label_str(self.labels, values, le)} {running}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, values)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, values)} {running}")
+        return lines
+
+
+class Sampled:
+    """
+    Counter or gauge read from the owning object at scrape time, so the hot path
+    pays nothing for it. fn returns a number, or {label value(s): number}.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], object], labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labels = tuple(labels)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        if isinstance(value, dict):
+            for label, v in value.items():
+                values = (label,) if isinstance(label, str) else label
+                lines.append(f"{self.name}{_label_str(self.labels, values)} {_format_value(v)}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Histogram, Sampled]] = {}
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = ("label",),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Histogram(name, help, labels, buckets)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable[[], object], labels: Sequence[str] = ()):
+        self._metrics[name] = Sampled(name, help, "gauge", fn, labels)
+
+    def counter(self, name: str, help: str, fn: Callable[[], object], labels: Sequence[str] = ()):
+        self._metrics[name] = Sampled(name, help, "counter", fn, labels)
+
+    def get(self, name: str) -> Optional[Union[Histogram, Sampled]]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()